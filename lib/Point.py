@@ -1,7 +1,5 @@
 
 from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import reportlab.pdfbase.ttfonts
 import logging
 
 log = logging.getLogger('root')
@@ -76,6 +74,7 @@ class FontTracker:
   size = 10
   fontname = "courier"
   fileLocator = None
+  fontCache = None #RasCache.FontCache for parsed TrueType fonts.
 
   def __init__(self, **args):
     for k in args.keys():
@@ -105,10 +104,24 @@ class FontTracker:
       fontfile = self.fileLocator(fontname)
     else:
       fontfile = fontname
+    font = None
+    if self.fontCache: font = self.fontCache.get(fontfile, fontname)
+    if font is not None:
+      log.debug("TTFont(%s, %s) from cache", fontname, fontfile)
+    else:
+      font = self._parseFont(fontname, fontfile)
+      if self.fontCache: self.fontCache.put(fontfile, font)
+
+    log.debug("Font: %s", font)
+    pdfmetrics.registerFont(font)
+    fonts[fontname] = [ fontname, fontname, fontname, fontname ]  #Use the same font no matter what styles are specified
+
+  def _parseFont(self, fontname, fontfile):
+    from reportlab.pdfbase.ttfonts import TTFont, TTFError #Only imported by jobs with TrueType fonts.
     log.debug("TTFont(%s, %s)", fontname, fontfile)
     try:
-      font = TTFont(fontname, fontfile)
-    except reportlab.pdfbase.ttfonts.TTFError, e: 
+      return TTFont(fontname, fontfile)
+    except TTFError, e: 
       if str(e).find("Font does not allow subsetting/embedding") > -1:
         print ""
         print "The font you are trying to load is set to not allow embedding. Use another font or edit"
@@ -117,10 +130,6 @@ class FontTracker:
         print ""
       raise
 
-    log.debug("Font: %s", font)
-    pdfmetrics.registerFont(font)
-    fonts[fontname] = [ fontname, fontname, fontname, fontname ]  #Use the same font no matter what styles are specified
-
   def getFontName(self):
     """Name of font to use."""
     fontnumber = 0
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""On disk caches for raspdf.
+
+Everything lives under the directory given by the cachedir option in xmmail.conf.
+If cachedir is not set no caching is done. Eg:
+
+[global]
+cachedir = /var/cache/raspdf
+;Maximum size of the finished pdf cache in megabytes.
+cachesize = 200
+;Permissions of the files in the cache. Only the user who made them can read them by default.
+;0640 lets the group of the cache directory read them too.
+cachemode = 0600
+
+JobCache stores finished pdfs keyed by a hash of the raw report, the options that change
+the layout, the current directory and the search path. Reprints of the same spool file are then
+copied straight from the cache.
+
+ProgramCache stores parsed include files so that they are not parsed again by the next run.
+They are only used if the include files they name still find the same files.
+
+FontCache stores parsed TrueType fonts so that the font files are not parsed by every run.
+
+Everything is stored with marshal, which can only hold plain data. Nothing read back from the
+cache can run code, even if someone else has written to it.
+
+ImageCache stores pictures already encoded for the pdf. See RasImage.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, os.path, marshal, tempfile, shutil, types
+import logging
+import RasConfig, RasProgram
+import reportlab
+
+try:
+  from hashlib import sha1
+except ImportError: #Python 2.4
+  from sha import new as sha1
+
+log = logging.getLogger()
+
+FORMAT = 4 #Increase whenever a change to raspdf changes the pdf produced for the same input.
+MODE = 0600 #Permissions of cache files if cachemode is not set.
+FONTFORMAT = 2 #Increase whenever the layout of a FontCache entry changes.
+BLOCKSIZE = 1024 * 1024 #Finished pdfs are copied in and out of the cache this many bytes at a time.
+
+def cacheDir(name):
+  """Returns the directory to use for the cache called name. Creates it if needed.
+     Returns None if caching is not configured or the directory can't be created.
+  """
+  if isinstance(RasConfig.xmmail, dict): return None #RasConfig.load() has not been called.
+  root = RasConfig.get_default('global', 'cachedir', None)
+  if not root: return None
+  d = os.path.join(root, name)
+  if not os.path.isdir(d):
+    try:
+      os.makedirs(d)
+    except OSError, e:
+      log.warning("Caching disabled. Could not create cache directory %s: %s", d, e)
+      return None
+  return d
+
+def fileMode():
+  """Permissions for new cache files. cachemode in xmmail.conf. Never writable by anyone else or
+     readable by everyone as finished reports can hold anything.
+  """
+  if isinstance(RasConfig.xmmail, dict): return MODE
+  try:
+    return int(RasConfig.get_default('global', 'cachemode', "%o" % (MODE)), 8) & 0640
+  except ValueError:
+    log.warning("cachemode must be octal, eg 0640. Using %o", MODE)
+    return MODE
+
+def writeFile(fname, data):
+  """Write data to fname so that other processes never see a partly written file.
+     data is a string or a file to copy from its current position.
+  """
+  fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), prefix=".tmp")
+  try:
+    f = os.fdopen(fd, "wb")
+    if isinstance(data, basestring):
+      f.write(data)
+    else:
+      shutil.copyfileobj(data, f, BLOCKSIZE)
+    f.close()
+    os.chmod(tmpname, fileMode())
+    os.rename(tmpname, fname)
+  except:
+    if os.path.exists(tmpname): os.unlink(tmpname)
+    raise
+
+def fileStamps(filenames):
+  """Returns a list of (filename, mtime, size) used to check that files have not changed."""
+  stamps = []
+  for f in filenames:
+    try:
+      st = os.stat(f)
+    except OSError:
+      continue
+    stamps.append((f, st.st_mtime, st.st_size))
+  return stamps
+
+def stampsValid(stamps):
+  """True if none of the files in stamps (from fileStamps) have changed."""
+  for f, mtime, size in stamps:
+    try:
+      st = os.stat(f)
+    except OSError:
+      return False
+    if st.st_mtime != mtime or st.st_size != size: return False
+  return True
+
+def namesValid(names):
+  """True if every (name, path) in names (see RasConfig.locatedNames) still finds the same path."""
+  for name, path in names:
+    try:
+      if RasConfig.fileLocate(name) != path: return False
+    except RasConfig.RasConfigNoSuchFileError:
+      return False
+  return True
+
+def jobCache():
+  """Returns the JobCache configured in xmmail.conf or None if there is none."""
+  d = cacheDir('jobs')
+  if d is None: return None
+  maxsize = int(RasConfig.get_default('global', 'cachesize', '100')) * 1024 * 1024
+  return JobCache(d, maxsize)
+
+class JobCache:
+  """Size limited least recently used cache of finished pdf files.
+     Each entry is <key>.pdf and <key>.dep. The dep file lists the include files, pictures and fonts
+     used by the report and the names they were found by. An entry is not used if any of the files
+     have changed or a name now finds another file.
+  """
+  def __init__(self, directory, maxsize):
+    self.directory = directory
+    self.maxsize = maxsize
+
+  def key(self, digest, *options):
+    """Returns the cache key for the hex sha1 digest of the raw report and any options that affect the layout.
+       The same report run somewhere else can find other include files, pictures and fonts so the
+       current directory and the search path are part of the key.
+    """
+    h = sha1(digest)
+    h.update(repr((FORMAT, os.getcwd(), tuple(RasConfig.searchLocations)) + options))
+    return h.hexdigest()
+
+  def get(self, key):
+    """Returns the cached pdf as an open file or None."""
+    pdfname = os.path.join(self.directory, key + ".pdf")
+    try:
+      stamps, names = marshal.loads(file(os.path.join(self.directory, key + ".dep"), "rb").read())
+      if not stampsValid(stamps) or not namesValid(names):
+        log.debug("Job cache entry %s is out of date", key)
+        return None
+      pdf = file(pdfname, "rb")
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      return None
+    try:
+      os.utime(pdfname, None) #Mark as recently used.
+    except OSError: #Eg a read only cache. Still a hit.
+      pass
+    log.debug("Job cache hit %s", key)
+    return pdf
+
+  def put(self, key, data, depends=(), names={}):
+    """Store a pdf. data is the pdf or a file to copy it from. depends lists the files the report used
+       and names is the name: file they were found by (see RasConfig.locatedNames).
+    """
+    try:
+      writeFile(os.path.join(self.directory, key + ".dep"), marshal.dumps((fileStamps(depends), names.items())))
+      writeFile(os.path.join(self.directory, key + ".pdf"), data)
+      self.evict()
+    except (IOError, OSError), e:
+      log.warning("Could not write to job cache %s: %s", self.directory, e)
+
+  def evict(self):
+    """Remove the least recently used entries until the cache is smaller than maxsize."""
+    entries = []
+    total = 0
+    for f in os.listdir(self.directory):
+      if not f.endswith(".pdf"): continue
+      try:
+        st = os.stat(os.path.join(self.directory, f))
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, f[:-4]))
+      total += st.st_size
+    entries.sort()
+    while total > self.maxsize and entries:
+      mtime, size, key = entries.pop(0)
+      log.debug("Job cache evicting %s", key)
+      for ext in (".pdf", ".dep"):
+        try: os.unlink(os.path.join(self.directory, key + ext))
+        except OSError: pass
+      total -= size
+
+def programCache():
+  """Returns the ProgramCache for include files or None if caching is not configured."""
+  d = cacheDir('includes')
+  if d is None: return None
+  return ProgramCache(d)
+
+class ProgramCache:
+  """Parsed files stored as RasProgram strings. Keyed by the full path of the file and anything else
+     that changes what it includes (see RascalPDF._Parser._loadInclude).
+     Each entry also holds the fileStamps of the file and anything it included and the
+     (name, path) of each include it used.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+
+  def _fname(self, key):
+    return os.path.join(self.directory, sha1(repr((FORMAT, key))).hexdigest() + ".prog")
+
+  def get(self, key):
+    """Returns (<stamps>, <names>, <RasProgram.Program>) or None. Neither the stamps nor the names are checked."""
+    try:
+      stamps, names, data = marshal.loads(file(self._fname(key), "rb").read())
+      return stamps, names, RasProgram.loads(data)
+    except (IOError, OSError, EOFError, ValueError, TypeError, RasProgram.RasProgramError):
+      return None
+
+  def put(self, key, stamps, names, program):
+    try:
+      writeFile(self._fname(key), marshal.dumps((stamps, names, program.dumps())))
+    except (IOError, OSError), e:
+      log.warning("Could not write to include cache %s: %s", self.directory, e)
+
+def fontCache():
+  """Returns the FontCache for TrueType fonts or None if caching is not configured."""
+  d = cacheDir('fonts')
+  if d is None: return None
+  return FontCache(d)
+
+def _instance(cls, attributes):
+  """An instance of cls with attributes (a dict) made without calling cls.__init__."""
+  if isinstance(cls, type):
+    obj = cls.__new__(cls)
+  else: #Old style class.
+    obj = types.InstanceType(cls)
+  obj.__dict__.update(attributes)
+  return obj
+
+class FontCache:
+  """Parsed reportlab TTFont objects stored with marshal as the attributes of the font, its face
+     and its encoding. Keyed by the full path of the font file.
+     Entries are only used if the font file and the reportlab version are unchanged.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+
+  def _fname(self, path):
+    return os.path.join(self.directory, sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + ".font")
+
+  def get(self, path, fontname):
+    """Returns the TTFont for path registered as fontname or None."""
+    try:
+      fmt, version, stamps, attributes, face, encoding = marshal.loads(file(self._fname(path), "rb").read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      return None
+    if fmt != FONTFORMAT or version != reportlab.Version or not stampsValid(stamps):
+      log.debug("Font cache entry for %s is out of date", path)
+      return None
+    from weakref import WeakKeyDictionary
+    from reportlab.pdfbase.ttfonts import TTFont, TTFontFace, TTEncoding
+    font = _instance(TTFont, attributes)
+    font.face = _instance(TTFontFace, face)
+    font.encoding = _instance(TTEncoding, encoding)
+    font.fontName = fontname
+    font.state = WeakKeyDictionary() #Per document subset state. Not stored.
+    return font
+
+  def put(self, path, font):
+    """Store a TTFont. Must be called before the font is used in a document."""
+    from reportlab.pdfbase.ttfonts import TTFont, TTFontFace, TTEncoding
+    if (font.__class__, font.face.__class__, font.encoding.__class__) != (TTFont, TTFontFace, TTEncoding):
+      return #get() would not make the same classes.
+    attributes = dict(vars(font))
+    for name in ('face', 'encoding', 'state'): attributes.pop(name, None)
+    try:
+      writeFile(self._fname(path), marshal.dumps((FONTFORMAT, reportlab.Version, fileStamps([path]), attributes,
+        vars(font.face), vars(font.encoding))))
+    except ValueError, e: #Something marshal can't store. A newer reportlab?
+      log.warning("Font %s can't be cached: %s", path, e)
+    except (IOError, OSError), e:
+      log.warning("Could not write to font cache %s: %s", self.directory, e)
+
+def imageCache():
+  """Returns the ImageCache for pictures or None if caching is not configured."""
+  d = cacheDir('images')
+  if d is None: return None
+  return ImageCache(d)
+
+class ImageCache:
+  """RasImage.EncodedImage tuples stored with marshal. The name of an image already
+     includes the file stamps and size so entries never go out of date.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+
+  def get(self, name):
+    try:
+      return marshal.loads(file(os.path.join(self.directory, name + ".img"), "rb").read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      return None
+
+  def put(self, name, t):
+    try:
+      writeFile(os.path.join(self.directory, name + ".img"), marshal.dumps(t))
+    except (IOError, OSError), e:
+      log.warning("Could not write to image cache %s: %s", self.directory, e)
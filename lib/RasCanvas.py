@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Graphics state tracking between RascalPDF and the reportlab canvas.
+
+Rascal reports set the font before every piece of text. Sent straight to the canvas every
+one of those becomes a Tf operator in the page. StateCanvas remembers what has already been
+set on the current page and only passes on the changes.
+
+Text is also batched. canvas.drawString wraps every fragment in its own BT/ET text object.
+StateCanvas keeps a single text object open and moves between fragments with relative Td
+moves. The text object is only closed when something else (a box, line, picture or the end
+of the page) needs to be drawn.
+
+Forms (PDF Form XObjects) are recorded with beginForm/endForm and placed with doForm.
+
+LayoutCanvas takes the place of StateCanvas when only the page breaks are wanted.
+
+RascalPDF only ever draws through these methods so anything with the same methods and the
+fillcolor and linewidth attributes can be used as a backend. See RasDirect for one that does
+not need reportlab's canvas.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+from RasConfig import RascalPDFException
+
+class Unsupported(RascalPDFException):
+  """Thrown by a canvas asked to draw something it can't. Jobs are checked before a canvas is
+     chosen (see RasDirect.canDraw and LayoutCanvas.unsupported) so this means a check was missed.
+  """
+
+class StateCanvas:
+  """Wraps a reportlab canvas. Font, fill colour and line width are only set when they change
+     and text is collected into one text object until a non text operation is needed.
+  """
+
+  def __init__(self, canvas):
+    self.canvas = canvas
+    self.saved = [] #State of the page while forms are being recorded.
+    self.reset()
+
+  def reset(self):
+    """Forget the current state. reportlab starts every page with its defaults."""
+    self.text = None #The open text object.
+    self.linestart = None #(x, y) of the start of the current line in the text object. Td moves are relative to this.
+    self.textfont = None #Font set in the open text object.
+    self.font = None #(name, size) to use for the next text.
+    self.fillcolor = None #(r, g, b)
+    self.linewidth = None
+
+  def flush(self):
+    """Close any open text object. Must be called before any drawing operation other than text."""
+    if self.text is not None:
+      self.canvas.drawText(self.text)
+      self.text = None
+
+  def setFont(self, fontname, size):
+    """Font for the following text. Nothing is output until text is drawn."""
+    self.font = (fontname, size)
+
+  def setFillColorRGB(self, r, g, b):
+    if self.fillcolor != (r, g, b):
+      if self.text is not None: #Colour operators are allowed inside a text object.
+        self.text.setFillColorRGB(r, g, b)
+      else:
+        self.canvas.setFillColorRGB(r, g, b)
+      self.fillcolor = (r, g, b)
+
+  def setLineWidth(self, width):
+    if self.linewidth != width:
+      self.flush()
+      self.canvas.setLineWidth(width)
+      self.linewidth = width
+
+  def drawString(self, x, y, text):
+    """Draw text at x,y in the current font."""
+    if self.text is None:
+      self.text = self.canvas.beginText(x, y)
+      self.textfont = None
+    elif self.linestart != (x, y):
+      lx, ly = self.linestart
+      self.text.moveCursor(x - lx, ly - y) #moveCursor measures y downwards.
+    self.linestart = (x, y)
+    if self.textfont != self.font:
+      self.text.setFont(self.font[0], self.font[1])
+      self.textfont = self.font
+    self.text._textOut(text) #textOut() would also measure the text which RascalPDF has already done.
+
+  def rect(self, *args, **kwargs):
+    self.flush()
+    self.canvas.rect(*args, **kwargs)
+
+  def roundRect(self, *args, **kwargs):
+    self.flush()
+    self.canvas.roundRect(*args, **kwargs)
+
+  def line(self, x1, y1, x2, y2):
+    """Line from x1,y1 to x2,y2. Drawn as a stroked and filled path the way xxpdf did."""
+    self.flush()
+    path = self.canvas.beginPath()
+    path.moveTo(x1, y1)
+    path.lineTo(x2, y2)
+    self.canvas.drawPath(path, stroke=1, fill=1)
+
+  def drawImage(self, image, x, y, width=None, height=None):
+    """image is a file name or a RasImage.EncodedImage"""
+    self.flush()
+    if isinstance(image, basestring):
+      self.canvas.drawImage(image, x, y, width, height)
+    else:
+      image.drawOn(self.canvas, x, y, width, height)
+
+  def beginForm(self, name):
+    """Everything drawn until endForm() goes into the form called name instead of the page."""
+    self.flush()
+    self.saved.append((self.fillcolor, self.linewidth))
+    self.canvas.beginForm(name)
+    self.reset() #A form only knows what it sets itself.
+
+  def endForm(self):
+    """Finish the form. Returns the (fill colour, line width) the form ended with. None for ones it did not set."""
+    self.flush()
+    self.canvas.endForm()
+    end = (self.fillcolor, self.linewidth)
+    self.reset()
+    self.fillcolor, self.linewidth = self.saved.pop()
+    return end
+
+  def doForm(self, name, fillcolor=None, linewidth=None):
+    """Place a form on the page. fillcolor and linewidth as returned by endForm.
+       A form can't change the state of the page it is drawn on so they are set again here.
+    """
+    self.flush()
+    self.canvas.doForm(name)
+    if fillcolor is not None: self.setFillColorRGB(*fillcolor)
+    if linewidth is not None: self.setLineWidth(linewidth)
+
+  def showPage(self):
+    self.flush()
+    self.canvas.showPage()
+    self.reset()
+
+class LayoutCanvas:
+  """Same methods as StateCanvas but nothing is drawn. Counts the pages and records the order
+     fonts and pictures are first used in. Used by RasParallel to plan a job.
+  """
+  fillcolor = None
+  linewidth = None
+
+  def __init__(self):
+    self.pages = 0 #Pages finished so far.
+    self.font = None
+    self.resources = [] #(page number, 'font', font name) or (page number, 'image', RasImage.EncodedImage)
+    self.seen = set()
+    self.unsupported = None #Reason the job can't be drawn in parts.
+
+  def reset(self): pass
+  def flush(self): pass
+  def setFillColorRGB(self, r, g, b): pass
+  def setLineWidth(self, width): pass
+  def rect(self, *args, **kwargs): pass
+  def roundRect(self, *args, **kwargs): pass
+  def line(self, x1, y1, x2, y2): pass
+
+  def setFont(self, fontname, size):
+    self.font = fontname
+
+  def drawString(self, x, y, text):
+    if self.font not in self.seen: #reportlab adds a font to the document the first time text uses it.
+      self.seen.add(self.font)
+      self.resources.append((self.pages, 'font', self.font))
+
+  def drawImage(self, image, x, y, width=None, height=None):
+    if isinstance(image, basestring):
+      self.unsupported = "picture %s can only be drawn by reportlab" % (image)
+    elif image.name not in self.seen:
+      self.seen.add(image.name)
+      self.resources.append((self.pages, 'image', image))
+
+  def beginForm(self, name):
+    raise Unsupported("FORM can't be laid out in advance")
+
+  def showPage(self):
+    self.pages += 1
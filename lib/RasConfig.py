@@ -13,14 +13,19 @@ __license__ = "GNU LGPL version 2"
 __status__ = "Production"
 
 from ConfigParser import ParsingError, SafeConfigParser as ConfigParser, NoSectionError, NoOptionError
-import os, os.path, sys
+import os, os.path, sys, time
 import logging
 
 xmmail = {}
 
 log = logging.getLogger("config")
 
-searchLocations = ["images", "templates"]; #Locations to search for files
+searchSubdirs = ["images", "templates"] #Sub directories of each search directory that are also searched.
+searchLocations = [] #Locations to search for files. See _initSearchLocations
+templateDirs = [] #Directories from the templates option. Searched after everything else.
+locatedFiles = set() #Every file found by fileLocate. Used by the caches to check if a report's files have changed.
+locatedNames = {} #Name given to fileLocate: the file it found. Used by the caches to check that names still find the same files.
+INDEXCHECK = 1.0 #Seconds fileLocate trusts its index before checking the directories for changes.
 
 class RascalPDFException(Exception):
    """The base exception for any fatal RasPDF error"""
@@ -38,7 +43,6 @@ def __appendIfNotExists(value, listobj):
 
 def _initSearchLocations():
   """Build a list of directories to search for files in."""
-  global searchLocations
   #Try build up a fairly detailed list of paths to search for files. 
   searchdirs = []
   curdir = os.path.abspath(os.curdir)
@@ -54,18 +58,110 @@ def _initSearchLocations():
   destdirs = []
   for d in searchdirs: 
     __appendIfNotExists(d, destdirs) 
-    for i in searchLocations: #Expand every search path listed in the original searchLocation with each of the search directories above.
+    for i in searchSubdirs: #Expand every search path with each of the sub directories.
       __appendIfNotExists(os.path.join(d, i), destdirs)
-    
-  searchLocations = destdirs
-  searchLocations.insert(0,'.')
+  for d in templateDirs:
+    __appendIfNotExists(d, destdirs)
+
+  searchLocations[:] = ['.'] + destdirs
+
+def setCurrentDirectory(d):
+  """Change to directory d and search it instead of the directory raspdf was started in.
+     Used by the render server (see server.py) which runs jobs for clients in other directories.
+  """
+  if os.path.abspath(d) == os.path.abspath(os.curdir): return
+  os.chdir(d)
+  _initSearchLocations()
+
+class _Index:
+  """filename: path of every file in the searchLocations. Each directory is listed once and only
+     listed again when its mtime changes. The first directory with the name wins, the same as
+     searching them in order.
+  """
+
+  def __init__(self):
+    self.paths = {}
+    self.listings = {} #Full path of directory: (mtime, names)
+    self.key = None #(current directory, searchLocations) the paths were built for.
+    self.checked = 0 #When the directories were last checked for changes.
+
+  def _changed(self):
+    """True if any directory on the search path has changed since the paths were built."""
+    for d in searchLocations:
+      listing = self.listings.get(os.path.abspath(d))
+      try:
+        if listing is None or os.stat(d).st_mtime != listing[0]: return True
+      except OSError:
+        if listing is None or listing[1]: return True #Directory has gone.
+    return False
+
+  def _build(self):
+    self.key = (os.getcwd(), tuple(searchLocations))
+    listings = {}
+    paths = {}
+    for d in reversed(searchLocations): #Earlier directories replace later ones.
+      full = os.path.abspath(d)
+      try:
+        mtime = os.stat(d).st_mtime
+        names = os.listdir(d)
+      except OSError:
+        mtime, names = None, []
+      listings[full] = (mtime, names)
+      if d == '.': d = full #The same full path fileLocate has always returned for the current directory.
+      for name in names: paths[name] = os.path.join(d, name)
+    self.listings = listings
+    self.paths = paths
+
+  def get(self, filename, refresh=False):
+    """Path of filename in the first search directory that has it or None.
+       refresh checks the directories for changes no matter when they were last checked.
+       The index is always built again if the path it has for filename no longer exists.
+    """
+    now = time.time()
+    if self.key != (os.getcwd(), tuple(searchLocations)): #Search path has changed.
+      self._build()
+      self.checked = now
+    elif refresh or now - self.checked > INDEXCHECK:
+      if self._changed(): self._build()
+      self.checked = now
+    path = self.paths.get(filename)
+    if path is not None and not os.path.exists(path): #Deleted since the directories were last checked.
+      self._build()
+      self.checked = now
+      path = self.paths.get(filename)
+    return path
+
+_index = _Index()
+
+def _plainName(filename):
+  """True if filename can be looked up in the index. No directory and only ascii if unicode."""
+  if os.sep in filename or (os.altsep and os.altsep in filename) or filename in (os.curdir, os.pardir): return False
+  if isinstance(filename, unicode):
+    try:
+      filename.encode('ascii') #Directory listings are byte strings.
+    except UnicodeError:
+      return False
+  return True
+
+def _located(filename, fname):
+  """Record that fileLocate found filename at fname. Returns fname."""
+  locatedFiles.add(fname)
+  locatedNames[filename] = fname
+  return fname
 
 def fileLocate(filename):
-  """Search  self.searchLocations for the file name"""
+  """Search searchLocations for the file name. Plain names are looked up in an index of the
+     search directories. Names with a directory in them are looked for in each directory in turn.
+  """
   if filename[0] == '"' and filename[-1] == '"': #Filename has quotes around it which need to be removed.
     filename = filename[1:-1]
+  if _plainName(filename):
+    fname = _index.get(filename) or _index.get(filename, refresh=True) #Check again in case it has just been created.
+    if fname is not None:
+      return _located(filename, fname)
+    raise RasConfigNoSuchFileError("Could not find filename %s in any of the following directories: %s" % ( filename, " : ".join(searchLocations)))
   if os.path.exists(filename): 
-    return os.path.abspath(filename) #Full path, already exists.
+    return _located(filename, os.path.abspath(filename)) #Full path, already exists.
   for d in searchLocations:
     try: 
       fname = os.path.join(d, filename)
@@ -75,7 +171,7 @@ def fileLocate(filename):
       print filename.encode('utf-8')
       raise
     if os.path.exists(fname): 
-        return fname
+        return _located(filename, fname)
   raise RasConfigNoSuchFileError("Could not find filename %s in any of the following directories: %s" % ( filename, " : ".join(searchLocations)))
 
 def get(section, option, default=None):
@@ -156,9 +252,9 @@ def load(configfile='xmmail.conf', defaults={'smtpserver': '127.0.0.1', 'templat
 
 
   templates =  get('global', 'templates', default='')
-  destdirs = []
   for d in templates.split(":"): 
     d = d.strip()
+    if d and d not in templateDirs: templateDirs.append(d)
     __appendIfNotExists(d, searchLocations) 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Writes text only reports straight to pdf without reportlab's canvas.
+
+Most spools only use text, font changes, colours, boxes and lines. DirectCanvas has the same
+methods as RasCanvas.StateCanvas and writes the page operators itself. Each page is written
+to the file as soon as it is finished.
+
+PrintJob uses it when canDraw() says the whole job can be drawn with it. Anything else is
+drawn with reportlab:
+
+  {$PIC} and {$FORM}
+  TrueType fonts and the Symbol and ZapfDingbats fonts
+  Text that can't be written in WinAnsiEncoding
+  The small compression profile, which needs reportlab's object streams (see RasWriter)
+
+Set backend = reportlab in the [global] section of xmmail.conf to never use it.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import re, math, time, logging
+import RasConfig
+from RasProgram import Program
+from RasCanvas import Unsupported
+from Point import fonts
+
+log = logging.getLogger()
+
+ENCODING = 'cp1252' #Same as the WinAnsiEncoding of the standard fonts.
+#Fonts that need no embedding and use WinAnsiEncoding.
+STANDARDFONTS = set([ f for name in ('courier', 'helvetica', 'times') for f in fonts[name] ])
+
+_ESCAPES = dict([ (chr(c), "\\%03o" % (c)) for c in range(0, 32) + range(127, 256) ])
+_ESCAPES.update({ "\\": "\\\\", "(": "\\(", ")": "\\)" })
+_NEEDSESCAPE = re.compile(r"[\\()\x00-\x1f\x7f-\xff]")
+_TRAILINGZEROS = re.compile("0+$")
+
+def backend():
+  """The backend option from xmmail.conf. auto or reportlab."""
+  if isinstance(RasConfig.xmmail, dict): return 'auto' #RasConfig.load() has not been called.
+  return RasConfig.get_default('global', 'backend', 'auto')
+
+def canDraw(program, compression):
+  """True if every command in program (a RasProgram.Program) can be drawn by DirectCanvas.
+     compression is the RasWriter.Compression the pdf will be written with.
+  """
+  if not isinstance(program, Program) or backend() != 'auto': return False
+  if compression.objectstreams: return False
+  for name in ('PIC', 'FORM'):
+    if name in program.names:
+      log.debug("Drawing with reportlab: %s is used", name)
+      return False
+  for params, kwargs in program.argsOf('FONTNAME'):
+    name = params and params[0] or kwargs.get('name')
+    if isinstance(name, basestring) and len(name) > 1 and name[0] == '"' and name[-1] == '"': name = name[1:-1]
+    if name not in ('courier', 'helvetica', 'times'):
+      log.debug("Drawing with reportlab: font %s", name)
+      return False
+  for c in program.consts:
+    if not isinstance(c, basestring): continue
+    try:
+      if not isinstance(c, unicode): c = c.decode('utf8')
+      c.encode(ENCODING)
+    except UnicodeError:
+      log.debug("Drawing with reportlab: %r is not in %s", c, ENCODING)
+      return False
+  return True
+
+def num(*values):
+  """Numbers formatted for pdf operators. The same as reportlab's fp_str so pages come out the same."""
+  s = []
+  for v in values:
+    if v == int(v): #Most positions are whole points.
+      s.append(str(int(v)))
+      continue
+    a = abs(v)
+    if a <= 1e-7:
+      s.append('0')
+      continue
+    places = a <= 1 and 6 or min(max(0, 6 - int(math.log10(a))), 6)
+    n = "%.*f" % (places, v)
+    if places:
+      n = _TRAILINGZEROS.sub('', n)
+      if n[-1] == '.': n = n[:-1]
+    if n[0] == '0' and len(n) > 1: n = n[1:]
+    s.append(n)
+  return " ".join(s)
+
+def escape(text):
+  """text as the inside of a pdf string. Unicode is encoded to ENCODING first."""
+  if isinstance(text, unicode):
+    try: text = text.encode('ascii') #Quicker than ENCODING and most text is plain ascii.
+    except UnicodeEncodeError: text = text.encode(ENCODING, 'replace')
+  return _NEEDSESCAPE.sub(lambda m: _ESCAPES[m.group()], text)
+
+class Info:
+  """Document information. Same attribute names as reportlab's PDFInfo."""
+  producer = "Raspdf"
+  creator = "Raspdf"
+  title = "untitled"
+  author = "anonymous"
+  subject = "unspecified"
+  keywords = ""
+
+class DirectCanvas:
+  """Same methods as RasCanvas.StateCanvas. Writes the pdf to out (a file or file name) itself.
+     pagesize is (width, height) in points and compression a RasWriter.Compression.
+     Object 1 is the catalog, 2 the page tree and 3 the font dictionary. Pages and their
+     content streams are numbered from 4 in the order they are finished.
+  """
+
+  def __init__(self, out, pagesize, compression):
+    if isinstance(out, basestring): out = file(out, "wb")
+    self.out = out
+    self.pagesize = pagesize
+    self.compression = compression
+    self.info = Info()
+    self.offsets = [] #File offset of every object. Object n is offsets[n - 1].
+    self.pages = [] #Object number of every page.
+    self.fontnames = {} #Font name: internal name (F1, F2 ...) in order of first use.
+    self.offset = 0
+    self._write("%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+    self.offsets.extend([None, None, None]) #Catalog, pages and font dictionary are written by save().
+    self.code = []
+    self.reset()
+
+  def _write(self, data):
+    self.out.write(data)
+    self.offset += len(data)
+
+  def _object(self, data, number=None):
+    """Write data as an indirect object. Returns its number. A new one unless number is given."""
+    if number is None:
+      self.offsets.append(None)
+      number = len(self.offsets)
+    self.offsets[number - 1] = self.offset
+    self._write("%d 0 obj\n%s\nendobj\n" % (number, data))
+    return number
+
+  def reset(self):
+    """Forget the current state. Every page starts with the pdf defaults."""
+    self.text = False #True while a text object is open.
+    self.linestart = None
+    self.textfont = None
+    self.font = None
+    self.fillcolor = None
+    self.linewidth = None
+
+  def flush(self):
+    """Close any open text object."""
+    if self.text:
+      self.code.append("ET")
+      self.text = False
+
+  def setFont(self, fontname, size):
+    self.font = (fontname, size)
+
+  def setFillColorRGB(self, r, g, b):
+    if self.fillcolor != (r, g, b):
+      self.code.append("%s rg" % (num(r, g, b)))
+      self.fillcolor = (r, g, b)
+
+  def setLineWidth(self, width):
+    if self.linewidth != width:
+      self.flush()
+      self.code.append("%s w" % (num(width)))
+      self.linewidth = width
+
+  def drawString(self, x, y, text):
+    code = self.code
+    if not self.text:
+      code.append("BT 1 0 0 1 %s Tm" % (num(x, y)))
+      self.text = True
+      self.textfont = None
+    elif self.linestart != (x, y):
+      lx, ly = self.linestart
+      code.append("%s Td" % (num(x - lx, y - ly)))
+    self.linestart = (x, y)
+    if self.textfont != self.font:
+      fontname, size = self.font
+      internal = self.fontnames.get(fontname)
+      if internal is None:
+        if fontname not in STANDARDFONTS: raise Unsupported("Font %s can only be drawn by reportlab" % (fontname))
+        internal = self.fontnames[fontname] = "F%d" % (len(self.fontnames) + 1)
+      code.append("/%s %s Tf %s TL" % (internal, num(size), num(size * 1.2)))
+      self.textfont = self.font
+    if not isinstance(text, unicode): text = text.decode('utf8')
+    code.append("(%s) Tj" % (escape(text)))
+
+  def rect(self, x, y, width, height, stroke=1, fill=0):
+    self.flush()
+    self.code.append("n %s re %s" % (num(x, y, width, height), _paint(stroke, fill)))
+
+  def roundRect(self, x, y, width, height, radius, stroke=1, fill=0):
+    """Corners are bezier quarter circles, the same as reportlab draws them."""
+    self.flush()
+    t = 0.4472 * radius
+    x0, x1, x2, x3, x4, x5 = x, x + t, x + radius, x + width - radius, x + width - t, x + width
+    y0, y1, y2, y3, y4, y5 = y, y + t, y + radius, y + height - radius, y + height - t, y + height
+    self.code.extend([ "n %s m" % (num(x2, y0)),
+      "%s l" % (num(x3, y0)), "%s c" % (num(x4, y0, x5, y1, x5, y2)),
+      "%s l" % (num(x5, y3)), "%s c" % (num(x5, y4, x4, y5, x3, y5)),
+      "%s l" % (num(x2, y5)), "%s c" % (num(x1, y5, x0, y4, x0, y3)),
+      "%s l" % (num(x0, y2)), "%s c" % (num(x0, y1, x1, y0, x2, y0)),
+      "h", _paint(stroke, fill) ])
+
+  def line(self, x1, y1, x2, y2):
+    self.flush()
+    self.code.append("n %s m %s l B" % (num(x1, y1), num(x2, y2)))
+
+  def drawImage(self, image, x, y, width=None, height=None):
+    raise Unsupported("PIC can only be drawn by reportlab")
+
+  def beginForm(self, name):
+    raise Unsupported("FORM can only be drawn by reportlab")
+
+  def showPage(self):
+    """Write the finished page and its content stream."""
+    self.flush()
+    data, filters = self.compression.encode("\n".join(self.code))
+    self.code = []
+    self.reset()
+    stream = self._object("<< /Length %d%s >>\nstream\n%s\nendstream" % (len(data), _filters(filters), data))
+    page = self._object("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s] /Resources << /Font 3 0 R /ProcSet [/PDF /Text] >> /Contents %d 0 R >>"
+      % (num(*self.pagesize), stream))
+    self.pages.append(page)
+
+  def save(self):
+    """Finish the document. Writes the fonts, page tree, catalog, info, xref and trailer."""
+    if self.code: self.showPage()
+    entries = []
+    for fontname, internal in sorted(self.fontnames.items(), key=lambda f: int(f[1][1:])):
+      n = self._object("<< /Type /Font /Subtype /Type1 /Name /%s /BaseFont /%s /Encoding /WinAnsiEncoding >>" % (internal, fontname))
+      entries.append("/%s %d 0 R" % (internal, n))
+    self._object("<< %s >>" % (" ".join(entries)), 3)
+    self._object("<< /Type /Pages /Count %d /Kids [%s] >>" % (len(self.pages), " ".join([ "%d 0 R" % (p) for p in self.pages ])), 2)
+    self._object("<< /Type /Catalog /Pages 2 0 R >>", 1)
+    i = self.info
+    info = self._object("<< /Producer (%s) /Creator (%s) /Title (%s) /Author (%s) /Subject (%s) /Keywords (%s) /CreationDate (%s) >>"
+      % (escape(i.producer), escape(i.creator), escape(i.title), escape(i.author), escape(i.subject), escape(i.keywords),
+      time.strftime("D:%Y%m%d%H%M%S+00'00'", time.gmtime())))
+    xref = self.offset
+    self._write("xref\n0 %d\n0000000000 65535 f \n%s" % (len(self.offsets) + 1, "".join([ "%010d 00000 n \n" % (o) for o in self.offsets ])))
+    self._write("trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.offsets) + 1, info, xref))
+    if hasattr(self.out, 'flush'): self.out.flush()
+
+def _paint(stroke, fill):
+  """Path painting operator. Non zero winding fill like reportlab."""
+  return {(0, 0): "n", (1, 0): "S", (0, 1): "f", (1, 1): "B"}[(stroke and 1, fill and 1)]
+
+def _filters(filters):
+  if not filters: return ""
+  return " /Filter [%s]" % (" ".join([ "/" + f for f in filters ]))
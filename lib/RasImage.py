@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Pictures for the {$PIC} command.
+
+canvas.drawImage decodes, compresses and ascii85 encodes an image again for every document.
+Logos on invoices are the same few files every time so ImageLoader keeps the finished pdf
+image streams instead:
+
+  JPEG files are used as they are.
+  Everything else is decoded once, scaled down to the size it is drawn at (see imagedpi in
+  xmmail.conf) and deflated. An alpha channel becomes a soft mask.
+
+Finished images are kept for the life of the process and in the image cache (RasCache) so
+other runs can use them. Each image is only written to a pdf once no matter how many pages
+it is on.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, math, zlib
+from cStringIO import StringIO
+from reportlab.lib.utils import Image as PILImage #None if PIL is not installed.
+import RasConfig, RasCache
+
+try:
+  from hashlib import sha1
+except ImportError: #Python 2.4
+  from sha import new as sha1
+
+FORMAT = 1 #Increase whenever the way images are encoded changes.
+
+_loaded = {} #(path, maxsize): (<RasCache.fileStamps>, <EncodedImage>) for every image used by this process.
+
+class EncodedImage:
+  """An image stream ready to be written to the pdf."""
+
+  def __init__(self, name, width, height, colorspace, filters, data, decode=None, smask=None):
+    self.name = name #Unique name of the XObject.
+    self.width = width #Pixels
+    self.height = height
+    self.colorspace = colorspace
+    self.filters = filters
+    self.data = data
+    self.decode = decode
+    self.smask = smask #EncodedImage holding the alpha channel.
+
+  def totuple(self):
+    """For storing with marshal. See fromtuple()"""
+    smask = self.smask
+    if smask is not None: smask = smask.totuple()
+    return (self.name, self.width, self.height, self.colorspace, self.filters, self.data, self.decode, smask)
+
+  def xobject(self):
+    """Returns the reportlab PDFImageXObject for this image."""
+    from reportlab.pdfbase import pdfdoc #Only loaded by jobs with pictures.
+    obj = pdfdoc.PDFImageXObject(self.name)
+    obj.width = self.width
+    obj.height = self.height
+    obj.bitsPerComponent = 8
+    obj.colorSpace = self.colorspace
+    obj._filters = self.filters
+    obj.streamContent = self.data
+    obj.mask = None
+    if self.decode: obj._decode = self.decode
+    return obj
+
+  def register(self, canvas):
+    """Add the image to the canvas's document if it is not there yet. Returns the name to use with Do."""
+    doc = canvas._doc
+    regname = doc.getXObjectName(self.name)
+    if regname not in doc.idToObject:
+      obj = self.xobject()
+      canvas._setXObjects(obj)
+      doc.Reference(obj, regname)
+      doc.addForm(self.name, obj)
+      if self.smask is not None:
+        mask = self.smask.xobject()
+        canvas._setXObjects(mask)
+        obj.smask = doc.Reference(mask, doc.getXObjectName(self.smask.name))
+    return regname
+
+  def drawOn(self, canvas, x, y, width=None, height=None):
+    """Same as canvas.drawImage(). The image is only added to the document the first time it is drawn."""
+    regname = self.register(canvas)
+    if width is None: width = self.width
+    if height is None: height = self.height
+    canvas._currentPageHasImages = 1
+    canvas.saveState()
+    canvas.translate(x, y)
+    canvas.scale(width, height)
+    canvas._code.append("/%s Do" % (regname))
+    canvas.restoreState()
+    canvas._formsinuse.append(self.name)
+
+def fromtuple(t):
+  """Recreate an EncodedImage from EncodedImage.totuple()"""
+  name, width, height, colorspace, filters, data, decode, smask = t
+  if smask is not None: smask = fromtuple(smask)
+  return EncodedImage(name, width, height, colorspace, tuple(filters), data, decode, smask)
+
+def _pixelData(im):
+  if hasattr(im, 'tobytes'): return im.tobytes() #tostring() is gone from newer versions of PIL.
+  return im.tostring()
+
+def encodeImage(path, name, maxsize=(None, None)):
+  """Returns an EncodedImage for the picture in path.
+     maxsize is the largest (width, height) in pixels worth keeping. Larger images are scaled down.
+     JPEG files are never changed.
+  """
+  from reportlab.pdfbase import pdfdoc, pdfutils
+  data = file(path, "rb").read()
+  if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg'):
+    try:
+      width, height, components = pdfutils.readJPEGInfo(StringIO(data))
+    except Exception: #Not really a jpeg. Let PIL try.
+      pass
+    else:
+      colorspace = {1: 'DeviceGray', 3: 'DeviceRGB'}.get(components, 'DeviceCMYK')
+      decode = None
+      if colorspace == 'DeviceCMYK': decode = [1, 0, 1, 0, 1, 0, 1, 0] #Same as reportlab. Adobe writes inverted CMYK.
+      return EncodedImage(name, width, height, colorspace, ('DCTDecode',), data, decode)
+
+  im = PILImage.open(StringIO(data))
+  alpha = None
+  if im.mode == 'P' and 'transparency' in im.info: im = im.convert('RGBA')
+  if im.mode in ('RGBA', 'LA'):
+    alpha = im.split()[-1]
+    im = im.convert(im.mode[:-1])
+  elif im.mode not in ('RGB', 'L', 'CMYK'):
+    im = im.convert('RGB')
+
+  width, height = im.size
+  mw, mh = maxsize
+  if mw and mw < width: width = mw
+  if mh and mh < height: height = mh
+  if (width, height) != im.size:
+    im = im.resize((width, height), PILImage.ANTIALIAS)
+    if alpha is not None: alpha = alpha.resize((width, height), PILImage.ANTIALIAS)
+
+  smask = None
+  if alpha is not None and alpha.getextrema() != (255, 255): #Fully opaque alpha channels are dropped.
+    smask = EncodedImage(name + "A", width, height, 'DeviceGray', ('FlateDecode',), zlib.compress(_pixelData(alpha)))
+  colorspace = pdfdoc._mode2CS[im.mode]
+  return EncodedImage(name, width, height, colorspace, ('FlateDecode',), zlib.compress(_pixelData(im)), smask=smask)
+
+def imageDPI():
+  """The imagedpi setting from xmmail.conf"""
+  if isinstance(RasConfig.xmmail, dict): return 300 #RasConfig.load() has not been called.
+  return float(RasConfig.get_default('global', 'imagedpi', '300'))
+
+def imageLoader():
+  """Returns an ImageLoader using the image cache and imagedpi from xmmail.conf"""
+  return ImageLoader(RasCache.imageCache(), imageDPI())
+
+class ImageLoader:
+  """Finds the EncodedImage for a picture, making it if needed."""
+
+  def __init__(self, cache=None, dpi=300):
+    """cache is an optional RasCache.ImageCache. Images are scaled down to dpi pixels per inch
+       at the size they are drawn. 0 means images are never scaled.
+    """
+    self.cache = cache
+    self.dpi = dpi
+
+  def _pixels(self, points):
+    """Most pixels needed to draw points wide at self.dpi"""
+    if not points or not self.dpi: return None
+    return int(math.ceil(abs(points) * self.dpi / 72.0))
+
+  def get(self, path, width=None, height=None):
+    """Returns the EncodedImage for path drawn at width x height points.
+       Returns None if the image can't be handled here and should go to canvas.drawImage().
+    """
+    maxsize = (self._pixels(width), self._pixels(height))
+    key = (path, maxsize)
+    entry = _loaded.get(key)
+    if entry is not None and RasCache.stampsValid(entry[0]):
+      return entry[1]
+
+    stamps = RasCache.fileStamps([path])
+    name = "RasImg" + sha1(repr((FORMAT, stamps, maxsize))).hexdigest()
+    image = None
+    if self.cache is not None:
+      t = self.cache.get(name)
+      if t is not None: image = fromtuple(t)
+    if image is None:
+      if PILImage is None and os.path.splitext(path)[1].lower() not in ('.jpg', '.jpeg'): return None
+      image = encodeImage(path, name, maxsize)
+      if self.cache is not None: self.cache.put(name, image.totuple())
+    _loaded[key] = (stamps, image)
+    return image
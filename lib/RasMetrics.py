@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Text width measurement for RascalPDF.
+
+reportlab's stringWidth looks up the font and maps the text onto the font encoding for every
+call. Rascal reports measure every fragment of every line so this adds up. WidthEngine gives
+exactly the same answers in three steps:
+
+  1. Recently measured strings are remembered. Column aligned reports repeat the same cells.
+  2. Monospaced fonts (Courier) measure plain ascii text as length * advance.
+  3. Everything else adds up a per font table of character advances built as characters are seen.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import re
+from reportlab.pdfbase import pdfmetrics
+
+try:
+  from _rl_accel import unicode2T1
+except ImportError:
+  from reportlab.pdfbase.pdfmetrics import unicode2T1
+
+_NOTPLAIN = re.compile(u"[^\x20-\x7e]") #Anything other than printable ascii.
+_PLAIN = [ unichr(c) for c in range(0x20, 0x7f) ]
+
+class WidthEngine:
+  """Memoised replacement for pdfmetrics.stringWidth.
+     Widths are added up and scaled in the same order as reportlab does so the results are identical.
+  """
+  def __init__(self, cachesize=5000):
+    self.cachesize = cachesize
+    self.recent = {} #(text, fontname, size): width
+    self.older = {} #The previous generation of recent. Entries found here are moved back to recent.
+    self.fonts = {} #fontname: (advance table, monospace advance or None)
+
+  def stringWidth(self, text, fontname, size):
+    """Width of text in points. Same as pdfmetrics.stringWidth(text, fontname, size)."""
+    key = (text, fontname, size)
+    try:
+      return self.recent[key]
+    except KeyError:
+      pass
+    width = self.older.get(key)
+    if width is None:
+      width = self._measure(text, fontname, size)
+    if len(self.recent) >= self.cachesize: #Drop everything that has not been used for a whole generation.
+      self.older = self.recent
+      self.recent = {}
+    self.recent[key] = width
+    return width
+
+  def _measure(self, text, fontname, size):
+    try:
+      table, mono = self.fonts[fontname]
+    except KeyError:
+      table, mono = self.fonts[fontname] = self._fontTable(fontname)
+    if not isinstance(text, unicode): text = text.decode('utf8')
+    if mono is not None and not _NOTPLAIN.search(text):
+      return len(text) * mono * 0.001 * size
+    try:
+      s = sum(map(table.__getitem__, text))
+    except KeyError:
+      for c in set(text).difference(table):
+        table[c] = self._advance(pdfmetrics.getFont(fontname), c)
+      s = sum(map(table.__getitem__, text))
+    return s * 0.001 * size
+
+  def _fontTable(self, fontname):
+    """Returns the advance table for the font starting with printable ascii and the
+       advance of every character if they are all the same.
+    """
+    font = pdfmetrics.getFont(fontname)
+    table = {}
+    for c in _PLAIN:
+      table[c] = self._advance(font, c)
+    mono = table[u" "]
+    if mono != int(mono): mono = None #n * advance is only the same as adding up n advances for whole numbers.
+    for w in table.itervalues():
+      if w != mono:
+        mono = None
+        break
+    return table, mono
+
+  def _advance(self, font, c):
+    """Width of one character in 1/1000ths of the font size"""
+    face = getattr(font, 'face', None)
+    if hasattr(face, 'charWidths'): #TrueType
+      return face.charWidths.get(ord(c), face.defaultWidth)
+    w = 0
+    for f, t in unicode2T1(c, [font] + font.substitutionFonts):
+      for b in t:
+        w += f.widths[ord(b)]
+    return w
+
+widths = WidthEngine() #Shared by all jobs in the process. Registered fonts never change.
+stringWidth = widths.stringWidth
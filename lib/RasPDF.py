@@ -15,12 +15,11 @@ __status__ = "Production"
 
 import logging
 import optparse
-import os, sys, time, tempfile, os.path
-import reportlab.lib.pagesizes
-import smtplib, string, random
-import socket
-from subprocess import *
-from cStringIO import StringIO
+import os, sys, time, os.path
+#Everything else is imported where it is used so small jobs don't pay for delivery modes they
+#don't use. See --startup-profile.
+
+log = logging.getLogger()
 
 def getVersion():
   """Returns the current version if we are running out of a git repository"""
@@ -48,11 +47,33 @@ def getVersion():
     raise
   return "RasPDF PDF library. Exported Source No version number."
 
+CONFIGDEFAULTS = {'readreceipt': 'False', 'xxpdf': 'True', 'noterraterm': 'True', 'zmodemterm': 'vt220, vt220a, vt320', 'secure': 'False' }
+RENDEROPTIONS = ('landscape', 'xxpdf', 'streaming', 'compiled', 'jobs', 'compression', 'nocache') #Options that change the pdf.
+
 def pwgen(pwlen=16):
+  import string, random
   l = len(string.ascii_letters) - 1
   return "".join([ string.ascii_letters[random.randint(0,l)] for i in xrange(pwlen) ])
 
 
+def render(options, inhandle, outhandle):
+  """Draw the report read from inhandle to outhandle. options holds the RENDEROPTIONS.
+     It is either the command line options or a dict of them from a render server client.
+  """
+  import RascalPDF, reportlab.lib.pagesizes
+  if isinstance(options, dict): options = optparse.Values(options)
+  if options.xxpdf: pagesize = (590, 890) # Use the old incorect page sizes from xxpdf.
+  else: pagesize = reportlab.lib.pagesizes.A4
+  log.debug("Page site is %s A4 is %s", pagesize, reportlab.lib.pagesizes.A4)
+
+  jobcache = None
+  if not options.nocache:
+    import RasCache
+    jobcache = RasCache.jobCache()
+
+  c = RascalPDF.PrintJob(output=outhandle, pagesize=pagesize, landscape=options.landscape, streaming=options.streaming, compiled=options.compiled, cache=jobcache, jobs=options.jobs)
+  c.feed(inhandle)
+
 def main():
   """Main harness. The actual work is all done in RascalPDF"""
 
@@ -67,6 +88,13 @@ def main():
   parser.add_option("-V", "--version", dest="version", action="store_true", help="Show running version")
   parser.add_option("--debug", dest="debug", action="store_true", default=False, help="Show debugging information")
   parser.add_option("--dsave", dest="debugsave", action="store_true", default=False, help="Debug save -- Save incoming command stream")
+  parser.add_option("--stream", dest="streaming", action="store_true", default=False, help="Draw each line as it is read instead of parsing the whole report first. Keeps memory use flat for very large reports.")
+  parser.add_option("--compiled", dest="compiled", action="store_true", default=False, help="Resolve all commands before drawing. Unknown commands are reported before any output is produced.")
+  parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="Draw large reports using this many processes.")
+  parser.add_option("--compression", dest="compression", type="choice", choices=["default", "fast", "small", "none"], help="How to compress the pdf: default, fast (quick previews), small (email and web, needs a PDF 1.5 reader) or none (printers). Overrides compression in the config file.")
+  parser.add_option("--server", dest="server", type="string", help="Draw the pdf with the render server listening on this socket. Overrides server in the config file. See server.py")
+  parser.add_option("--noserver", dest="noserver", action="store_true", default=False, help="Always draw the pdf in this process even if a render server is configured.")
+  parser.add_option("--nocache", dest="nocache", action="store_true", default=False, help="Do not use or update the finished pdf cache set up by cachedir in the config file.")
   parser.add_option("-f", "--outputfile", "--file", dest="outputfile", type="string", help="Send output to file with given name instead of a temp file.")
   parser.add_option("--tty", dest="tty", type="string", help="The running TTY to conenct to for zmodem")
   parser.add_option("-x", "--xxpdf", dest="xxpdf", action="store_true", help='Use xxpdf defaults including the broken A4 page size of 8.19" x 12.36" instead of 8.27" x 11.69"  ')
@@ -80,6 +108,7 @@ def main():
   parser.add_option("-m", "--message", dest="message", default="", help="Message body (If starts with a slash will be taken as filename for html body)")
   parser.add_option("--rr", "--readreceipt", dest="readreceipt", action="store_true", help="Request a read receipt on any outgoing email.")
   parser.add_option("-n", "--noattach",  dest="noattach", action="store_true", help="Do not attach any pdf report. (For using as a command line email program) ")
+  parser.add_option("--startup-profile", dest="startupprofile", action="store_true", default=False, help="When raspdf exits show how long each module took to import.")
   parser.add_option("--secure", dest="secure", action="store_true", help="Set flags preventing alteration and add a write password. **SNAKEOIL**")
 
   (options, args) = parser.parse_args()
@@ -96,7 +125,7 @@ def main():
   if options.debug:  log.setLevel(logging.DEBUG)
 
   import RasConfig
-  RasConfig.load(options.config, {'readreceipt': 'False', 'xxpdf': 'True', 'noterraterm': 'True', 'zmodemterm': 'vt220, vt220a, vt320', 'secure': 'False' } )
+  RasConfig.load(options.config, CONFIGDEFAULTS)
   if options.readreceipt is None:
     setattr(options,'readreceipt',RasConfig.getBool('global','readreceipt'))
   if options.xxpdf is None:
@@ -105,8 +134,7 @@ def main():
     setattr(options,'secure',RasConfig.getBool('global','secure'))
 
 
-  #Do the imports AFTER logging has been set up.
-  import RascalPDF, RasConfig 
+  #RascalPDF is only imported by render() when the pdf is drawn in this process, after logging has been set up.
 
   outfile = None
   if options.version:
@@ -118,32 +146,50 @@ def main():
 
   RasConfig.set('global','debug', options.debug)
   RasConfig.set('global','debugsave', options.debugsave)
+  if options.compression: RasConfig.set('global', 'compression', options.compression)
     
   if options.outputfile:
     outfile = options.outputfile
     outhandle = file(outfile,"w+")
   elif options.zmodem:
+    import tempfile
     tf = tempfile.NamedTemporaryFile(suffix='_auto.pdf' ) #Temporary file with the work auto in it to force auto starting in terraterm.
     outfile = tf.name
     log.debug("Temporary outfile: %s", outfile)
     outhandle = tf
   else:
-    outhandle = StringIO() #Store the file in memory for speed.
+    import tempfile
+    outhandle = tempfile.TemporaryFile() #Pages are written as they are finished so large reports don't have to fit in memory.
 
-  if options.xxpdf: pagesize = (590, 890) # Use the old incorect page sizes from xxpdf.
-  else: pagesize = reportlab.lib.pagesizes.A4
-  log.debug("Page site is %s A4 is %s", pagesize, reportlab.lib.pagesizes.A4)
+  if args: inhandle = file(args[0])
+  else: inhandle = sys.stdin
 
   start= time.time()
-  c = RascalPDF.PrintJob(output=outhandle, pagesize=pagesize, landscape=options.landscape)
-    
-  if args: c.feed(file(args[0]))
-  else: c.feed(sys.stdin)
+  socketpath = None
+  if not options.noserver: #As server.socketPath() but without importing server when there is none.
+    socketpath = options.server or RasConfig.get_default('global', 'server', None)
+  if socketpath:
+    import server
+    data = inhandle.read()
+    job = dict([ (k, getattr(options, k)) for k in RENDEROPTIONS ])
+    job['config'] = os.path.abspath(RasConfig.fileLocate(options.config))
+    job['cwd'] = os.path.abspath(os.curdir)
+    job.update(server.describe(data, options.evince or options.zmodem or options.printer))
+    pdf = server.request(socketpath, job, data)
+    if pdf is None: #Server is not running. Draw it here instead.
+      from cStringIO import StringIO
+      render(options, StringIO(data), outhandle)
+    else:
+      outhandle.write(pdf)
+      outhandle.flush()
+  else:
+    render(options, inhandle, outhandle)
 
   stop = time.time()
   log.info("Render time: %s seconds" % (stop - start))
 
   if options.secure:
+    import tempfile
     outhandle.flush()
     prepdf = tempfile.NamedTemporaryFile(suffix='presecure.pdf' ) #Temporary file with the work auto in it to force auto starting in terraterm.
     postpdf = tempfile.NamedTemporaryFile(suffix='postecure.pdf' ) #Temporary file with the work auto in it to force auto starting in terraterm.
@@ -161,6 +207,7 @@ def main():
     postpdf.close()
   
   if options.evince:
+    import shutil, tempfile
     if outfile is None:
       tf = tempfile.NamedTemporaryFile(suffix='.pdf' ) #Create a temporary file name. (WARNING THERE Is a risk of a race condition here )
       outfile = tf.name
@@ -168,7 +215,7 @@ def main():
       tf.close()
       f=file(outfile,"w")
       outhandle.seek(0)
-      f.write(outhandle.read())
+      shutil.copyfileobj(outhandle, f)
       f.flush()
       f.close()
       
@@ -179,7 +226,7 @@ def main():
 
 
   if options.web or (options.zmodem and RasConfig.getBool('global','noterraterm') and os.environ['TERM'] not in zmodemterms):
-    import shutil, pwd
+    import pwd, shutil
     uname = pwd.getpwuid(os.getuid())[0]
     dstdir = os.path.join(RasConfig.get('global','webdocs','/tmp'),uname)
     if not os.path.exists(dstdir): os.makedirs(dstdir,mode=0777)
@@ -209,11 +256,13 @@ def main():
       os.system(cmdstr)
 
   if options.printer or options.realprinter:
+    import shutil
+    from subprocess import Popen, PIPE
     printer = (options.realprinter, options.printer)[not options.realprinter] 
     pipe = Popen("lp -d %s -s " % (printer) , shell=True, stdin=PIPE).stdin
     outhandle.flush()
     outhandle.seek(0)
-    pipe.write(outhandle.read())
+    shutil.copyfileobj(outhandle, pipe)
     pipe.close()
 
   if options.to:
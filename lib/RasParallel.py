@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Draws a parsed print job on several processors at once.
+
+  1. The job is laid out once without drawing anything (RasCanvas.LayoutCanvas). This finds every
+     point where a new page starts, the RascalPDF state at that point and the order fonts and
+     pictures are first used in.
+  2. The pages are split into ranges and each range is drawn by a process from a
+     multiprocessing pool. Workers return their finished, compressed page streams.
+  3. The pages are added to the real document in order. Fonts and pictures are added to the
+     document at the same point as they would be when drawing normally so the names used in the
+     page streams match.
+
+Jobs using TrueType fonts or FORM are drawn normally. Font subsets and forms belong to one
+document and can't be shared between processes.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import logging
+from cStringIO import StringIO
+from reportlab.pdfbase import pdfmetrics
+import RascalPDF, RasWriter
+from RasCanvas import StateCanvas, LayoutCanvas
+
+log = logging.getLogger()
+
+MINCOMMANDS = 20000 #Smaller jobs are not worth starting processes for.
+MINPAGES = 4 #Least number of pages per range.
+
+_job = None #The _Job being drawn. Set before the pool is started so the workers inherit it.
+
+class _Job:
+  def __init__(self, program, pagesize, landscape, fonts, ranges, compression):
+    self.program = program
+    self.pagesize = pagesize
+    self.landscape = landscape
+    self.fonts = fonts #Font names in the order they are first used.
+    self.ranges = ranges #(first command, <RascalPDF.layoutState>, number of pages or None for the rest)
+    self.compression = compression #RasWriter.Compression for the page streams.
+
+class _PageCapture(StateCanvas):
+  """Keeps the finished page streams instead of leaving them in the document."""
+
+  def __init__(self, canvas, skipfirst, npages):
+    StateCanvas.__init__(self, canvas)
+    self.skipfirst = skipfirst #The first page belongs to the previous range.
+    self.npages = npages
+    self.pages = []
+
+  def showPage(self):
+    self.flush()
+    forms = list(self.canvas._formsinuse)
+    hasimages = self.canvas._currentPageHasImages
+    self.canvas.showPage()
+    self.reset()
+    if self.skipfirst:
+      self.skipfirst = False
+      return
+    content, filters = _job.compression.encode(self.canvas._doc.Pages.pages[-1].stream)
+    self.pages.append((content, filters, forms, hasimages))
+
+  def done(self):
+    """True once all the pages for the range have been drawn."""
+    return len(self.pages) == self.npages
+
+def _drawRange(n):
+  """Runs in a worker. Draws page range n of _job and returns the pages."""
+  start, state, npages = _job.ranges[n]
+  pdf = RascalPDF.RascalPDF(StringIO(), pagesize=_job.pagesize, isLandscape=_job.landscape)
+  pdf.writer = None #Nothing is saved.
+  for name in _job.fonts: #Same internal font names as the real document.
+    pdf.canvas._doc.getInternalFontName(name)
+  pdf.gstate = capture = _PageCapture(pdf.canvas, start > 0, npages)
+  if state is not None: pdf.setLayoutState(state)
+  for fncall, params, kwargs in _job.program.iterFrom(start):
+    pdf.fnexec(fncall, *params, **kwargs)
+    if capture.done(): return capture.pages
+  pdf.showPage()
+  return capture.pages
+
+def layout(program, pagesize, landscape):
+  """Lay out program without drawing it.
+     Returns the LayoutCanvas and a list of (command number, <RascalPDF.layoutState>, page number)
+     for every page the job could be split at.
+  """
+  pdf = RascalPDF.RascalPDF(StringIO(), pagesize=pagesize, isLandscape=landscape)
+  pdf.writer = None
+  pdf.gstate = lc = LayoutCanvas()
+  splits = []
+  candidate = None
+  pages = 0
+  for i, (fncall, params, kwargs) in enumerate(program):
+    pdf.fnexec(fncall, *params, **kwargs)
+    if lc.pages != pages:
+      #A page was finished. If it was the one asked for by an earlier command, the next range can
+      #start straight after that command. The first page it draws is then this one.
+      if candidate is not None: splits.append(candidate + (pages + 1,))
+      candidate = None
+      pages = lc.pages
+    if pdf.showPageNeeded and candidate is None:
+      candidate = (i + 1, pdf.layoutState())
+  pdf.showPage()
+  return lc, splits
+
+def _ranges(splits, totalpages, count):
+  """Choose count ranges of about the same number of pages. Returns (first command, state, pages)."""
+  ranges = []
+  start, state, first = 0, None, 0
+  for index, s, page in splits:
+    if page - first >= max(MINPAGES, (totalpages - first) / (count - len(ranges))):
+      ranges.append((start, state, page - first))
+      start, state, first = index, s, page
+      if len(ranges) == count - 1: break
+  ranges.append((start, state, None))
+  return ranges
+
+def processes(jobs):
+  """Number of processes to use when asked for jobs. Never more than there are processors."""
+  if jobs < 2: return jobs
+  import multiprocessing
+  return min(jobs, multiprocessing.cpu_count())
+
+def render(rascalpdf, program, jobs, pagesize, landscape):
+  """Draw program (a RasProgram.Program) on rascalpdf using jobs processes.
+     Returns False without drawing anything if the job should be drawn normally instead.
+  """
+  global _job
+  import multiprocessing
+  from reportlab.pdfbase.ttfonts import TTFont
+  jobs = processes(jobs)
+  if jobs < 2: return False #One processor. Laying the job out first would only make it slower.
+  if rascalpdf.canvas is None: return False #Not drawing with reportlab. See RasDirect.
+  if len(program) < MINCOMMANDS or 'FORM' in program.names: return False
+  lc, splits = layout(program, pagesize, landscape)
+  if lc.unsupported:
+    log.debug("Not drawing in parallel: %s", lc.unsupported)
+    return False
+  fonts = [ value for page, kind, value in lc.resources if kind == 'font' ]
+  for name in fonts:
+    if isinstance(pdfmetrics.getFont(name), TTFont):
+      log.debug("Not drawing in parallel: TrueType font %s", name)
+      return False
+
+  ranges = _ranges(splits, lc.pages, jobs * 2) #More ranges than workers to even out the load.
+  if len(ranges) < 2: return False
+  log.debug("Drawing %s pages in %s ranges with %s processes", lc.pages, len(ranges), jobs)
+  compression = getattr(rascalpdf.writer, 'compression', None) or RasWriter.Compression()
+  _job = _Job(program, pagesize, landscape, fonts, ranges, compression)
+  pool = multiprocessing.Pool(jobs)
+  try:
+    results = pool.map(_drawRange, range(len(ranges)), 1)
+  finally:
+    pool.close()
+    pool.join()
+    _job = None
+
+  canvas = rascalpdf.canvas
+  doc = canvas._doc
+  resources = {}
+  for page, kind, value in lc.resources:
+    resources.setdefault(page, []).append((kind, value))
+  pageno = 0
+  for pages in results:
+    for content, filters, forms, hasimages in pages:
+      for kind, value in resources.get(pageno, ()):
+        if kind == 'font':
+          doc.getInternalFontName(value)
+        else:
+          value.register(canvas)
+      canvas._formsinuse = forms
+      canvas._currentPageHasImages = hasimages
+      canvas.showPage()
+      doc.Pages.pages[-1].Contents = RasWriter.encodedStream(content, filters)
+      if rascalpdf.writer is not None: rascalpdf.writer.flush()
+      pageno += 1
+  return True
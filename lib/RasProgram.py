@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Compact storage for a parsed print job.
+
+A job is a long list of (<function name>, <tuple of args>, <dict of kw args>) commands.
+Stored as python lists every command costs several hundred bytes. Program stores the same
+commands in arrays instead:
+
+  ops    one byte per command. Index into names.
+  argc   one byte per command. Number of positional args.
+  kwc    one byte per command. Number of keyword args.
+  args   index into consts for every positional arg followed by a (name, value) pair for every kw arg.
+  consts shared table of every distinct string and number. Repeated text is only stored once.
+
+Programs can be converted to a string with dumps() and back with loads() for caching or
+sending to another process.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import sys, marshal
+from array import array
+from itertools import izip
+from RasConfig import RascalPDFException
+
+MAGIC = "RASPROG"
+FORMAT = 1 #Increase whenever the layout of dumps() changes.
+
+class RasProgramError(RascalPDFException):
+  """Thrown when a program can't be stored or loaded"""
+
+class Program:
+  """A print job stored as arrays. Behaves like a list of commands that can only be appended to."""
+
+  def __init__(self):
+    self.names = [] #Command names, the opcode is the position in this list.
+    self.consts = [] #Every distinct argument value.
+    self.ops = array('B')
+    self.argc = array('B')
+    self.kwc = array('B')
+    self.args = array('i')
+    self.linestarts = array('i') #Index of the first command of each input line. Only used for error messages.
+    self._reindex()
+
+  def _reindex(self):
+    """Rebuild the lookup dicts used while appending"""
+    self.nameindex = dict([ (n, i) for i, n in enumerate(self.names) ])
+    self.constindex = dict([ ((type(c), c), i) for i, c in enumerate(self.consts) ])
+
+  def _const(self, value):
+    """Return the position of value in consts, adding it if needed."""
+    key = (type(value), value) #1, 1.0 and u'1' must not share an entry.
+    try:
+      return self.constindex[key]
+    except KeyError:
+      i = self.constindex[key] = len(self.consts)
+      self.consts.append(value)
+      return i
+
+  def append(self, cmd):
+    """Add a (<function name>, <tuple of args>, <dict of kw args>) command"""
+    name, params, kwargs = cmd
+    try:
+      op = self.nameindex[name]
+    except KeyError:
+      op = self.nameindex[name] = len(self.names)
+      if op > 255: raise RasProgramError("Too many different commands in one job. %s is number %s" % (name, op))
+      self.names.append(name)
+    if len(params) > 255 or len(kwargs) > 255: raise RasProgramError("Too many parameters for %s" % (name))
+    self.ops.append(op)
+    self.argc.append(len(params))
+    self.kwc.append(len(kwargs))
+    const = self._const
+    for p in params:
+      self.args.append(const(p))
+    for k, v in kwargs.items():
+      self.args.append(const(k))
+      self.args.append(const(v))
+
+  def extend(self, cmds):
+    for cmd in cmds:
+      self.append(cmd)
+
+  def __len__(self):
+    return len(self.ops)
+
+  def __iter__(self):
+    """Yields each command as a (<function name>, <tuple of args>, <dict of kw args>) tuple"""
+    return self.iterFrom(0)
+
+  def iterFrom(self, start):
+    """As for __iter__ but starts at command number start."""
+    names = self.names
+    consts = self.consts
+    args = self.args
+    pos = 0
+    ops, argcs, kwcs = self.ops, self.argc, self.kwc
+    if start:
+      pos = sum(argcs[:start]) + 2 * sum(kwcs[:start])
+      ops, argcs, kwcs = ops[start:], argcs[start:], kwcs[start:]
+    for op, argc, kwc in izip(ops, argcs, kwcs):
+      if argc:
+        params = tuple([ consts[a] for a in args[pos:pos + argc] ])
+        pos += argc
+      else:
+        params = ()
+      kwargs = {}
+      if kwc:
+        for i in xrange(pos, pos + 2 * kwc, 2):
+          kwargs[consts[args[i]]] = consts[args[i + 1]]
+        pos += 2 * kwc
+      yield (names[op], params, kwargs)
+
+  def argsOf(self, name):
+    """Yields the (<tuple of args>, <dict of kw args>) of every command called name."""
+    op = self.nameindex.get(name)
+    if op is None: return
+    consts = self.consts
+    args = self.args
+    pos = 0
+    for o, argc, kwc in izip(self.ops, self.argc, self.kwc):
+      if o == op:
+        params = tuple([ consts[a] for a in args[pos:pos + argc] ])
+        kwargs = {}
+        for i in xrange(pos + argc, pos + argc + 2 * kwc, 2):
+          kwargs[consts[args[i]]] = consts[args[i + 1]]
+        yield params, kwargs
+      pos += argc + 2 * kwc
+
+  def dumps(self):
+    """Returns the program as a string. See loads()"""
+    return MAGIC + marshal.dumps((FORMAT, sys.byteorder, self.names, self.consts, self.ops.tostring(),
+      self.argc.tostring(), self.kwc.tostring(), self.args.tostring(), self.linestarts.tostring()))
+
+def loads(data):
+  """Recreate a Program from a string returned by Program.dumps()"""
+  if not data.startswith(MAGIC):
+    raise RasProgramError("Not a stored program")
+  try:
+    fmt, byteorder, names, consts, ops, argc, kwc, args, linestarts = marshal.loads(data[len(MAGIC):])
+  except (ValueError, EOFError, TypeError), e:
+    raise RasProgramError("Corrupt stored program: %s" % (e))
+  if fmt != FORMAT:
+    raise RasProgramError("Stored program is format %s. Expected %s" % (fmt, FORMAT))
+  p = Program()
+  p.names = names
+  p.consts = consts
+  p.ops.fromstring(ops)
+  p.argc.fromstring(argc)
+  p.kwc.fromstring(kwc)
+  p.args.fromstring(args)
+  p.linestarts.fromstring(linestarts)
+  if byteorder != sys.byteorder:
+    p.args.byteswap()
+    p.linestarts.byteswap()
+  p._reindex()
+  return p
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Times the imports made while raspdf starts up. Used by --startup-profile.
+
+raspdf.dist.py calls start() before it imports RasPDF when --startup-profile is on the command
+line, so everything raspdf imports is timed. When raspdf exits the imports are printed to stderr
+as a tree with the time each took with and without the modules it imported in turn.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import sys, time, atexit, __builtin__
+
+SHOW = 0.001 #Imports quicker than this many seconds are left out of the report.
+
+_import = __builtin__.__import__
+started = None
+imports = [] #[module, depth, seconds, own seconds] in the order the imports started.
+_children = [] #Seconds spent in nested imports for each import in progress.
+
+def _timedImport(name, globals=None, locals=None, fromlist=None, level=-1):
+  if name in sys.modules and not fromlist: return _import(name, globals, locals, fromlist, level)
+  if fromlist: label = "from %s import %s" % (name, ", ".join(fromlist)) #May load submodules.
+  else: label = name
+  entry = [label, len(_children), 0.0, 0.0]
+  imports.append(entry)
+  _children.append(0.0)
+  start = time.time()
+  try:
+    return _import(name, globals, locals, fromlist, level)
+  finally:
+    entry[2] = time.time() - start
+    entry[3] = entry[2] - _children.pop()
+    if _children: _children[-1] += entry[2]
+
+def start(begin=None):
+  """Start timing imports. begin is when the program started if earlier than now."""
+  global started
+  if started is not None: return
+  started = begin or time.time()
+  __builtin__.__import__ = _timedImport
+  atexit.register(report)
+
+def report(out=None):
+  """Print the imports made since start()."""
+  out = out or sys.stderr
+  total = sum([ i[2] for i in imports if i[1] == 0 ])
+  out.write("Startup profile: %.3fs since start, %.3fs in %d imports\n" % (time.time() - started, total, len(imports)))
+  out.write("%7s %7s  %s\n" % ("total", "own", "module"))
+  for name, depth, seconds, own in imports:
+    if seconds >= SHOW: out.write("%7.3f %7.3f  %s%s\n" % (seconds, own, "  " * depth, name))
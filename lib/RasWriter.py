@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Writes a reportlab document to its file a page at a time.
+
+canvas.save() formats every object of the document at the end and returns it as one string so the
+whole pdf is in memory at least twice before anything is written. IncrementalWriter instead writes
+each finished page, its content stream and any new fonts and pictures to the file as soon as the
+page is done. The page streams are then dropped so memory use does not grow with the page count.
+
+Objects that can still change until the document is finished (the catalog, page tree, info,
+outlines and font dictionary) are written at the end followed by the xref and trailer.
+
+How page streams are compressed is set by the compression option in xmmail.conf or
+raspdf --compression. See PROFILES. Pictures are always deflated (see RasImage).
+
+[global]
+;default, fast, small or none
+compression = default
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import zlib, struct
+from reportlab import rl_config
+try: #pdfdoc is slow to import and not needed by jobs drawn with RasDirect.
+  from reportlab.lib.rl_accel import asciiBase85Encode
+except ImportError: #reportlab 2
+  from reportlab.pdfbase.pdfutils import _AsciiBase85Encode as asciiBase85Encode
+import RasConfig
+from RasConfig import RascalPDFException
+
+#name: (zlib level or None for no compression, ascii85 encode, PDF 1.5 object streams)
+PROFILES = {
+  'default': (-1, True, False), #The same as reportlab. ascii85 only if rl_config.useA85 is set.
+  'fast': (1, False, False), #Quickest to make. For previews.
+  'small': (9, False, True), #Smallest file, for email and webdocs. Needs a PDF 1.5 reader.
+  'none': (None, False, False), #Nothing to decompress. For sending straight to a printer.
+}
+
+OBJSTMSIZE = 200 #Most objects to put in one object stream.
+
+def compression():
+  """Returns the Compression for the compression option in xmmail.conf"""
+  if isinstance(RasConfig.xmmail, dict): return Compression() #RasConfig.load() has not been called.
+  return Compression(RasConfig.get_default('global', 'compression', 'default'))
+
+class Compression:
+  """One of the PROFILES"""
+
+  def __init__(self, name='default'):
+    try:
+      self.level, self.ascii85, self.objectstreams = PROFILES[name]
+    except KeyError:
+      raise RascalPDFException("Unknown compression profile %s. Use one of %s" % (name, ", ".join(sorted(PROFILES))))
+    self.name = name
+    self.ascii85 = self.ascii85 and rl_config.useA85
+
+  def encode(self, data):
+    """Returns the encoded data and the list of filter names needed to decode it."""
+    filters = []
+    if self.level is not None:
+      data = zlib.compress(data, self.level)
+      filters.insert(0, 'FlateDecode')
+    if self.ascii85:
+      data = asciiBase85Encode(data)
+      filters.insert(0, 'ASCII85Decode')
+    return data, filters
+
+def encodedStream(data, filters):
+  """Returns the PDFStream for a page stream already encoded by Compression.encode."""
+  from reportlab.pdfbase import pdfdoc
+  stream = pdfdoc.PDFStream(content=data)
+  stream.dictionary["Filter"] = pdfdoc.PDFArray(map(pdfdoc.PDFName, filters)) #Also stops reportlab adding its own.
+  stream.__Comment__ = "page stream"
+  return stream
+
+class _Written:
+  """Takes the place in the document of objects IncrementalWriter wrote itself."""
+  __PDFObject__ = True
+
+class IncrementalWriter:
+  """Writes the document of a reportlab canvas to out. Call flush() after every showPage and
+     close() instead of canvas.save().
+     compression is a Compression. Defaults to Compression('default')
+  """
+
+  def __init__(self, canvas, out, compression=None):
+    self.canvas = canvas
+    self.doc = canvas._doc
+    self.out = out
+    self.compression = compression or Compression()
+    self.offset = None #Bytes written so far. None until the header is written.
+    self.counter = 0 #Highest object number looked at.
+    self.held = [] #Names of objects left for close()
+    self.pageindex = 0 #Pages before this in doc.Pages.pages have been written.
+    self.batch = [] #(name, formatted object) waiting to go into the next object stream.
+    self.instream = {} #name: (object stream number, index) of objects in object streams.
+    if self.compression.objectstreams:
+      self.doc._pdfVersion = max(self.doc._pdfVersion, (1, 5))
+
+  def _write(self, data):
+    if self.offset is None: #Left as late as possible in case the pdf version is raised.
+      from reportlab.pdfbase import pdfdoc
+      header = pdfdoc.PDFFile(self.doc._pdfVersion).format(self.doc) #A new PDFFile only holds the header.
+      self.out.write(header)
+      self.offset = len(header)
+    self.out.write(data)
+    self.offset += len(data)
+
+  def _writeObject(self, name):
+    from reportlab.pdfbase import pdfdoc
+    doc = self.doc
+    obj = doc.idToObject[name]
+    if isinstance(obj, pdfdoc.PDFPage) and not obj.Contents and obj.stream:
+      obj.Contents = encodedStream(*self.compression.encode(obj.stream))
+    if self.compression.objectstreams and not isinstance(obj, (pdfdoc.PDFStream, pdfdoc.PDFImageXObject, pdfdoc.PDFFormXObject)):
+      self.batch.append((name, pdfdoc.format(obj, doc, toplevel=1)))
+      if len(self.batch) >= OBJSTMSIZE: self._writeBatch()
+    else:
+      data = pdfdoc.PDFIndirectObject(name, obj).format(doc)
+      self._write("") #Header first so the offset is right.
+      doc.idToOffset[name] = self.offset
+      self._write(data)
+    if isinstance(obj, (pdfdoc.PDFPage, pdfdoc.PDFStream)): #Nothing looks at a written page again. Keep only a reference.
+      ref = pdfdoc.PDFObjectReference(name)
+      doc.idToObject[name] = ref
+      pages = doc.Pages.pages
+      while self.pageindex < len(pages) and pages[self.pageindex] is obj:
+        pages[self.pageindex] = ref
+        self.pageindex += 1
+
+  def _writeBatch(self):
+    """Write the batched objects as one object stream."""
+    if not self.batch: return
+    doc = self.doc
+    ids = doc.idToObjectNumberAndVersion
+    stmname = "ObjStm%d" % (len(doc.numberToId) + 1)
+    doc.Reference(_Written(), stmname)
+    stmnum = ids[stmname][0]
+    index = []
+    pos = 0
+    for i, (name, data) in enumerate(self.batch):
+      index.append("%d %d" % (ids[name][0], pos))
+      pos += len(data) + 1
+      self.instream[name] = (stmnum, i)
+    first = " ".join(index) + "\n"
+    data = zlib.compress(first + "\n".join([ data for name, data in self.batch ]), self.compression.level)
+    self._write("")
+    doc.idToOffset[stmname] = self.offset
+    self._write("%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream\nendobj\n"
+      % (stmnum, len(self.batch), len(first), len(data), data))
+    self.batch = []
+
+  def _mutable(self):
+    """The objects that may still change."""
+    from reportlab.pdfbase import pdfdoc
+    doc = self.doc
+    return [ id(o) for o in (doc.Catalog, doc.Pages, doc.info, doc.Outlines, doc.idToObject.get(pdfdoc.BasicFonts)) ]
+
+  def flush(self):
+    """Write every object registered so far that can't change any more."""
+    doc = self.doc
+    mutable = self._mutable()
+    numbertoid = doc.numberToId
+    while self.counter + 1 in numbertoid: #Formatting an object can register new ones.
+      self.counter += 1
+      name = numbertoid[self.counter]
+      obj = doc.idToObject[name]
+      if isinstance(obj, _Written): continue
+      if id(obj) in mutable:
+        self.held.append(name)
+      else:
+        self._writeObject(name)
+
+  def close(self):
+    """Finish the document. Same as canvas.save()"""
+    canvas = self.canvas
+    doc = self.doc
+    if len(canvas._code): canvas.showPage()
+    self.flush()
+    #Same as PDFDocument.GetPDFData
+    for fnt in doc.delayedFonts:
+      fnt.addObjects(doc)
+    doc.info.invariant = doc.invariant
+    doc.info.digest(doc.signature)
+    cat = doc.Reference(doc.Catalog)
+    info = doc.Reference(doc.info)
+    doc.Outlines.prepare(doc, canvas)
+    if getattr(doc.Outlines, 'ready', 0) < 0: doc.Catalog.Outlines = None
+
+    for name in self.held:
+      self._writeObject(name)
+    numbertoid = doc.numberToId
+    while self.counter + 1 in numbertoid:
+      self.counter += 1
+      name = numbertoid[self.counter]
+      if not isinstance(doc.idToObject[name], _Written): self._writeObject(name)
+    self._writeBatch()
+
+    if self.compression.objectstreams:
+      self._xrefStream(cat, info)
+    else:
+      self._xrefTable(cat, info)
+    if hasattr(self.out, 'flush'): self.out.flush()
+
+  def _xrefTable(self, cat, info):
+    from reportlab.pdfbase import pdfdoc
+    doc = self.doc
+    xref = pdfdoc.PDFCrossReferenceTable()
+    xref.addsection(0, [ doc.numberToId[n] for n in range(1, self.counter + 1) ])
+    xrefoffset = self.offset
+    self._write(xref.format(doc))
+    trailer = pdfdoc.PDFTrailer(startxref=xrefoffset, Size=self.counter + 1, Root=cat, Info=info, ID=doc.ID())
+    self._write(trailer.format(doc))
+
+  def _xrefStream(self, cat, info):
+    """PDF 1.5 cross reference stream. Needed to find objects in object streams."""
+    doc = self.doc
+    numbertoid = doc.numberToId
+    xrefnum = len(numbertoid) + 1 #The last object stream was registered after self.counter.
+    entries = [ struct.pack(">BIH", 0, 0, 65535) ]
+    for n in range(1, xrefnum):
+      name = numbertoid[n]
+      if name in self.instream:
+        entries.append(struct.pack(">BIH", 2, *self.instream[name]))
+      else:
+        entries.append(struct.pack(">BIH", 1, doc.idToOffset[name], 0))
+    entries.append(struct.pack(">BIH", 1, self.offset, 0)) #The xref stream itself.
+    data = zlib.compress("".join(entries), self.compression.level)
+    xrefoffset = self.offset
+    self._write("%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root %s /Info %s /ID %s /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream\nendobj\n"
+      % (xrefnum, xrefnum + 1, cat.format(doc), info.format(doc), doc.ID(), len(data), data))
+    self._write("startxref\n%d\n%%%%EOF\n" % (xrefoffset))
@@ -26,9 +26,7 @@ __copyright__ = "Ed Pascoe 2011. All rights reserved."
 __license__ = "GNU LGPL version 2"
 __status__ = "Production"
 
-from reportlab.pdfgen import canvas
 import reportlab.lib.pagesizes
-from reportlab.platypus.flowables import Image
 from reportlab.lib.units import inch
 from Point import Point, FontTracker
 import logging
@@ -36,16 +34,21 @@ cm = inch / 2.54
 
 log = logging.getLogger()
 
-import re, os, os.path, sys, tempfile
+import re, os, os.path, sys, tempfile, bisect, stat, mmap
 from copy import copy, deepcopy
-from reportlab.pdfbase.pdfmetrics import stringWidth
 from RasConfig import fileLocate, RascalPDFException
+import RasConfig, RasCache, RasImage, RasParallel, RasWriter, RasDirect
+from RasProgram import Program
+from RasCanvas import StateCanvas
+from RasMetrics import stringWidth
 
 cnstNORMAL = 0
 cnstBOLD = 1
 cnstITALIC = 2
 
 _ISYAMLTEMPLATE = 99 #Internal use only.
+_CONTROLCHARS = chr(0x0f) + chr(0x1b) + chr(0x12) # ^O, ^[ Escape and ^R are removed from all input.
+_READSIZE = 1024 * 1024 #Input is decoded in blocks of about this size.
 
 class RascalPDFException(Exception):
   """Errors thrown by the PDF system"""
@@ -63,25 +66,40 @@ class RascalPDF:
 
   reporttitle = "Rascal Report";
 
-  def  __init__(self, pdffile, pagesize=reportlab.lib.pagesizes.A4, isLandscape=False):
+  def  __init__(self, pdffile, pagesize=reportlab.lib.pagesizes.A4, isLandscape=False, backend='reportlab'):
+    """backend is reportlab or direct. direct can only draw some jobs. See RasDirect.canDraw"""
     self.pdffile = pdffile
     if isLandscape:
       pagesize = reportlab.lib.pagesizes.landscape(pagesize)
     else:
       pagesize = reportlab.lib.pagesizes.portrait(pagesize)
 
-    self.canvas = canvas.Canvas(self.pdffile, pagesize, verbosity=0)
-    self.canvas.setPageCompression(True)
+    self.writer = None
+    if backend == 'direct':
+      self.gstate = RasDirect.DirectCanvas(pdffile, pagesize, RasWriter.compression())
+      self.info = self.gstate.info
+    else:
+      from reportlab.pdfgen import canvas #Slow to import and not needed by the direct backend.
+      self.canvas = canvas.Canvas(self.pdffile, pagesize, verbosity=0)
+      self.canvas.setPageCompression(True)
+      if not isinstance(pdffile, basestring): #Pages are written as they are finished. See RasWriter.
+        self.writer = RasWriter.IncrementalWriter(self.canvas, pdffile, RasWriter.compression())
+      self.gstate = StateCanvas(self.canvas) #All drawing goes through here. See RasCanvas.
+      self.info = self.canvas._doc.info #The PDF document info
+    self.images = RasImage.imageLoader()
 
-    self.info = self.canvas._doc.info #The PDF document info
     self.pagesize = pagesize
 
     self.pos = Point(x=self.lmargin, y=self.pagesize[1] - self.tmargin)
-    self.font = FontTracker(fileLocator=fileLocate)
+    self.font = FontTracker(fileLocator=fileLocate, fontCache=RasCache.fontCache())
 
     self.boxlist = {} # for drawing boxes
     self.linelist = {} # for drawing lines
 
+    self.forms = {} #(path, <_formState>) -> (form name, <_formState> at the end of the block)
+    self.formstack = () #Paths of the FORM blocks being recorded.
+    self.formparser = None #_Parser used to load FORM blocks.
+
     self.start_newpage = 1;
     self.printingBegun = False
     self.showPageNeeded = False #Next output command should do a show page
@@ -119,8 +137,57 @@ class RascalPDF:
       log.error("Failure executing %s(%s) Command stack line number: %s Params: %s KWargs: %s" , fnname, params, self.linenumber, params, kwargs)
       raise
 
+  def compile(self, cmdlist, lineOf=None):
+    """Check that every command name in cmdlist has a function.
+       All unknown commands are reported together before anything is drawn.
+       Returns a generator of (function, args, kwargs) tuples for run(). Commands are only bound as
+       run() reaches them so nothing the size of the job is built.
+       lineOf if given is called with the command index to get the source line for error messages.
+    """
+    functions = self.functions
+    if isinstance(cmdlist, Program) and not [ n for n in cmdlist.names if n not in functions ]:
+      return self._bind(cmdlist) #Every distinct name is known. No need to look at each command.
+    unknown = [ (name, i) for i, (name, params, kwargs) in enumerate(cmdlist) if name not in functions ]
+    if unknown:
+      if lineOf is None: lineOf = lambda i: "command %s" % (i)
+      raise RascalPDFException("Unknown command(s): %s" % (", ".join([ "%s (line %s)" % (name, lineOf(i)) for name, i in unknown ])))
+    return self._bind(cmdlist)
+
+  def _bind(self, cmdlist):
+    """Generator. Yields each command in cmdlist with its name replaced by its function."""
+    functions = self.functions
+    for fnname, params, kwargs in cmdlist:
+      yield functions[fnname], params, kwargs
+
+  def run(self, program, lineOf=None):
+    """Execute a program returned by compile."""
+    index, cmd = -1, None
+    try:
+      for index, cmd in enumerate(program):
+        cmd[0](*cmd[1], **cmd[2])
+        cmd = None
+    except Exception:
+      if lineOf is None: lineOf = lambda i: "command %s" % (i)
+      if cmd is None: #The program failed before giving us the next command.
+        log.exception("Failure getting command number: %s Line: %s", index + 1, lineOf(index + 1))
+        raise
+      log.error("Failure executing %s Command number: %s Params: %s KWargs: %s Line: %s" , cmd[0].__name__, index, cmd[1], cmd[2], lineOf(index))
+      raise
+
   def save(self):
-    self.canvas.save()
+    if self.canvas is None:
+      self.gstate.save()
+    elif self.writer is not None:
+      self.writer.close()
+    else:
+      self.canvas.save()
+
+  def showPage(self):
+    """Finish the current page."""
+    if self.formstack:
+      raise RascalPDFException("FORM %s does not fit on one page" % (self.formstack[-1]))
+    self.gstate.showPage()
+    if self.writer is not None: self.writer.flush()
 
   def _regfnFontSetBoldTrue(self):
     """For registerkeys, set bold on"""
@@ -170,13 +237,13 @@ class RascalPDF:
 
   def stripQuotes(self, msg):
     """Removes and quotes surrounding given string"""
-    if msg[0] == '"' and msg[-1] == '"': #Filename has quotes around it which need to be removed.
+    if len(msg) > 1 and msg[0] == '"' and msg[-1] == '"': #Filename has quotes around it which need to be removed.
       msg = msg[1:-1]
     return msg
 
   def _regfnFontSetColor(self, r, g, b):
     """For registerkeys, set font color"""
-    self.canvas.setFillColorRGB(float(r), float(g), float(b))
+    self.gstate.setFillColorRGB(float(r), float(g), float(b))
 
   def _regfnCopiesSet(self, numcopies):
     """For registerkeys, set number of copies"""
@@ -233,6 +300,7 @@ class RascalPDF:
     self.functions["SHOWLINE"] = self.output
 
     self.functions["PIC"] = self.picture
+    self.functions["FORM"] = self.form
 
     self.functions["UP"] = self.up
     self.functions["DOWN"] = self.down
@@ -287,8 +355,8 @@ class RascalPDF:
 
   def moveabsolute(self, x=None, y=None):
     """Move to given spot on page. x and y in cm"""
-    if x: self.pos.x = float(x) * cm;
-    if y: self.pos.y = self.pagesize[1] - float(y) * cm;
+    if x is not None: self.pos.x = float(x) * cm;
+    if y is not None: self.pos.y = self.pagesize[1] - float(y) * cm;
 
   def printinit(self):
     """Initialize printing system"""
@@ -324,7 +392,7 @@ class RascalPDF:
       return
     s = self.boxlist[boxname]
     e = self.pos
-    self.canvas.rect(s.x, e.y, (e.x - s.x), (s.y - e.y), stroke=1, fill=0)
+    self.gstate.rect(s.x, e.y, (e.x - s.x), (s.y - e.y), stroke=1, fill=0)
 
     log.debug("box end Position: %s", e)
 
@@ -337,7 +405,7 @@ class RascalPDF:
     e = self.pos
     log.debug("boxendround end box from %s to %s", s, e)
     u = inch / 10.0
-    self.canvas.roundRect(s.x, e.y, (e.x - s.x), (s.y - e.y), 1.5 * u, stroke=1, fill=0)
+    self.gstate.roundRect(s.x, e.y, (e.x - s.x), (s.y - e.y), 1.5 * u, stroke=1, fill=0)
     return
 
   def linestart(self, linename=0):  #Remember the posistion of the start of a line.
@@ -347,18 +415,10 @@ class RascalPDF:
     self.showPageIfNeeded()
     s = self.linelist.get(linename, None)
     if s is None: return
-    x1 = s.x
-    y1 = s.y
-    x2 = self.pos.x
-    y2 = self.pos.y
-
-    path = self.canvas.beginPath()
-    path.moveTo(x1, y1);
-    path.lineTo(x2, y2);
-    self.canvas.drawPath(path, stroke=1, fill=1)
+    self.gstate.line(s.x, s.y, self.pos.x, self.pos.y)
 
   def linewidth(self, width):
-    self.canvas.setLineWidth(width)
+    self.gstate.setLineWidth(width)
 
   def output(self, line):
     if len(line) == 0: return
@@ -410,7 +470,7 @@ class RascalPDF:
     """
     if self.showPageNeeded:
       self.showPageNeeded = False
-      self.canvas.showPage()
+      self.showPage()
     else:
       self.printingBegun = True
 
@@ -443,10 +503,9 @@ height of the paragraph can be calculated as lineSpacing*len(lines)
     """Prints string on page at current cursor location."""
     self.showPageIfNeeded()
 
-    textobject = self.canvas.beginText()
-    self.canvas.setFont(self.font.getFontName(), self.font.size)
+    self.gstate.setFont(self.font.getFontName(), self.font.size)
     log.debug(" self.canvas.drawText%s, %s)", self.pos, msg)
-    self.canvas.drawString(self.pos.x, self.pos.y, msg)
+    self.gstate.drawString(self.pos.x, self.pos.y, msg)
 
   def picture(self, fname, imgwidth=None, imgheight=None):
     """Insert picture into pdf. If imgwidth and imgheight are not none they will be used to reposition the cursor after the insert."""
@@ -460,7 +519,79 @@ height of the paragraph can be calculated as lineSpacing*len(lines)
       y = y - imgheight
 
     fname = fileLocate(fname)
-    self.canvas.drawImage(fname, x, y, imgwidth, imgheight)
+    image = self.images.get(fname, imgwidth, imgheight)
+    if image is None: image = fname #No PIL. Let reportlab deal with it.
+    self.gstate.drawImage(image, x, y, imgwidth, imgheight)
+
+  def form(self, name):
+    """Draw include file name like INCLUDE does but as a PDF Form XObject.
+       The block is only drawn the first time it is used with a given starting position, font etc.
+       After that the form is placed on the page with a single Do and the state is set to what
+       the block left it at. Use for headers and other blocks that are the same on every page.
+    """
+    self.showPageIfNeeded()
+    path = fileLocate(name)
+    if path in self.formstack:
+      raise RascalPDFException("FORM loop: %s" % (" -> ".join(self.formstack + (path,))))
+    key = (path, self._formState())
+    entry = self.forms.get(key)
+    if entry is None:
+      if self.formparser is None: self.formparser = _Parser(diskcache=RasCache.programCache())
+      block = self.formparser.includeBlock(name)
+      formname = "RasForm%d" % (len(self.forms))
+      log.debug("Recording FORM %s as %s", path, formname)
+      self.gstate.beginForm(formname)
+      self.formstack += (path,)
+      try:
+        for fncall, params, kwargs in block:
+          self.fnexec(fncall, *params, **kwargs)
+        if self.showPageNeeded: self.showPage() #NEWPAGE inside the block.
+      finally:
+        self.formstack = self.formstack[:-1]
+      entry = self.forms[key] = (formname, self._formState(), self.gstate.endForm())
+    formname, state, gstate = entry
+    self.gstate.doForm(formname, *gstate)
+    self._setFormState(state)
+
+  def _formState(self):
+    """Everything that changes what a FORM block draws or that the block can change."""
+    f = self.font
+    points = lambda d: tuple([ (k, p.x, p.y) for k, p in sorted(d.items()) ])
+    return (self.pos.x, self.pos.y, tuple(self.pos.saved), self.lmargin, self.lmarginDefault,
+      f.fontname, f.bold, f.italic, f.size, self.gstate.fillcolor, self.gstate.linewidth,
+      points(self.boxlist), points(self.linelist))
+
+  def _setFormState(self, state):
+    """Undo _formState"""
+    x, y, saved, self.lmargin, self.lmarginDefault, fontname, bold, italic, size, fillcolor, linewidth, boxes, lines = state
+    self.pos.x, self.pos.y = x, y #Not Point(x, y) which would round to whole points.
+    self.pos.saved = list(saved)
+    self.font.set(fontname=fontname, bold=bold, italic=italic, size=size)
+    self.boxlist = {}
+    for k, px, py in boxes:
+      p = self.boxlist[k] = Point()
+      p.x, p.y = px, py
+    self.linelist = {}
+    for k, px, py in lines:
+      p = self.linelist[k] = Point()
+      p.x, p.y = px, py
+
+  def layoutState(self):
+    """Returns everything needed to carry on from this point in another RascalPDF. See setLayoutState.
+       The graphics state is not included. It is always the default at the start of a page.
+    """
+    f = self.font
+    return (deepcopy(self.pos), self.lmargin, self.lmarginDefault, (f.fontname, f.bold, f.italic, f.size),
+      deepcopy(self.boxlist), deepcopy(self.linelist), self.start_newpage, self.printingBegun, self.showPageNeeded,
+      self.linenumber, getattr(self, 'numcopies', None))
+
+  def setLayoutState(self, state):
+    """Undo layoutState"""
+    (self.pos, self.lmargin, self.lmarginDefault, font, self.boxlist, self.linelist, self.start_newpage,
+      self.printingBegun, self.showPageNeeded, self.linenumber, numcopies) = deepcopy(state)
+    fontname, bold, italic, size = font
+    self.font.set(fontname=fontname, bold=bold, italic=italic, size=size)
+    if numcopies is not None: self.numcopies = numcopies
 
   def __toInt(self, value):
     """make sure value is either None or an integer"""
@@ -468,64 +599,192 @@ height of the paragraph can be calculated as lineSpacing*len(lines)
     if value is None: return value
     return int(float(value))
 
+_includeCache = {} #Parsed include files shared by all parsers. See _Parser._loadInclude.
+
 class _Parser:
   """Contains the print job broken into an array of python function calls.
+    Each entry is a tuple: (<function name>, <tuple of args>, <dict of kw args>)
+    cmdlist is a RasProgram.Program which stores the commands compactly.
+    Parameters of the commands in numeric that are numbers become int or float when parsed. Any other
+    parameter is passed as written, as is the text for SHOWLINE. Quotes are only removed from kw args.
     Usage:  p = _Parser()
             for line in file("Blah"): p.parseLine(line)
             print "Function calls: ", print p.cmdlist
   """
-  def __init__(self):
-    self.cmdlist = []
+  tagre = re.compile(r'{\$(.*?)}') #A single {$COMMAND(params)} tag.
+  paramendre = re.compile(r'\s*\)\s*$') #Closing bracket of the parameter list.
+  intre = re.compile(r'^[-+]?\d+$')
+  floatre = re.compile(r'^[-+]?(\d+\.\d*|\.\d+)$')
+  numeric = frozenset(['UP', 'DOWN', 'RIGHT', 'LMARGIN', 'MA', 'MR', 'SF', 'SETFONT', 'LINEWIDTH', 'LW', 'SETCOLOR', 'COPIES', 'PIC',
+                       'BOXS', 'BOXE', 'RBOXS', 'RBOXE', 'LINES', 'L1', 'LINEE', 'L0']) #Commands that take numbers.
+
+  def __init__(self, diskcache=None, including=()):
+    """diskcache is an optional RasCache.ProgramCache for keeping parsed include files between runs.
+       including lists the include files being parsed by the parent parsers.
+    """
+    self.cmdlist = Program()
+    self.linestarts = self.cmdlist.linestarts #Index in cmdlist of the first command of each input line. Only used for error messages.
+    self.diskcache = diskcache
+    self.including = including
+    self.includes = {} #Include name -> (<Program>, <list of files used>, <names located>) for includes already used in this job.
+    self.depends = set() #Every include file used, including nested ones.
+    self.located = {} #Include name: path for every include used, including nested ones.
+
+  def sourceLine(self, index):
+    """Return the input line number (1 based) that created cmdlist[index]. 0 is before the first line."""
+    return bisect.bisect_right(self.linestarts, index)
 
   def parseLine(self, line):
+    """Split line into text and commands. The line is scanned once, left to right."""
     if len(line) == 0: return  #Blank line
     hasnewline = line[-1] == "\n"
     line = line.rstrip()
-    r = re.search(r'^(.*?){\$(.*?)}(.*)$', line)
-    if r:
-      leadtext = r.group(1)
-      cmd = r.group(2)
-      restofline = r.group(3)
-      self.cmdlist.append(("printstring", u'line="' + leadtext + '"'))
-      self.addCommand(cmd)
-      self.parseLine(restofline)
-    else:
-      self.cmdlist.append(("printstring", u'line="' + line + '"'))
+    pos = 0
+    for r in self.tagre.finditer(line):
+      self.cmdlist.append(("printstring", (line[pos:r.start()],), {}))
+      self.addCommand(r.group(1))
+      pos = r.end()
+    if pos == 0 or pos < len(line): #Text after the last tag. A line without tags is always printed, even if empty.
+      self.cmdlist.append(("printstring", (line[pos:],), {}))
 
     if hasnewline:
-      self.cmdlist.append(("newline",))
+      self.cmdlist.append(("newline", (), {}))
+
+  def commands(self, lines):
+    """Generator. Parses lines one at a time and yields the resulting commands straight away.
+       cmdlist only ever holds the commands for the line currently being parsed.
+    """
+    for line in lines:
+      self.cmdlist = []
+      self.parseLine(line)
+      for cmd in self.cmdlist:
+        yield cmd
+    self.cmdlist = []
 
   def addCommand(self, command):
     command = command.strip()
-    cmdname = None
-    cmdparams = []
     p = command.find("(") #Find the start of any parameters
     if p == -1: #No parameters
-      return self.cmdlist.append([command.strip(), ])
+      return self.cmdlist.append((command, (), {}))
     cmdname = command[:p]
     params = command[p + 1:]
-    params = re.sub(r'\s*\)\s*$', '', params)
+    params = self.paramendre.sub('', params)
     params = [ x.strip() for x in params.split(",") if len(x.strip()) > 0]
     if cmdname == "INCLUDE":
-      includefile = list(params)[0]
-      includefile = fileLocate(includefile)
-      log.debug("Including %s", includefile)
-      for line in file(includefile):
-        self.parseLine(line)
+      self.addInclude(params[0])
     else:
-      return self.cmdlist.append([ cmdname, ] + list(params))
+      args, kwargs = self.splitParams(params, cmdname in self.numeric)
+      return self.cmdlist.append((cmdname, args, kwargs))
+
+  def addInclude(self, name):
+    """Add the commands from include file name to cmdlist."""
+    self.cmdlist.extend(self.includeBlock(name))
+
+  def includeBlock(self, name):
+    """Returns the Program for include file name.
+       Each include file is only located and checked once per job and only parsed again if it has changed.
+    """
+    if name not in self.includes:
+      path = fileLocate(name)
+      if path in self.including:
+        raise RascalPDFException("INCLUDE loop: %s" % (" -> ".join(self.including + (path,))))
+      block, depends, located = self._loadInclude(path)
+      located = dict(located)
+      located[name] = path
+      self.includes[name] = block, depends, located
+    block, depends, located = self.includes[name]
+    self.depends.update(depends)
+    self.located.update(located)
+    RasConfig.locatedFiles.update(depends) #Nested includes from the cache were never located.
+    RasConfig.locatedNames.update(located)
+    log.debug("Including %s", name)
+    return block
+
+  def _loadInclude(self, path):
+    """Returns (<Program>, <list of files used>, <list of (name, path) of nested includes>) for include file path.
+       Uses the cached version if none of the files have changed and the nested include names still find the same files.
+       Cache entries are (<RasCache.fileStamps>, <(name, path) list>, <Program>) keyed by the path, current directory
+       and search path as nested names can find other files elsewhere.
+    """
+    key = (path, os.getcwd(), tuple(RasConfig.searchLocations))
+    entry = _includeCache.get(key)
+    if entry is None and self.diskcache is not None:
+      entry = self.diskcache.get(key)
+    if entry is not None and RasCache.stampsValid(entry[0]) and RasCache.namesValid(entry[1]):
+      _includeCache[key] = entry
+      return entry[2], [ s[0] for s in entry[0] ], entry[1]
+
+    log.debug("Parsing include file %s", path)
+    sub = _Parser(self.diskcache, self.including + (path,))
+    for line in file(path):
+      sub.parseLine(line)
+    depends = [path] + list(sub.depends)
+    entry = _includeCache[key] = (RasCache.fileStamps(depends), sub.located.items(), sub.cmdlist)
+    if self.diskcache is not None:
+      self.diskcache.put(key, entry[0], entry[1], sub.cmdlist)
+    return sub.cmdlist, depends, entry[1]
+
+  def splitParams(self, params, numeric=False):
+    """For converting the xxpdf format parameters to arguments. 
+       Converts params to a a tuple: (<tuple of non kw args>, <dict of kw args>)
+       If numeric is True parameters that are numbers are converted to int or float.
+    """
+    args = []
+    kw = {}
+    for p in params:
+      k = None
+      equalpos = p.find("=")
+      #Be really sure this is not string we are mistaking for a named argument. A space in the keyword part means it is not.
+      if equalpos > 0 and p[0] != '"' and p[0] != "'" and p[:equalpos].find(" ") == -1:
+        k = str(p[:equalpos])
+        p = self.stripQuotes(p[equalpos + 1:].strip())
+      if numeric: p = self.convertParam(p)
+      if k is None:
+        args.append(p)
+      else:
+        kw[k] = p
+    return (tuple(args), kw)
+
+  def convertParam(self, value):
+    """Convert a single parameter to an int or float if it is a number."""
+    if self.intre.match(value): return int(value)
+    if self.floatre.match(value): return float(value)
+    return value
+
+  def stripQuotes(self, value):
+    """value without any quotations around the entire string."""
+    if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+      return value[1:-1]
+    return value
+
 class PrintJob:
   """Controls the output and setup of a print job. """
   rascalpdf = None
   parser = None
+  commands = None
   output = None
   landscape = False
+  streaming = False
+  compiled = False
+  cache = None
+  jobs = 1
 
-  def __init__(self, output=None, pagesize=reportlab.lib.pagesizes.A4, landscape=False):
+  def __init__(self, output=None, pagesize=reportlab.lib.pagesizes.A4, landscape=False, streaming=False, compiled=False, cache=None, jobs=1):
     """ fhandle should be a file like object. 
+        If streaming is True each input line is parsed and drawn as it is read instead of
+        parsing the whole document before drawing starts. Memory use then stays flat for very large reports.
+        If compiled is True every command is resolved to its function before anything is drawn. 
+        Unknown commands are then reported up front. Ignored when streaming.
+        cache if given is a RasCache.JobCache. Input that has been printed before is then copied from the cache
+        instead of being parsed and drawn again.
+        jobs is the number of processes to draw large reports with. See RasParallel. Ignored when streaming.
     """
     self.pagesize = pagesize
     self.landscape = landscape
+    self.streaming = streaming
+    self.compiled = compiled
+    self.cache = cache
+    self.jobs = jobs
 
     if output:
       if isinstance(output, basestring): #String means its a filename
@@ -545,6 +804,68 @@ class PrintJob:
     """Feed data to the pdf job. Retuns the result code of the parsing action.(Currently always true) """
     if not self.pdffile:
       self.pdffile = tempfile.NamedTemporaryFile(suffix='_auto.pdf') #Temporary file with the work auto in it to force auto starting in terraterm.
+    if self.cache is not None:
+      return self._cachedFeed(fhandle)
+    return self._feed(fhandle)
+
+  def _cachedFeed(self, fhandle):
+    """As for feed but first checks the job cache. Yaml templates are never cached because they can contain live data.
+       Neither the input nor the pdf are ever held in memory as a whole.
+    """
+    import shutil
+    digest, fhandle = self._hashInput(fhandle)
+    start = fhandle.tell()
+    first = fhandle.readline()
+    fhandle.seek(start)
+    if first.find("YMLTEMPLATE") > -1:
+      return self._feed(fhandle)
+
+    key = self.cache.key(digest, tuple(self.pagesize), self.landscape, RasImage.imageDPI(), RasWriter.compression().name)
+    pdf = self.cache.get(key)
+    if pdf is not None:
+      try:
+        shutil.copyfileobj(pdf, self.pdffile, _READSIZE)
+      finally:
+        pdf.close()
+      self.pdffile.flush()
+      return True
+
+    RasConfig.locatedFiles.clear()
+    RasConfig.locatedNames.clear()
+    try:
+      start = self.pdffile.tell()
+    except (AttributeError, IOError): #Output can't be read back. Eg a pipe.
+      return self._feed(fhandle)
+    result = self._feed(fhandle)
+    self.pdffile.seek(start)
+    self.cache.put(key, self.pdffile, RasConfig.locatedFiles, RasConfig.locatedNames)
+    return result
+
+  def _hashInput(self, fhandle):
+    """Returns (<hex sha1 of the rest of fhandle>, <file to read the same input from>).
+       fhandle is read _READSIZE bytes at a time. Input that can't be read twice (eg a pipe)
+       is copied to a temporary file as it is hashed.
+    """
+    h = RasCache.sha1()
+    try:
+      start = fhandle.tell()
+      fhandle.seek(start)
+      spool = None
+    except (AttributeError, IOError):
+      spool = tempfile.TemporaryFile()
+    while True:
+      block = fhandle.read(_READSIZE)
+      if not block: break
+      h.update(block)
+      if spool is not None: spool.write(block)
+    if spool is None:
+      fhandle.seek(start)
+      return h.hexdigest(), fhandle
+    spool.seek(0)
+    return h.hexdigest(), spool
+
+  def _feed(self, fhandle):
+    """Parse and draw everything in fhandle."""
     result = self._1stParse(fhandle)
     if result == _ISYAMLTEMPLATE:
       import YamlTemplate  #Import as late as possible to reduce dependency issues if rest of system is not installed.
@@ -553,95 +874,152 @@ class PrintJob:
       except YamlTemplate.YamlTemplateError, e:
         raise RascalPDFException(e)
     else:
-      self.rascalpdf = RascalPDF(self.pdffile, pagesize=self.pagesize, isLandscape=self.landscape)
+      self.rascalpdf = RascalPDF(self.pdffile, pagesize=self.pagesize, isLandscape=self.landscape, backend=self._backend())
 
       self.rascalpdf.info.producer = "Raspdf by Ed Pascoe <ed@pascoe.co.za>"
       self.rascalpdf.info.tile = "Rascal document"
       self.rascalpdf.info.subject = "Rascal document"
 
       self._2ndParse()
-      self.rascalpdf.canvas.save()
+      self.rascalpdf.save()
       self.pdffile.flush()
     return True
 
+  def _backend(self):
+    """RascalPDF backend for the parsed job. Large jobs being drawn in parallel stay with reportlab."""
+    if self.streaming: return 'reportlab' #Nothing has been parsed yet.
+    if len(self.commands) >= RasParallel.MINCOMMANDS and RasParallel.processes(self.jobs) > 1: return 'reportlab'
+    if RasDirect.canDraw(self.commands, RasWriter.compression()): return 'direct'
+    return 'reportlab'
+
   def _1stParse(self, fhandle):
-    """Converts the incoming document into a series of functions to be executed"""
+    """Converts the incoming document into a series of functions to be executed.
+       When streaming self.commands is a generator and nothing is parsed until _2ndParse asks for it.
+    """
     self.parser = None
+    self.commands = None
     line = fhandle.readline()
 
     if line.find("YMLTEMPLATE") > -1:
       return _ISYAMLTEMPLATE
 
-    self.parser = _Parser()
-    self.parser.addCommand('PRINTINIT')
-    while len(line) > 0 :
-      # -------- Strip any control characters -----------
-      line = line.replace(chr(0x0f), '') # ^O
-      line = line.replace(chr(0x1b), '') # ^[ Escape
-      line = line.replace(chr(0x12), '') # ^R
-      try: line = line.decode("utf-8")
-      except UnicodeDecodeError: #Drop any non-readable characters.
-        line = line.decode("utf-8", "replace") #Convert to unicode. Leaving out any characters that would cause issues.
-        line = line.replace(u'\ufffd', '') #Remove the unicode unknown character from the text.
+    self.parser = _Parser(diskcache=RasCache.programCache())
+    if self.streaming:
+      self.commands = self._streamCommands(line, fhandle)
+      return True
 
+    self.parser.addCommand('PRINTINIT')
+    for line in self._readLines(line, fhandle):
       # convert the line into function calls for 2nd parse later.
+      self.parser.linestarts.append(len(self.parser.cmdlist))
       self.parser.parseLine(line)
-      line = fhandle.readline() #Get the next line.
     self.parser.addCommand('PRINTEND')
-    lineno = 0
-    for cmd in self.parser.cmdlist:
-      log.debug("Cmd: %s Line: %s", cmd, lineno)
-      lineno += 1
+    self.commands = self.parser.cmdlist
+    if log.isEnabledFor(logging.DEBUG):
+      lineno = 0
+      for cmd in self.parser.cmdlist:
+        log.debug("Cmd: %s Line: %s", cmd, lineno)
+        lineno += 1
     return True
 
+  def _streamCommands(self, line, fhandle):
+    """Generator. Yields the commands for the whole document as the input is read."""
+    self.parser.addCommand('PRINTINIT')
+    for cmd in self.parser.cmdlist: yield cmd
+    for cmd in self.parser.commands(self._readLines(line, fhandle)): yield cmd
+    self.parser.addCommand('PRINTEND')
+    for cmd in self.parser.cmdlist: yield cmd
+
+  def _readLines(self, line, fhandle):
+    """Generator. Yields each input line decoded to unicode with any control characters removed.
+       line is the first line, already read from fhandle.
+       The rest of the input is cleaned and decoded a block at a time. See _readBlocks.
+    """
+    for block in self._readBlocks(line, fhandle):
+      # -------- Strip any control characters -----------
+      block = block.translate(None, _CONTROLCHARS)
+      try: text = block.decode("ascii") #Most reports are plain ascii, which is the quickest to decode.
+      except UnicodeDecodeError:
+        try: text = block.decode("utf-8")
+        except UnicodeDecodeError: #Drop any non-readable characters. Done per line so that only the bad lines are affected.
+          text = u"\n".join([ self._decodeBadLine(l) for l in block.split("\n") ])
+      lines = text.split(u"\n") #Not splitlines() which would also split on form feeds.
+      last = lines.pop()
+      for l in lines:
+        yield l + u"\n"
+      if last:
+        yield last
+
+  def _decodeBadLine(self, line):
+    """Decode a line that is not valid utf-8."""
+    try: return line.decode("utf-8")
+    except UnicodeDecodeError:
+      line = line.decode("utf-8", "replace") #Convert to unicode. Leaving out any characters that would cause issues.
+      return line.replace(u'\ufffd', '') #Remove the unicode unknown character from the text.
+
+  def _readBlocks(self, line, fhandle):
+    """Generator. Yields line and then the rest of fhandle in large blocks that each end with a newline.
+       Regular files are mmapped, anything else is read _READSIZE bytes at a time.
+    """
+    yield line
+    if len(line) == 0: return
+    mm = None
+    try:
+      st = os.fstat(fhandle.fileno())
+      if stat.S_ISREG(st.st_mode) and st.st_size > fhandle.tell():
+        mm = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, EnvironmentError): #Not a real file. Eg StringIO or a pipe.
+      mm = None
+
+    if mm is not None:
+      try:
+        pos = fhandle.tell()
+        size = len(mm)
+        while pos < size:
+          end = mm.rfind("\n", pos, pos + _READSIZE) + 1
+          if end <= pos: #No newline in this block. Take everything up to the next one.
+            end = mm.find("\n", pos) + 1 or size
+          yield mm[pos:end]
+          pos = end
+      finally:
+        mm.close()
+      return
+
+    rest = ""
+    while True:
+      data = fhandle.read(_READSIZE)
+      if not data: break
+      data = rest + data
+      end = data.rfind("\n") + 1
+      rest = data[end:]
+      if end > 0: yield data[:end]
+    if rest: yield rest
+
   def _2ndParse(self):
     """Generate the actual print job."""
-    fncall = None
-    partams = None
+    if self.jobs > 1 and not self.streaming:
+      if RasParallel.render(self.rascalpdf, self.commands, self.jobs, self.pagesize, self.landscape): return
+    if self.compiled and not self.streaming:
+      program = self.rascalpdf.compile(self.commands, lineOf=self.parser.sourceLine)
+      self.rascalpdf.run(program, lineOf=self.parser.sourceLine)
+      log.debug("_2ndParse showPage")
+      self.rascalpdf.showPage()
+      return
+
     lineno = 0
-    for cmd in  self.parser.cmdlist:
+    for cmd in self.commands:
       try:
-        fncall = cmd[0]
-        if len(cmd) > 1:
-          params, kwargs = self.__args2kw(cmd[1:])
-          try: self.rascalpdf.fnexec(fncall, *params, **kwargs)
-          except TypeError:
-            print "Failed to call fnexec(%s, %s, %s)" % (fncall, params, kwargs)
-            raise
-        else:
-          self.rascalpdf.fnexec(fncall)
+        fncall, params, kwargs = cmd
+        try: self.rascalpdf.fnexec(fncall, *params, **kwargs)
+        except TypeError:
+          print "Failed to call fnexec(%s, %s, %s)" % (fncall, params, kwargs)
+          raise
         lineno += 1
       except:
         log.error("Failure on command %s line %s", cmd, lineno)
         raise
     log.debug("_2ndParse showPage")
-    self.rascalpdf.canvas.showPage()
-
-  def __args2kw(self, params):
-    """For converting the xxpdf format parameters to arguments. 
-       Converts params to a a tuple: (<array of non kw args>, <dict of kw args>)
-    """
-    args = []
-    kw = {}
-    for p in params:
-      p = str(p)
-      equalpos = p.find("=")
-      if equalpos == -1 or p[0] == "=" or p[0] == '"' or p[0] == "'": #Be really sure this is not string we are mistaking for a named argument.
-        args.append(p)
-      else:
-        k = p[:equalpos]
-        if k.find(" ") > -1: #A space in the keyword part of the name means this is NOT a named argument
-          args.append(p)
-          continue
-        else:
-          v = p[equalpos + 1:].strip()
-          if v[0] == '"' and v[-1] == '"': #Chop off any quotations around the entire string.
-            v = v[1:-1]
-          elif v[0] == "'" and v[-1] == "'": #Chop off any quotations around the entire string.
-            v = v[1:-1]
-
-          kw[k.strip()] = v
-    return (args, kw)
+    self.rascalpdf.showPage()
 
 if __name__ == "__main__":
   #Enable logging
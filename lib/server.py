@@ -1,78 +1,743 @@
-import socket
-from multiprocessing import Process, Queue
-import multiprocessing
-import cPickle as pickle
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Render server for raspdf.
 
-QMAX=5
-CHILDREN=5
+Starting raspdf means starting python, importing reportlab and loading the config and fonts
+before anything is drawn. For one page invoices that is most of the run time. The server does
+all of that once in a set of preforked worker processes which then draw jobs sent to them over
+a Unix domain socket. raspdf uses the server when server is set in xmmail.conf (or with
+--server) and draws the job itself if the server is not running.
 
-q=Queue(QMAX)
+  python server.py -C /etc/xmmail.conf
 
-def qhandle():
+[global]
+;Socket the render server listens on.
+server = /tmp/raspdf.sock
+;Number of worker processes.
+serverworkers = 5
+;Jobs that can wait for a worker. Clients are told to retry later once it is full.
+serverqueue = 50
+;Seconds a client retries a busy server before drawing the pdf itself.
+serverwait = 60
+;Workers kept free of big batch jobs so small and interactive jobs don't wait behind them.
+serverreserve = 1
+;Idle workers kept on top of serverworkers so a replaced worker is never missed.
+serverspares = 1
+;Replace a worker after this many jobs or once it uses this many megabytes. 0 for never.
+servermaxjobs = 1000
+servermaxrss = 500
+
+The parent only accepts connections and reads each client's JOB. Queued jobs are handed to
+idle workers together with the client's connection and the worker reads the spool file straight
+from the client.
+
+Jobs are only drawn for the user the server runs as (SO_PEERCRED). A job names its directory
+and the include files, pictures and fonts to read, so drawing it for anyone else would let them
+read whatever the server's user can. Other users are sent REFUSED and draw the pdf themselves.
+
+Every message in either direction is a header line "<KIND> <length>\\n" followed by length
+bytes of data. A client sends
+
+  JOB   marshalled dict of the raspdf options that change the pdf (see RasPDF.render) and
+        the job's size (see describe)
+
+and gets back one of
+
+  SEND     a worker has taken the job. The client sends DATA (the spool file) and then
+           gets back PDF or ERROR.
+  BUSY     the queue is full. The data is the number of seconds to wait before trying again.
+  REFUSED  the server can't draw this job (eg the client uses another config file or is
+           another user). The client should draw it itself. Also sent after DATA if the
+           server could not read the job's directory or one of its files.
+  PDF      the finished pdf
+  ERROR    the job failed. The data is the error message.
+
+A client can send STATUS instead of JOB to get back a STATUS listing each worker's job count
+and why the most recent ones were replaced (python server.py --status).
+
+Delivery (email, zmodem, lp etc) is always done by the client.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, socket, select, marshal, errno, signal, time, traceback, heapq, math, resource, struct
+import logging
+from collections import deque
+try:
+  from _multiprocessing import sendfd, recvfd
+except ImportError: #No SCM_RIGHTS support. Server.start() refuses to run.
+  sendfd = recvfd = None
+import RasConfig
+from RasConfig import RascalPDFException
+
+log = logging.getLogger()
+
+SOCKET = '/tmp/raspdf.sock'
+WORKERS = 5
+QUEUE = 50 #Jobs waiting for a worker before clients are told to retry later.
+WAIT = 60 #Seconds a client keeps retrying a busy server before drawing the pdf itself.
+MAXHEADER = 64 #Longest header line.
+MAXJOB = 65536 #Longest JOB message.
+TIMEOUT = 600 #Seconds a client waits for its pdf.
+JOBTIMEOUT = 10 #Seconds the server waits for a new connection to send its JOB.
+READY = "R" #Sent by a worker to the parent when it can take another connection.
+RESERVE = 1 #Workers kept free of big batch jobs for small and interactive ones.
+SPARES = 1 #Idle workers kept on top of the workers count so a replaced worker is never missed.
+MAXJOBS = 1000 #Jobs a worker draws before it is replaced. Fonts and images pile up in long lived workers.
+MAXRSS = 500 #Megabytes a worker may grow to before it is replaced.
+RECENT = 20 #Exited workers listed by STATUS.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17) #Linux. Missing from python 2's socket module.
+
+#Exit status of a worker that has been replaced and why.
+EXITJOBS = 3
+EXITMEMORY = 4
+CAUSES = {0: "stopped", 1: "failed", EXITJOBS: "jobs", EXITMEMORY: "memory"}
+
+#Estimated cost of a job in seconds. Rough figures from timing text reports of 1 to 160000 lines.
+JOBSECONDS = 0.02
+LINESECONDS = 0.00005
+BYTESECONDS = 0.0000006
+TEMPLATESECONDS = 0.5 #YAML templates are slow to load.
+BIGJOB = 5.0 #Jobs estimated to take longer are big batch jobs.
+INTERACTIVE = 5.0 #Someone is waiting for it. Queued as if it had already waited this long.
+AGEING = 1.0 #Seconds of estimated cost forgiven per second waited. Big jobs are never starved.
+
+class ServerError(RascalPDFException):
+  """Thrown on protocol errors"""
+
+def socketPath():
+  """The socket given by server in xmmail.conf or None if the server is not to be used."""
+  if isinstance(RasConfig.xmmail, dict): return None #RasConfig.load() has not been called.
+  return RasConfig.get_default('global', 'server', None) or None
+
+def serverWait():
+  """Seconds to keep retrying a busy server. serverwait in xmmail.conf."""
+  if isinstance(RasConfig.xmmail, dict): return WAIT
+  return float(RasConfig.get_default('global', 'serverwait', WAIT))
+
+def describe(data, interactive):
+  """Entries for a JOB that let the server estimate how long the job will take (see cost).
+     interactive is true if someone is waiting for the pdf (evince, zmodem or a printer).
+  """
+  end = data.find("\n")
+  if end < 0: end = len(data)
+  return {'size': len(data), 'lines': data.count("\n"), 'interactive': bool(interactive),
+    'template': data.find("YMLTEMPLATE", 0, end) > -1 } #Same test as PrintJob._1stParse.
+
+def cost(options):
+  """Estimated seconds to draw a job from the entries added by describe()."""
+  try:
+    seconds = JOBSECONDS + int(options.get('lines', 0)) * LINESECONDS + int(options.get('size', 0)) * BYTESECONDS
+  except (TypeError, ValueError):
+    return JOBSECONDS
+  if options.get('template'): seconds += TEMPLATESECONDS
+  return seconds
+
+def rss():
+  """Megabytes of memory used by this process. The peak where there is no /proc."""
+  try:
+    return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize() / 1048576.0
+  except (IOError, IndexError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 #Kilobytes on Linux.
+
+def warm():
+  """Builds the width tables used to measure text. Done in the parent so new workers start with them."""
+  import RasMetrics
+  from Point import fonts
+  for names in fonts.values():
+    for name in names: RasMetrics.stringWidth(u" ", name, 10)
+
+def peerUid(conn):
+  """uid of the process at the other end of Unix socket conn or None if it can't be found out."""
+  try:
+    pid, uid, gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i")))
+  except (socket.error, struct.error):
+    return None
+  return uid
+
+def sendMessage(sock, kind, data=""):
+  sock.sendall("%s %d\n" % (kind, len(data)))
+  if data: sock.sendall(data)
+
+def recvMessage(f):
+  """Read one message from f (a file made with sock.makefile). Returns (kind, data)."""
+  header = f.readline(MAXHEADER)
+  if not header: raise EOFError("Connection closed")
+  kind, length = parseHeader(header)
+  data = f.read(length)
+  if len(data) != length: raise EOFError("Connection closed part way through a message")
+  return kind, data
+
+def parseHeader(header):
+  """(kind, length) from a message header line."""
+  try:
+    kind, length = header.split()
+    return kind, int(length)
+  except ValueError:
+    raise ServerError("Bad message header %r" % (header))
+
+def request(path, options, data, wait=None):
+  """Ask the server on socket path to draw spool data with options (a dict).
+     Returns the pdf or None if the server is not running or won't draw the job.
+     A busy server is retried for up to wait seconds (default serverWait()).
+  """
+  if wait is None: wait = serverWait()
+  deadline = time.time() + wait
   while True:
-    logger = logging.getLogger("Qhandle")
-    msg = q.get()
-    connection, address = pickle.loads(msg)
-    handle(connection, address)
+    reply = _request(path, options, data)
+    if reply is None: return None
+    kind, reply = reply
+    if kind != "BUSY": break
+    try:
+      delay = float(reply)
+    except ValueError:
+      raise ServerError("Bad BUSY reply %r from render server" % (reply))
+    if time.time() + delay > deadline:
+      log.info("Render server %s is busy", path)
+      return None
+    log.debug("Render server %s is busy. Retrying in %ss", path, delay)
+    time.sleep(delay)
+  if kind == "PDF": return reply
+  if kind == "REFUSED":
+    log.info("Render server refused the job: %s", reply)
+    return None
+  if kind == "ERROR": raise RascalPDFException("Render server: %s" % (reply))
+  raise ServerError("Unexpected reply %s from render server" % (kind))
+
+def status(path):
+  """The STATUS report of the server listening on socket path."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+    sock.settimeout(TIMEOUT)
+    sendMessage(sock, "STATUS")
+    kind, reply = recvMessage(sock.makefile('rb'))
+  finally:
+    sock.close()
+  if kind != "STATUS": raise ServerError("Unexpected reply %s from render server" % (kind))
+  return reply
+
+def _request(path, options, data):
+  """One attempt at request(). Returns the server's (kind, reply) or None if it could not be reached."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(path)
+    except socket.error, e:
+      log.debug("Render server %s not available: %s", path, e)
+      return None
+    sock.settimeout(TIMEOUT)
+    try:
+      f = sock.makefile('rb')
+      sendMessage(sock, "JOB", marshal.dumps(options))
+      kind, reply = recvMessage(f) #The data is only sent once a worker has taken the job.
+      if kind != "SEND": return kind, reply
+      sendMessage(sock, "DATA", data)
+      sock.shutdown(socket.SHUT_WR)
+      return recvMessage(f)
+    except (socket.error, EOFError), e:
+      log.warning("Render server %s failed: %s", path, e)
+      return None
+  finally:
+    sock.close()
+
+class Worker:
+  """Draws jobs in a process that has already imported and set up everything needed."""
+
+  def __init__(self, config):
+    self.config = config #Full path of the config file.
+    self.stamps = None
+    self.jobs = 0
+    self._load()
+    import RasPDF
+    self.raspdf = RasPDF
+    warm()
+
+  def _load(self):
+    import RasCache, RasPDF
+    RasConfig.load(self.config, RasPDF.CONFIGDEFAULTS)
+    self.stamps = RasCache.fileStamps([self.config])
+    self.compression = RasConfig.get_default('global', 'compression', 'default')
+
+  def handle(self, conn, options):
+    """Draw the job described by options (the client's JOB) and reply on socket conn.
+       Nothing the client or the job does ends the worker.
+    """
+    conn.settimeout(TIMEOUT)
+    RasConfig.locatedFiles.clear() #Only this job's files. See RasConfig.fileLocate.
+    RasConfig.locatedNames.clear()
+    if options.get('config') != self.config:
+      return self._reply(conn, "REFUSED", "Server uses %s not %s" % (self.config, options.get('config')))
+    try:
+      sendMessage(conn, "SEND")
+      kind, data = recvMessage(conn.makefile('rb'))
+      if kind != "DATA": raise ServerError("Expected DATA not %s" % (kind))
+    except (ServerError, EOFError, socket.error), e:
+      log.warning("Bad request: %s", e)
+      return
+    try:
+      reply = self.render(options, data)
+    except (EnvironmentError, RasConfig.RasConfigError), e: #Eg a file under a home directory only the client can read.
+      log.warning("Job handed back to the client: %s", e)
+      self._reply(conn, "REFUSED", "%s: %s" % (e.__class__.__name__, e))
+    except SystemExit, e: #Eg POPPOS with nothing saved.
+      log.error("Job exited with status %s", e.code)
+      self._reply(conn, "ERROR", "Job exited with status %s" % (e.code))
+    except Exception, e:
+      log.error("Job failed: %s", traceback.format_exc())
+      self._reply(conn, "ERROR", "%s: %s" % (e.__class__.__name__, e))
+    else:
+      self._reply(conn, "PDF", reply)
+
+  def _reply(self, conn, kind, data):
+    """Send the client its reply unless it has gone away."""
+    try:
+      sendMessage(conn, kind, data)
+    except socket.error, e:
+      log.warning("Could not send %s to client: %s", kind, e)
+
+  def render(self, options, data):
+    """Returns the pdf for spool data drawn with the client's options."""
+    import RasCache
+    from cStringIO import StringIO
+    if not RasCache.stampsValid(self.stamps):
+      log.info("Reloading %s", self.config)
+      self._load()
+    RasConfig.setCurrentDirectory(options['cwd'])
+    RasConfig.set('global', 'compression', options.get('compression') or self.compression)
+    out = StringIO()
+    self.jobs += 1
+    start = time.time()
+    self.raspdf.render(options, StringIO(data), out)
+    log.info("Job %s in %s: %s bytes in %.2fs", self.jobs, options['cwd'], len(data), time.time() - start)
+    return out.getvalue()
 
+  def retire(self, maxjobs, maxrss):
+    """Exit status to leave with (EXITJOBS or EXITMEMORY) if the worker should be replaced or None."""
+    if maxjobs and self.jobs >= maxjobs: return EXITJOBS
+    if maxrss and self.jobs and rss() > maxrss: return EXITMEMORY #Not before a job or a new worker would be replaced at once.
+    return None
 
-def handle(connection, address):
-    import logging
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger("process-%r" % (address,))
+def _serve(control, config, maxjobs, maxrss):
+  """Worker process main loop. Tells the parent it is ready on control and then waits for the
+     parent to pass it a client connection followed by the client's JOB. Returns the exit status.
+  """
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_IGN) #The parent shuts the workers down.
+  worker = Worker(config)
+  f = control.makefile('rb', 0) #Unbuffered so nothing is read past the JOB.
+  while True:
+    status = worker.retire(maxjobs, maxrss)
+    if status:
+      log.info("Replacing worker after %s jobs using %.0fMB", worker.jobs, rss())
+      return status
+    control.sendall(READY)
+    try:
+      fd = recvfd(control.fileno())
+    except RuntimeError: #No descriptor. The parent has gone.
+      return 0
+    except OSError, e:
+      if e.errno == errno.EINTR: continue
+      raise
+    #fromfd returns a bare _socket.socket whose makefile ignores timeouts.
+    conn = socket.socket(_sock=socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM))
+    os.close(fd)
     try:
-        logger.debug("Connected %r at %r", connection, address)
-        while True:
-            data = connection.recv(1024)
-            if data == "":
-                logger.debug("Socket closed remotely")
-                break
-            logger.debug("Received data %r", data)
-            connection.sendall(data)
-            logger.debug("Sent data")
-    except:
-        logger.exception("Problem handling request")
+      kind, options = recvMessage(f)
+      worker.handle(conn, marshal.loads(options))
     finally:
-        logger.debug("Closing socket")
-        connection.close()
-
-class Server(object):
-    def __init__(self, hostname, port):
-        import logging
-        self.logger = logging.getLogger("server")
-        self.hostname = hostname
-        self.port = port
-
-    def start(self):
-        self.logger.debug("listening")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.hostname, self.port))
-        self.socket.listen(1)
-
-        while True:
-            conn, address = self.socket.accept()
-            self.logger.debug("Got connection")
-            q.put( pickle.dumps((conn, address)))
+      conn.close()
 
-if __name__ == "__main__":
-    import logging
-    logging.basicConfig(level=logging.DEBUG)
-    for i in xrange(CHILDREN):
-      process = Process(target=qhandle)
-      process.daemon = True
-      process.start()
-      
-    server = Server("0.0.0.0", 9001)
+def _terminate(signum, frame):
+  raise SystemExit(0)
+
+def _cause(status):
+  """Why a worker exited from its waitpid status."""
+  if os.WIFSIGNALED(status): return "signal %s" % (os.WTERMSIG(status))
+  code = os.WEXITSTATUS(status)
+  return CAUSES.get(code, "status %s" % (code))
+
+class _Child:
+  """A worker process as seen by the parent."""
+  def __init__(self, pid, control):
+    self.pid = pid
+    self.control = control #Parent's end of the socket pair to the worker.
+    self.started = None #When the worker was given its current job.
+    self.big = False #Current job is a big batch job.
+    self.jobs = 0
+    self.born = time.time()
+
+class _Client:
+  """A client connection in the parent. Its JOB is read here, the DATA by the worker.
+     The JOB of a client that is not trusted is never unmarshalled.
+  """
+  def __init__(self, conn, trusted):
+    self.conn = conn
+    self.trusted = trusted
+    self.accepted = time.time()
+    self.buffer = ""
+    self.kind = None #JOB or STATUS once the whole request has arrived.
+    self.job = None #The marshalled options of a JOB.
+    self.options = None
+    self.cost = None #Estimated seconds, set when queued.
+    self.big = False
+
+  def fileno(self):
+    return self.conn.fileno()
+
+  def read(self):
+    """Read whatever has arrived. True once the JOB or STATUS is complete."""
+    data = self.conn.recv(MAXJOB)
+    if not data: raise EOFError("Connection closed")
+    self.buffer += data
+    if "\n" not in self.buffer:
+      if len(self.buffer) > MAXHEADER: raise ServerError("Bad message header %r" % (self.buffer[:MAXHEADER]))
+      return False
+    header, rest = self.buffer.split("\n", 1)
+    kind, length = parseHeader(header)
+    if kind not in ("JOB", "STATUS"): raise ServerError("Expected JOB not %s" % (kind))
+    if length > MAXJOB: raise ServerError("JOB of %s bytes is too long" % (length))
+    if len(rest) < length: return False
+    if len(rest) > length: raise ServerError("DATA sent before SEND")
+    self.kind = kind
+    if kind == "STATUS" or not self.trusted: return True
+    self.job = rest
     try:
-        logging.info("Listening")
-        server.start()
-    except:
-        logging.exception("Unexpected exception")
+      self.options = marshal.loads(rest)
+    except (ValueError, EOFError, TypeError), e:
+      raise ServerError("Bad JOB: %s" % (e))
+    if not isinstance(self.options, dict): raise ServerError("Bad JOB: not a dict")
+    return True
+
+  def close(self):
+    self.conn.close()
+
+class Server:
+  """Listens on a Unix socket and keeps count worker processes running.
+
+     Connections are accepted here and their JOB read without blocking, so any number of clients
+     can be connected at once. Complete jobs wait in a priority queue of at most queue entries,
+     shortest estimated job first. Waiting makes a job's priority better (AGEING) so big jobs
+     still get drawn, and interactive jobs start as if they had already waited. Big batch jobs
+     are kept off the last reserve workers so small jobs aren't stuck behind them.
+
+     Workers are replaced after maxjobs jobs or once they use more than maxrss megabytes. spares
+     extra workers are kept running so there is always a warm one to take over. At most count
+     jobs are drawn at once.
+     When it is full the client is told BUSY with the number of seconds to wait before trying
+     again. A job's connection is handed to an idle worker (SCM_RIGHTS) together with its JOB
+     and the worker reads the DATA straight from the client. Workers send READY on their
+     control socket each time they are free for another connection.
+  """
+
+  def __init__(self, path, config, count=WORKERS, queue=QUEUE, reserve=RESERVE, spares=SPARES, maxjobs=MAXJOBS, maxrss=MAXRSS):
+    self.path = path
+    self.config = config
+    self.count = count
+    self.queuesize = queue
+    self.reserve = min(reserve, count - 1)
+    self.spares = spares
+    self.maxjobs = maxjobs
+    self.maxrss = maxrss
+    self.children = {} #Control socket: _Child
+    self.leaving = {} #pid: _Child of workers that have closed their control socket but not been reaped.
+    self.exited = deque(maxlen=RECENT) #(pid, cause, jobs, time) of workers that have exited.
+    self.ready = [] #Idle workers in the order they became free.
+    self.clients = {} #Socket: _Client for connections still sending their JOB.
+    self.queue = [] #Heap of (priority, sequence, _Client) waiting for a worker. See priority().
+    self.sequence = 0 #Keeps jobs of the same priority in arrival order.
+    self.average = 1.0 #Recent seconds per job. Used for the BUSY retry time.
+
+  def _listen(self):
+    if os.path.exists(self.path):
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        probe.connect(self.path)
+      except socket.error: #Left over from a server that has gone.
+        os.unlink(self.path)
+      else:
+        raise ServerError("A server is already listening on %s" % (self.path))
+      finally:
+        probe.close()
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.socket.bind(self.path)
+    os.chmod(self.path, 0777) #Every user runs raspdf. Jobs from other users are refused, see _accept.
+    self.socket.listen(socket.SOMAXCONN)
+    self.socket.setblocking(0)
+
+  def _spawn(self):
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        try:
+          self.socket.close()
+          parent.close()
+          for c in self.children: c.close() #Otherwise workers would not see the parent go.
+          for c in self.clients.values(): c.close()
+          for entry in self.queue: entry[-1].close()
+          status = _serve(child, self.config, self.maxjobs, self.maxrss)
+        except KeyboardInterrupt:
+          status = 0
+        except:
+          log.exception("Worker failed")
+      finally:
+        os._exit(status)
+    child.close()
+    self.children[parent] = _Child(pid, parent)
+
+  def _remove(self, control):
+    """Forget a worker that has gone. Its process is collected by _reap."""
+    child = self.children.pop(control)
+    if child in self.ready: self.ready.remove(child)
+    self.leaving[child.pid] = child
+    control.close()
+
+  def _reap(self):
+    """Collect workers that have exited."""
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError: #No children left.
+        return
+      if not pid: return
+      for control, child in self.children.items():
+        if child.pid == pid: self._remove(control)
+      child = self.leaving.pop(pid, None)
+      cause = _cause(status)
+      self.exited.append((pid, cause, child and child.jobs or 0, time.time()))
+      if cause in ("jobs", "memory"):
+        log.info("Worker %s replaced after %s jobs (%s)", pid, child and child.jobs, cause)
+      else:
+        log.warning("Worker %s exited: %s", pid, cause)
+        time.sleep(0.1) #Don't spin if workers die straight away.
+
+  def priority(self, client):
+    """Lower runs first. Estimated cost less the time waited (times AGEING). Every job ages at
+       the same rate so the order never changes and the cost plus the arrival time will do.
+    """
+    priority = client.cost + AGEING * client.accepted
+    if client.options.get('interactive'): priority -= INTERACTIVE
+    return priority
+
+  def retryAfter(self):
+    """Seconds a client turned away should wait. Roughly how long the queue takes to clear."""
+    return max(1, min(30, int(math.ceil(self.average * len(self.queue) / max(1, self.count)))))
+
+  def _queue(self, client):
+    """Queue a client whose JOB has arrived or tell it to come back later."""
+    if len(self.queue) >= self.queuesize:
+      log.info("Queue full. Busy for %s", self.retryAfter())
+      try:
+        client.conn.setblocking(1)
+        sendMessage(client.conn, "BUSY", str(self.retryAfter()))
+      except socket.error:
+        pass
+      client.close()
+      return
+    client.cost = cost(client.options)
+    client.big = client.cost >= BIGJOB and not client.options.get('interactive')
+    self.sequence += 1
+    heapq.heappush(self.queue, (self.priority(client), self.sequence, client))
+
+  def _next(self):
+    """Position in the queue of the job to draw next or None if only big jobs are waiting and
+       the rest of the workers are reserved.
+    """
+    if not self.queue[0][-1].big: return 0
+    big = len([ c for c in self.children.values() if c.started and c.big ])
+    if big < self.count - self.reserve: return 0
+    small = [ (entry, i) for i, entry in enumerate(self.queue) if not entry[-1].big ]
+    if not small: return None
+    return min(small)[1]
+
+  def _dispatch(self):
+    """Hand queued connections to idle workers."""
+    busy = len([ c for c in self.children.values() if c.started ])
+    while self.queue and self.ready and busy < self.count:
+      i = self._next()
+      if i is None: return
+      child = self.ready.pop(0)
+      client = self.queue[i][-1]
+      try:
+        sendfd(child.control.fileno(), client.conn.fileno())
+        sendMessage(child.control, "JOB", client.job)
+      except (OSError, socket.error), e: #Worker has died.
+        log.warning("Could not pass connection to worker %s: %s", child.pid, e)
+        self._remove(child.control)
+        continue
+      self.queue[i] = self.queue[-1]
+      self.queue.pop()
+      heapq.heapify(self.queue)
+      log.debug("Job of %.2fs estimated waited %.2fs", client.cost, time.time() - client.accepted)
+      client.close()
+      child.started = time.time()
+      child.big = client.big
+      child.jobs += 1
+      busy += 1
+
+  def status(self):
+    """Text for a STATUS request. Every worker and the ones that exited most recently."""
+    now = time.time()
+    lines = [ "%s workers, %s spare, %s queued, %.2fs per job" % (self.count, self.spares, len(self.queue), self.average) ]
+    for child in sorted(self.children.values(), key=lambda c: c.born):
+      state = child.started and "busy" or child in self.ready and "idle" or "starting"
+      lines.append("worker %s %s jobs %s up %ds" % (child.pid, state, child.jobs, now - child.born))
+    for pid, cause, jobs, when in self.exited:
+      lines.append("exited %s after %s jobs (%s) %ds ago" % (pid, jobs, cause, now - when))
+    return "\n".join(lines) + "\n"
+
+  def _expire(self):
+    """Drop connections that have not sent their JOB."""
+    limit = time.time() - JOBTIMEOUT
+    for s, client in self.clients.items():
+      if client.accepted < limit:
+        log.warning("No JOB after %ss", JOBTIMEOUT)
+        del self.clients[s]
+        client.close()
+
+  def _accept(self):
+    while True:
+      try:
+        conn, address = self.socket.accept()
+      except socket.error, e:
+        if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK): return
+        raise
+      conn.setblocking(0)
+      uid = peerUid(conn)
+      if uid != os.getuid(): log.info("Connection from uid %s. Only jobs from uid %s are drawn", uid, os.getuid())
+      self.clients[conn] = _Client(conn, uid == os.getuid())
+
+  def _read(self, s):
+    client = self.clients[s]
+    try:
+      if not client.read(): return
+    except socket.error, e:
+      if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK): return
+      log.warning("Bad request: %s", e)
+    except (ServerError, EOFError), e:
+      log.warning("Bad request: %s", e)
+    else:
+      del self.clients[s]
+      if client.kind == "STATUS" or not client.trusted:
+        try:
+          client.conn.setblocking(1)
+          if client.kind == "STATUS": sendMessage(client.conn, "STATUS", self.status())
+          else: sendMessage(client.conn, "REFUSED", "Server only draws jobs for uid %s" % (os.getuid()))
+        except socket.error:
+          pass
+        client.close()
+      else:
+        self._queue(client)
+      return
+    del self.clients[s]
+    client.close()
+
+  def _ready(self, control):
+    """Messages from a worker."""
+    child = self.children[control]
+    try:
+      data = control.recv(64)
+    except socket.error:
+      data = ""
+    if not data: #Worker has gone.
+      self._remove(control)
+      return
+    if child.started:
+      self.average = 0.8 * self.average + 0.2 * (time.time() - child.started)
+      child.started = None
+    for i in range(data.count(READY)): self.ready.append(child)
+
+  def _poll(self, timeout):
+    """Wait for new connections, JOBs and messages from the workers."""
+    try:
+      readable = select.select([self.socket] + self.children.keys() + self.clients.keys(), [], [], timeout)[0]
+    except select.error, e:
+      if e.args[0] == errno.EINTR: return
+      raise
+    for s in readable:
+      if s is self.socket: self._accept()
+      elif s in self.children: self._ready(s)
+      elif s in self.clients: self._read(s)
+
+  def start(self):
+    """Run until interrupted."""
+    if sendfd is None: raise ServerError("This python can't pass file descriptors between processes")
+    self._listen()
+    signal.signal(signal.SIGTERM, _terminate)
+    log.info("Listening on %s with %s workers and a queue of %s", self.path, self.count, self.queuesize)
+    try:
+      while True:
+        if len(self.children) < self.count + self.spares:
+          self._spawn()
+          continue
+        self._poll(1.0)
+        self._dispatch()
+        self._expire()
+        self._reap()
     finally:
-        logging.info("Shutting down")
-        for process in multiprocessing.active_children():
-            logging.info("Shutting down process %r", process)
-            process.terminate()
-            process.join()
-    logging.info("All done")
+      self.stop()
+
+  def stop(self):
+    for child in self.children.values():
+      try: os.kill(child.pid, signal.SIGTERM)
+      except OSError: pass
+    for child in self.children.values():
+      try: os.waitpid(child.pid, 0)
+      except OSError: pass
+      child.control.close()
+    self.children = {}
+    self.ready = []
+    for client in self.clients.values(): client.close()
+    self.clients = {}
+    for entry in self.queue: entry[-1].close()
+    self.queue = []
+    try: os.unlink(self.path)
+    except OSError: pass
+
+def main():
+  import optparse
+  parser = optparse.OptionParser("Usage: %prog [<options>]\nRender server for raspdf.")
+  parser.add_option("-C", "--config", dest="config", type="string", default="xmmail.conf", help="Config file location")
+  parser.add_option("--socket", dest="socket", type="string", help="Socket to listen on. Overrides server in the config file.")
+  parser.add_option("--workers", dest="workers", type="int", help="Number of worker processes. Overrides serverworkers in the config file.")
+  parser.add_option("--reserve", dest="reserve", type="int", help="Workers kept free of big batch jobs. Overrides serverreserve in the config file.")
+  parser.add_option("--queue", dest="queue", type="int", help="Jobs that can wait for a worker before clients are told to retry. Overrides serverqueue in the config file.")
+  parser.add_option("--status", dest="status", action="store_true", default=False, help="Show the workers of the running server and why the last ones were replaced")
+  parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Log every job")
+  parser.add_option("--debug", dest="debug", action="store_true", default=False, help="Show debugging information")
+  (options, args) = parser.parse_args()
 
+  logging.basicConfig(format="%(asctime)s %(process)d %(levelname)s %(module)s:%(lineno)d: %(message)s")
+  if options.verbose: log.setLevel(logging.INFO)
+  if options.debug: log.setLevel(logging.DEBUG)
+
+  import RasPDF, RascalPDF #Imported before the workers are started so they share the memory.
+  config = RasConfig.fileLocate(options.config)
+  RasConfig.load(config, RasPDF.CONFIGDEFAULTS)
+  path = options.socket or socketPath() or SOCKET
+  if options.status:
+    try:
+      print status(path),
+    except (socket.error, EOFError), e:
+      parser.error("No server on %s: %s" % (path, e))
+    return
+  setting = lambda name, default: int(RasConfig.get_default('global', name, default))
+  workers = options.workers or setting('serverworkers', WORKERS)
+  queue = options.queue or setting('serverqueue', QUEUE)
+  reserve = options.reserve
+  if reserve is None: reserve = setting('serverreserve', RESERVE)
+  warm()
+  try:
+    Server(path, os.path.abspath(config), workers, queue, reserve, spares=setting('serverspares', SPARES),
+      maxjobs=setting('servermaxjobs', MAXJOBS), maxrss=setting('servermaxrss', MAXRSS)).start()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  main()
@@ -10,7 +10,8 @@ __license__ = "BSD"
 __status__ = "Production"
 
 
-import sys
+import sys, time
+begin = time.time()
 import os, os.path 
 
 #Setup system so we can find the libraries easily.
@@ -23,6 +24,10 @@ for d in [ os.path.join(rd, 'lib'), '/rascal/raspdf/lib', '/usr/local/raspdf/lib
     sys.path.append(d)
     break #Use the first path that matches.
 
+if "--startup-profile" in sys.argv:
+  import RasStartup
+  RasStartup.start(begin)
+
 try:
   import RasPDF
 except ImportError:
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Shared set up for the raspdf tests. Run them all from the top directory with:
+
+  python -m unittest discover -s tests
+
+Each test runs in its own temporary directory with the config written by configure().
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, os.path, sys, re, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import RasConfig
+
+class TestCase(unittest.TestCase):
+  """Runs each test in a new temporary directory, self.tmp. The current directory, the search
+     path and the config are put back afterwards.
+  """
+
+  def setUp(self):
+    self.tmp = os.path.realpath(tempfile.mkdtemp(prefix="rastest"))
+    self.cwd = os.getcwd()
+    self.locations = list(RasConfig.searchLocations)
+    self.xmmail = RasConfig.xmmail
+    self.chdir(self.tmp)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    RasConfig.searchLocations[:] = self.locations
+    RasConfig.xmmail = self.xmmail
+    shutil.rmtree(self.tmp)
+
+  def chdir(self, d):
+    """Change to d and search it the way the render server does for each job."""
+    RasConfig.setCurrentDirectory(d)
+
+  def mkdir(self, name, files={}):
+    """Make directory name under self.tmp holding files, a dict of file name: contents. Returns its path."""
+    d = os.path.join(self.tmp, name)
+    if not os.path.isdir(d): os.makedirs(d)
+    for fname, data in files.items():
+      f = file(os.path.join(d, fname), "wb")
+      f.write(data)
+      f.close()
+    return d
+
+  def configure(self, **options):
+    """Write and load a config file with options in its [global] section.
+       Pages are not compressed unless asked for so tests can look for the text on them.
+    """
+    options.setdefault('compression', 'none')
+    fname = os.path.join(self.mkdir("etc"), "xmmail.conf")
+    f = file(fname, "w")
+    f.write("[global]\n")
+    for k, v in options.items(): f.write("%s = %s\n" % (k, v))
+    f.close()
+    RasConfig.load(fname, {})
+
+  def draw(self, spool, **options):
+    """Returns the pdf for spool. options are passed to RascalPDF.PrintJob."""
+    import RascalPDF
+    from cStringIO import StringIO
+    out = tempfile.TemporaryFile()
+    if isinstance(spool, basestring): spool = StringIO(spool)
+    RascalPDF.PrintJob(output=out, **options).feed(spool)
+    out.seek(0)
+    return out.read()
+
+def undated(pdf):
+  """pdf without the parts that change from run to run."""
+  return re.sub(r"/(CreationDate|ModDate) \(D:[^)]*\)|/ID\s*\[.*?\]", "", pdf, flags=re.S)
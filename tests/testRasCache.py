@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the on disk caches in RasCache."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, stat, shutil, cPickle, unittest
+from rastest import TestCase, undated
+import RasConfig, RasCache, RascalPDF
+
+SPOOL = "{$INCLUDE(header.inc)}\nInvoice 1234\n"
+
+class JobCacheTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.cache = RasCache.JobCache(self.mkdir("jobs"), 1024 * 1024)
+    self.indexcheck = RasConfig.INDEXCHECK
+    RasConfig.INDEXCHECK = 0 #Notice new files straight away.
+
+  def tearDown(self):
+    RasConfig.INDEXCHECK = self.indexcheck
+    TestCase.tearDown(self)
+
+  def testOtherDirectory(self):
+    a = self.mkdir("a", {"header.inc": "Company AAA header\n"})
+    b = self.mkdir("b", {"header.inc": "Company BBB header\n"})
+    self.chdir(a)
+    self.assertTrue("Company AAA header" in self.draw(SPOOL, cache=self.cache))
+    self.chdir(b)
+    self.assertTrue("Company BBB header" in self.draw(SPOOL, cache=self.cache))
+    self.chdir(a)
+    self.assertTrue("Company AAA header" in self.draw(SPOOL, cache=self.cache))
+
+  def testNameFindsAnotherFile(self):
+    d = self.mkdir("a")
+    self.mkdir("a/images", {"header.inc": "Shared header\n"})
+    self.chdir(d)
+    self.assertTrue("Shared header" in self.draw(SPOOL, cache=self.cache))
+    self.mkdir("a", {"header.inc": "Own header\n"}) #Found before the one in images.
+    self.assertTrue("Own header" in self.draw(SPOOL, cache=self.cache))
+
+  def testChangedInclude(self):
+    d = self.mkdir("a", {"header.inc": "First header\n"})
+    self.chdir(d)
+    self.draw(SPOOL, cache=self.cache)
+    self.mkdir("a", {"header.inc": "Second header, longer\n"})
+    self.assertTrue("Second header" in self.draw(SPOOL, cache=self.cache))
+
+  def testReadOnly(self):
+    pdf = self.draw("Invoice 1234\n", cache=self.cache)
+    key = [ f[:-4] for f in os.listdir(self.cache.directory) if f.endswith(".pdf") ][0]
+    def utime(path, times): raise OSError(1, "Operation not permitted")
+    os.utime, saved = utime, os.utime
+    try:
+      cached = self.cache.get(key)
+    finally:
+      os.utime = saved
+    self.assertEqual(cached.read(), pdf)
+    cached.close()
+
+  def mode(self, directory):
+    return set([ stat.S_IMODE(os.stat(os.path.join(directory, f)).st_mode) for f in os.listdir(directory) ])
+
+  def testPrivate(self):
+    self.draw("Invoice 1234\n", cache=self.cache)
+    self.assertEqual(self.mode(self.cache.directory), set([0600]))
+
+  def testGroupMode(self):
+    self.configure(cachemode="0666")
+    self.draw("Invoice 1234\n", cache=self.cache)
+    self.assertEqual(self.mode(self.cache.directory), set([0640]))
+
+class IncludeCacheTest(TestCase):
+  """A header shared by two directories that includes a file each directory has its own copy of."""
+
+  def setUp(self):
+    TestCase.setUp(self)
+    shared = self.mkdir("shared", {"header.inc": "{$INCLUDE(logo.inc)}\nShared header\n"})
+    self.spool = "{$INCLUDE(%s)}\nInvoice 1234\n" % (os.path.join(shared, "header.inc"))
+    self.a = self.mkdir("a", {"logo.inc": "Logo of AAA\n"})
+    self.b = self.mkdir("b", {"logo.inc": "Logo of BBB\n"})
+
+  def drawIn(self, d):
+    self.chdir(d)
+    return self.draw(self.spool)
+
+  def check(self):
+    for d, logo in ((self.a, "Logo of AAA"), (self.b, "Logo of BBB"), (self.a, "Logo of AAA")):
+      pdf = self.drawIn(d)
+      self.assertTrue(logo in pdf and "Shared header" in pdf, "%s not drawn in %s" % (logo, d))
+
+  def testMemory(self):
+    self.configure()
+    self.check()
+
+  def testDisk(self):
+    self.configure(cachedir=self.mkdir("cache"))
+    self.drawIn(self.a)
+    self.drawIn(self.b)
+    RascalPDF._includeCache.clear() #As if a new process.
+    self.check()
+    self.assertTrue(os.listdir(os.path.join(self.tmp, "cache", "includes")))
+
+class _Exploit(object):
+  """Makes a directory when unpickled."""
+  def __init__(self, path): self.path = path
+  def __reduce__(self): return (os.mkdir, (self.path,))
+
+class FontCacheTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.cache = RasCache.FontCache(self.mkdir("fonts"))
+    self.font = os.path.join(self.tmp, "tahoma.ttf")
+    shutil.copy(os.path.join(self.cwd, os.path.dirname(__file__), "..", "images", "tahoma.ttf"), self.font)
+
+  def testSameFont(self):
+    from reportlab.pdfbase.ttfonts import TTFont
+    font = TTFont("tahoma.ttf", self.font)
+    self.cache.put(self.font, font)
+    cached = self.cache.get(self.font, "tahoma.ttf")
+    self.assertEqual(cached.face.charWidths, font.face.charWidths)
+    self.assertEqual(cached.face._ttf_data, font.face._ttf_data)
+    self.assertEqual(cached.stringWidth(u"Invoice 1234", 10), font.stringWidth(u"Invoice 1234", 10))
+
+  def testSamePdf(self):
+    spool = "{$FONTNAME(\"tahoma.ttf\")}Invoice 1234\n"
+    from reportlab.pdfbase.ttfonts import TTFont
+    import Point
+    try:
+      drawn = undated(self.draw(spool))
+      del Point.fonts["tahoma.ttf"] #Load it again, this time from the cache.
+      self.cache.put(self.font, TTFont("tahoma.ttf", self.font))
+      self.configure(cachedir=self.tmp) #Uses self.cache's directory.
+      self.assertEqual(undated(self.draw(spool)), drawn)
+    finally:
+      Point.fonts.pop("tahoma.ttf", None)
+
+  def testChangedFont(self):
+    from reportlab.pdfbase.ttfonts import TTFont
+    self.cache.put(self.font, TTFont("tahoma.ttf", self.font))
+    file(self.font, "ab").write("\0")
+    self.assertEqual(self.cache.get(self.font, "tahoma.ttf"), None)
+
+  def testNoPickles(self):
+    marker = os.path.join(self.tmp, "unpickled")
+    file(self.cache._fname(self.font), "wb").write(cPickle.dumps(_Exploit(marker), 2))
+    self.assertEqual(self.cache.get(self.font, "tahoma.ttf"), None)
+    self.assertFalse(os.path.exists(marker))
+
+if __name__ == "__main__":
+  unittest.main()
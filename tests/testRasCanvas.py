@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the operators StateCanvas sends to reportlab's canvas."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import unittest
+from rastest import TestCase
+import RasCanvas
+
+class CanvasTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    from cStringIO import StringIO
+    from reportlab.pdfgen import canvas
+    self.canvas = canvas.Canvas(StringIO())
+    self.gstate = RasCanvas.StateCanvas(self.canvas)
+
+  def page(self):
+    """The operators of the page so far."""
+    self.gstate.flush()
+    return "\n".join(self.canvas._code)
+
+class StateTest(CanvasTest):
+  """Font, fill colour and line width are only set when they change."""
+
+  def testFont(self):
+    for i in range(3):
+      self.gstate.setFont("Courier", 10)
+      self.gstate.drawString(10, 800 - i * 10, "Line %d" % (i))
+    self.gstate.setFont("Courier-Bold", 10)
+    self.gstate.drawString(10, 770, "Total")
+    page = self.page()
+    self.assertEqual(page.count(" Tf"), 2, page)
+
+  def testFontNotSetWithoutText(self):
+    self.gstate.setFont("Courier", 10)
+    self.gstate.setFont("Courier-Bold", 12)
+    self.assertEqual(self.page().count(" Tf"), 0)
+
+  def testFillColor(self):
+    for i in range(3): self.gstate.setFillColorRGB(1, 0, 0)
+    self.gstate.setFillColorRGB(0, 0, 1)
+    self.assertEqual(self.page().count(" rg"), 2)
+
+  def testLineWidth(self):
+    for i in range(3): self.gstate.setLineWidth(2)
+    self.assertEqual(self.page().count(" w"), 1)
+
+  def testNewPage(self):
+    """reportlab starts each page with its defaults so everything is set again."""
+    self.gstate.setLineWidth(2)
+    self.gstate.showPage()
+    self.gstate.setLineWidth(2)
+    self.assertEqual(self.page().count(" w"), 1)
+
+class TextTest(CanvasTest):
+  """Text is batched into one text object until something else is drawn."""
+
+  def setUp(self):
+    CanvasTest.setUp(self)
+    self.gstate.setFont("Courier", 10)
+
+  def lines(self, count, y=800):
+    for i in range(count):
+      self.gstate.drawString(10, y - i * 10, "Line %d" % (i))
+      self.gstate.drawString(60, y - i * 10, "Amount %d" % (i))
+
+  def testOneTextObject(self):
+    self.lines(20)
+    page = self.page()
+    self.assertEqual((page.count("BT"), page.count("ET"), page.count(" Tj")), (1, 1, 40))
+
+  def testClosedForOtherDrawing(self):
+    self.lines(5)
+    self.gstate.rect(10, 10, 100, 100)
+    self.lines(5, 500)
+    page = self.page()
+    self.assertEqual(page.count("BT"), 2)
+    self.assertTrue(page.index("ET") < page.index(" re") < page.rindex("BT"))
+
+  def testColorInText(self):
+    self.lines(1)
+    self.gstate.setFillColorRGB(1, 0, 0)
+    self.lines(1, 700)
+    self.assertEqual(self.page().count("BT"), 1)
+
+  def testRelativeMoves(self):
+    """Positions are Td moves from the start of the previous fragment."""
+    self.lines(2)
+    page = self.page()
+    self.assertTrue("50 0 Td" in page and "-50 -10 Td" in page, page)
+
+if __name__ == "__main__":
+  unittest.main()
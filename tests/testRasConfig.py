@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for finding files with RasConfig.fileLocate."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, unittest
+from rastest import TestCase
+import RasConfig
+
+class IndexTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.indexcheck = RasConfig.INDEXCHECK
+    RasConfig.INDEXCHECK = 3600 #Never checked again unless a lookup needs it.
+    self.mkdir("a/images", {"logo.png": "images"})
+    self.a = self.mkdir("a", {"logo.png": "own"})
+    self.chdir(self.a)
+
+  def tearDown(self):
+    RasConfig.INDEXCHECK = self.indexcheck
+    TestCase.tearDown(self)
+
+  def testFirstDirectoryWins(self):
+    self.assertEqual(RasConfig.fileLocate("logo.png"), os.path.join(self.a, "logo.png"))
+    self.assertEqual(RasConfig.fileLocate('"logo.png"'), os.path.join(self.a, "logo.png"))
+
+  def testCreated(self):
+    self.assertRaises(RasConfig.RasConfigNoSuchFileError, RasConfig.fileLocate, "header.inc")
+    file(os.path.join(self.a, "images", "header.inc"), "w").write("Header\n")
+    self.assertEqual(RasConfig.fileLocate("header.inc"), os.path.join(self.a, "images", "header.inc"))
+
+  def testDirectoryInName(self):
+    self.assertEqual(RasConfig.fileLocate(os.path.join("images", "logo.png")), os.path.join(self.a, "images", "logo.png"))
+
+  def testOtherDirectory(self):
+    self.assertEqual(RasConfig.fileLocate("logo.png"), os.path.join(self.a, "logo.png"))
+    b = self.mkdir("b", {"logo.png": "b"})
+    self.chdir(b)
+    self.assertEqual(RasConfig.fileLocate("logo.png"), os.path.join(b, "logo.png"))
+
+  def testDeleted(self):
+    self.assertEqual(RasConfig.fileLocate("logo.png"), os.path.join(self.a, "logo.png"))
+    os.unlink(os.path.join(self.a, "logo.png"))
+    self.assertEqual(RasConfig.fileLocate("logo.png"), os.path.join(self.a, "images", "logo.png"))
+    os.unlink(os.path.join(self.a, "images", "logo.png"))
+    self.assertRaises(RasConfig.RasConfigNoSuchFileError, RasConfig.fileLocate, "logo.png")
+
+if __name__ == "__main__":
+  unittest.main()
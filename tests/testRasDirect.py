@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the text only backend in RasDirect."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import unittest
+from cStringIO import StringIO
+from rastest import TestCase
+import RascalPDF, RasDirect, RasWriter
+from RasCanvas import Unsupported
+
+class DirectTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.canvas = RasDirect.DirectCanvas(StringIO(), (595, 842), RasWriter.Compression('none'))
+
+  def program(self, spool):
+    parser = RascalPDF._Parser()
+    for line in spool.splitlines(True): parser.parseLine(line)
+    return parser.cmdlist
+
+  def testCanDraw(self):
+    none = RasWriter.Compression('none')
+    self.assertTrue(RasDirect.canDraw(self.program("{$SF(12)}Invoice 1234\n{$BOXS(5)}  {$BOXE(5)}\n"), none))
+    self.assertFalse(RasDirect.canDraw(self.program('{$PIC("logo.jpg",100,50)}\n'), none))
+    self.assertFalse(RasDirect.canDraw(self.program('{$FONTNAME("tahoma.ttf")}Invoice\n'), none))
+
+  def testUnsupported(self):
+    self.assertRaises(Unsupported, self.canvas.drawImage, "logo.jpg", 0, 0)
+    self.assertRaises(Unsupported, self.canvas.beginForm, "RasForm0")
+    self.canvas.setFont("tahoma.ttf", 10)
+    self.assertRaises(Unsupported, self.canvas.drawString, 10, 10, u"Invoice")
+
+if __name__ == "__main__":
+  unittest.main()
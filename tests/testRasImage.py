@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the {$PIC} images made and cached by RasImage."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, re, shutil, unittest
+from rastest import TestCase
+import RasImage, RasCache
+
+IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images")
+
+class ImageTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    for name in ("nac.png", "nac.jpg"):
+      shutil.copy(os.path.join(IMAGES, name), self.tmp)
+    self.png = os.path.join(self.tmp, "nac.png")
+    self.cache = RasCache.ImageCache(self.mkdir("images"))
+    RasImage._loaded.clear()
+    self.encodeImage = RasImage.encodeImage
+    self.encoded = []
+
+  def tearDown(self):
+    RasImage.encodeImage = self.encodeImage
+    RasImage._loaded.clear()
+    TestCase.tearDown(self)
+
+  def count(self):
+    """Count the images encoded from now on."""
+    def counted(*args):
+      self.encoded.append(args[0])
+      return self.encodeImage(*args)
+    RasImage.encodeImage = counted
+
+  def testLoadedOnce(self):
+    self.count()
+    loader = RasImage.ImageLoader(self.cache)
+    image = loader.get(self.png)
+    self.assertTrue(RasImage.ImageLoader(self.cache).get(self.png) is image)
+    self.assertEqual(len(self.encoded), 1)
+
+  def testDiskCache(self):
+    image = RasImage.ImageLoader(self.cache).get(self.png)
+    RasImage._loaded.clear() #As if a new process.
+    self.count()
+    cached = RasImage.ImageLoader(self.cache).get(self.png)
+    self.assertEqual(self.encoded, [])
+    self.assertEqual(cached.totuple(), image.totuple())
+
+  def testChangedFile(self):
+    image = RasImage.ImageLoader(self.cache).get(self.png)
+    shutil.copy(os.path.join(IMAGES, "geeks.png"), self.png)
+    changed = RasImage.ImageLoader(self.cache).get(self.png)
+    self.assertNotEqual(changed.name, image.name)
+    self.assertNotEqual(changed.data, image.data)
+
+  def testScaled(self):
+    image = RasImage.ImageLoader(dpi=0).get(self.png)
+    small = RasImage.ImageLoader(dpi=72).get(self.png, 20, 10)
+    self.assertTrue(image.width > 20 and image.height > 10)
+    self.assertEqual((small.width, small.height), (20, 10))
+
+  def testJpegUnchanged(self):
+    jpg = os.path.join(self.tmp, "nac.jpg")
+    image = RasImage.ImageLoader(dpi=72).get(jpg, 20, 10)
+    self.assertEqual((image.filters, image.data), (('DCTDecode',), file(jpg, "rb").read()))
+
+  def testOncePerPdf(self):
+    pdf = self.draw("{$PIC(nac.png, 100, 50)}Page 1\n{$NEWPAGE}{$PIC(nac.png, 100, 50)}Page 2\n")
+    self.assertEqual(pdf.count("/Subtype /Image"), 1)
+    self.assertEqual(len(re.findall(r"/FormXob\.RasImg\w+ Do", pdf)), 2)
+
+if __name__ == "__main__":
+  unittest.main()
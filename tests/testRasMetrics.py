@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for measuring text with RasMetrics.WidthEngine."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, unittest
+from rastest import TestCase
+from reportlab.pdfbase import pdfmetrics
+import RasMetrics
+
+TEXTS = [ "", "Invoice 1234", "  Total:      1,234.56", u"Caf\xe9 cr\xe8me", "Caf\xc3\xa9", u"€ 10", u"☃ snowman",
+          "iiiiiiiiii WWWWWWWWWW" ]
+FONTS = [ "Courier", "Courier-Bold", "Helvetica", "Helvetica-Oblique", "Times-Roman" ]
+SIZES = [ 6, 10, 10.5, 12 ]
+
+class WidthTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.engine = RasMetrics.WidthEngine()
+
+  def check(self, fonts):
+    for font in fonts:
+      for text in TEXTS:
+        for size in SIZES:
+          self.assertEqual(self.engine.stringWidth(text, font, size), pdfmetrics.stringWidth(text, font, size),
+                           "%r in %s %s" % (text, font, size))
+
+  def testStandardFonts(self):
+    self.check(FONTS)
+    self.check(FONTS) #Again from the cache.
+
+  def testTrueType(self):
+    from reportlab.pdfbase.ttfonts import TTFont
+    path = os.path.join(self.cwd, os.path.dirname(__file__), "..", "images", "tahoma.ttf")
+    pdfmetrics.registerFont(TTFont("tahoma.ttf", path))
+    self.check(["tahoma.ttf"])
+
+  def testMonospace(self):
+    self.assertNotEqual(self.engine._fontTable("Courier")[1], None)
+    self.assertEqual(self.engine._fontTable("Helvetica")[1], None)
+
+  def testSmallCache(self):
+    self.engine = RasMetrics.WidthEngine(cachesize=3)
+    self.check(FONTS)
+    self.assertTrue(len(self.engine.recent) <= 3 and len(self.engine.older) <= 3)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the raspdf command line in RasPDF. Each run is a new python so the modules it
+imports can be checked.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, sys, subprocess, unittest
+from rastest import TestCase
+
+RUN = """import sys
+sys.path.insert(0, %r)
+sys.argv = %r
+import RasPDF
+RasPDF.main()
+print " ".join(sorted(sys.modules))
+"""
+
+class StartupTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.spool = os.path.join(self.mkdir("a", {"spool": "Invoice 1234\n"}), "spool")
+    self.out = os.path.join(self.tmp, "out.pdf")
+
+  def raspdf(self, *args, **config):
+    """Run raspdf with args and a config file holding config. Returns the names of the modules it imported."""
+    self.configure(**config)
+    argv = ["raspdf", "-C", os.path.join(self.tmp, "etc", "xmmail.conf"), "-f", self.out] + list(args) + [self.spool]
+    lib = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+    p = subprocess.Popen([sys.executable, "-c", RUN % (lib, argv)], stdout=subprocess.PIPE)
+    modules = p.communicate()[0].split()
+    self.assertEqual(p.returncode, 0)
+    self.assertTrue("Invoice 1234" in file(self.out, "rb").read())
+    return modules
+
+  def testNoServer(self):
+    self.assertFalse("server" in self.raspdf())
+
+  def testServerNotRunning(self):
+    self.assertTrue("server" in self.raspdf(server=os.path.join(self.tmp, "raspdf.sock")))
+
+  def testNoserverOption(self):
+    self.assertFalse("server" in self.raspdf("--noserver", server=os.path.join(self.tmp, "raspdf.sock")))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for drawing print jobs in parallel with RasParallel."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import multiprocessing, unittest
+from rastest import TestCase, undated
+import RasParallel, RasCanvas
+from RasConfig import RascalPDFException
+
+SPOOL = "".join([ "{$SF(%d)}Line %d of the statement\n%s" % (8 + i % 3, i, i % 70 == 69 and "{$NEWPAGE}" or "") for i in range(2000) ])
+
+class ParallelTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure(backend="reportlab") #As used when drawing in parallel.
+    self.saved = RasParallel.MINCOMMANDS, RasParallel.layout, multiprocessing.cpu_count
+    RasParallel.MINCOMMANDS = 1000
+    self.layouts = 0
+
+  def tearDown(self):
+    RasParallel.MINCOMMANDS, RasParallel.layout, multiprocessing.cpu_count = self.saved
+    TestCase.tearDown(self)
+
+  def cpus(self, count):
+    """Pretend the machine has count processors and count the layout passes."""
+    multiprocessing.cpu_count = lambda: count
+    layout = self.saved[1]
+    def counted(*args):
+      self.layouts += 1
+      return layout(*args)
+    RasParallel.layout = counted
+
+  def testOneCPU(self):
+    self.cpus(1)
+    self.assertEqual(undated(self.draw(SPOOL, jobs=4)), undated(self.draw(SPOOL, jobs=1)))
+    self.configure() #The text only backend, as when drawn serially.
+    self.assertEqual(undated(self.draw(SPOOL, jobs=4)), undated(self.draw(SPOOL, jobs=1)))
+    self.assertEqual(self.layouts, 0)
+
+  def testSameAsSerial(self):
+    self.cpus(2)
+    self.assertEqual(undated(self.draw(SPOOL, jobs=2)), undated(self.draw(SPOOL, jobs=1)))
+    self.assertEqual(self.layouts, 1)
+
+  def testFormNotLaidOut(self):
+    self.assertRaises(RascalPDFException, RasCanvas.LayoutCanvas().beginForm, "RasForm0")
+
+if __name__ == "__main__":
+  unittest.main()
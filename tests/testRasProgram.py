@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the array backed RasProgram.Program."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import unittest
+from rastest import TestCase
+import RasProgram
+
+COMMANDS = [ ("PRINTINIT", (), {}), ("SF", (10,), {}), ("printstring", (u"Invoice 1",), {}), ("SHOWLINE", ("1",), {}),
+             ("MA", (1, 1.0), {}), ("PIC", ("logo.png",), {'imgwidth': 40, 'imgheight': 20.5}), ("newline", (), {}),
+             ("printstring", (u"Invoice 1",), {}), ("PRINTEND", (), {}) ]
+
+class ProgramTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.program = RasProgram.Program()
+    self.program.extend(COMMANDS)
+
+  def testSameCommands(self):
+    self.assertEqual(len(self.program), len(COMMANDS))
+    self.assertEqual(list(self.program), COMMANDS)
+
+  def testTypesKept(self):
+    """1, 1.0 and "1" are different constants."""
+    self.assertEqual([ type(a) for a in list(self.program)[4][1] ], [int, float])
+    self.assertEqual(list(self.program)[3][1], ("1",))
+
+  def testSharedText(self):
+    self.assertEqual(self.program.consts.count(u"Invoice 1"), 1)
+
+  def testIterFrom(self):
+    self.assertEqual(list(self.program.iterFrom(5)), COMMANDS[5:])
+
+  def testArgsOf(self):
+    self.assertEqual(list(self.program.argsOf("PIC")), [(("logo.png",), {'imgwidth': 40, 'imgheight': 20.5})])
+    self.assertEqual(list(self.program.argsOf("NOSUCH")), [])
+
+  def testDumps(self):
+    self.program.linestarts.extend([0, 7])
+    loaded = RasProgram.loads(self.program.dumps())
+    self.assertEqual(list(loaded), COMMANDS)
+    self.assertEqual(list(loaded.linestarts), [0, 7])
+    loaded.append(("B1", (), {})) #Can still be added to.
+    self.assertEqual(list(loaded)[-1], ("B1", (), {}))
+
+  def testNotAProgram(self):
+    self.assertRaises(RasProgram.RasProgramError, RasProgram.loads, "Invoice 1234")
+    self.assertRaises(RasProgram.RasProgramError, RasProgram.loads, RasProgram.MAGIC + "junk")
+
+  def testTooManyParameters(self):
+    self.assertRaises(RasProgram.RasProgramError, self.program.append, ("MA", tuple(range(256)), {}))
+
+if __name__ == "__main__":
+  unittest.main()
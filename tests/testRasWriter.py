@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for writing pdfs a page at a time with RasWriter."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import re, zlib, struct, unittest
+from cStringIO import StringIO
+from rastest import TestCase
+import RascalPDF, RasWriter
+from RasConfig import RascalPDFException
+
+SPOOL = "".join([ "Page %d line %d\n%s" % (i / 50, i, i % 50 == 49 and "{$NEWPAGE}" or "") for i in range(500) ])
+
+def xrefOffsets(pdf):
+  """object number: offset from the xref table of pdf"""
+  start = int(re.search(r"startxref\s+(\d+)", pdf).group(1))
+  m = re.match(r"xref\s+0 (\d+)\s+", pdf[start:])
+  offsets = {}
+  for n in range(1, int(m.group(1))):
+    entry = pdf[start + m.end() + 20 * n:start + m.end() + 20 * (n + 1)]
+    offsets[n] = int(entry[:10])
+  return offsets
+
+def pageStreams(pdf):
+  """The decoded content of every stream in pdf that lists its filters in an array. Only pages do in SPOOL."""
+  try:
+    from reportlab.lib.rl_accel import asciiBase85Decode
+  except ImportError: #reportlab 2
+    from reportlab.pdfbase.pdfutils import _AsciiBase85Decode as asciiBase85Decode
+  decoders = {'ASCII85Decode': asciiBase85Decode, 'FlateDecode': zlib.decompress}
+  streams = []
+  for m in re.finditer(r"<<\s*/Filter \[([^]]*)\]\s*/Length (\d+)\s*>>\s*stream\r?\n", pdf, re.S):
+    data = pdf[m.end():m.end() + int(m.group(2))]
+    for name in m.group(1).split():
+      data = decoders[name[1:]](data)
+    streams.append(data)
+  return streams
+
+class WriterTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure(backend="reportlab")
+
+  def pages(self, count):
+    """A RascalPDF with count pages drawn and the last one still open. Returns (<RascalPDF>, <output file>)"""
+    out = StringIO()
+    pdf = RascalPDF.RascalPDF(out)
+    pdf.fnexec("PRINTINIT")
+    for page in range(count):
+      pdf.fnexec("printstring", "Page %d" % (page))
+      pdf.fnexec("newline")
+      pdf.fnexec("NEWPAGE")
+    pdf.fnexec("printstring", "Last page")
+    return pdf, out
+
+  def testPagesWrittenAsDone(self):
+    pdf, out = self.pages(3)
+    self.assertTrue("(Page 2)" in out.getvalue() and "(Last page)" not in out.getvalue())
+    pdf.showPage()
+    self.assertTrue("(Last page)" in out.getvalue())
+    pdf.save()
+    self.assertTrue(out.getvalue().rstrip().endswith("%%EOF"))
+
+  def testPagesDropped(self):
+    from reportlab.pdfbase import pdfdoc
+    pdf, out = self.pages(5)
+    pages = pdf.canvas._doc.Pages.pages
+    self.assertTrue(len(pages) > 2)
+    self.assertEqual([ p for p in pages if not isinstance(p, pdfdoc.PDFObjectReference) ], [])
+
+  def testPageCount(self):
+    self.assertEqual(len(re.findall(r"/Type /Page\b", self.draw(SPOOL))), 10)
+
+  def testXref(self):
+    pdf = self.draw(SPOOL)
+    offsets = xrefOffsets(pdf)
+    self.assertTrue(len(offsets) > 20)
+    for n, offset in offsets.items():
+      self.assertTrue(pdf.startswith("%d 0 obj" % (n), offset), "Object %d is not at %d" % (n, offset))
+
+class CompressionTest(TestCase):
+
+  def draw(self, compression):
+    self.configure(backend="reportlab", compression=compression)
+    return TestCase.draw(self, SPOOL)
+
+  def testSamePages(self):
+    pages = pageStreams(self.draw("none"))
+    self.assertEqual(len(pages), 10)
+    self.assertTrue("(Page 9 line 499) Tj" in pages[-1])
+    for name in ("default", "fast", "small"):
+      self.assertEqual(pageStreams(self.draw(name)), pages, name)
+
+  def testFilters(self):
+    self.assertTrue("(Page 0 line 0) Tj" in self.draw("none"))
+    for name in ("default", "fast", "small"):
+      pdf = self.draw(name)
+      self.assertFalse("(Page 0 line 0) Tj" in pdf, name)
+      self.assertEqual(RasWriter.Compression(name).encode("BT ET")[1][-1], "FlateDecode")
+
+  def testObjectStreams(self):
+    pdf = self.draw("small")
+    self.assertTrue(pdf.startswith("%PDF-1.5"))
+    self.assertFalse("/Type /Page\r" in pdf or "/Type /Page\n" in pdf) #Page dictionaries are in object streams.
+    m = re.search(r"/Type /XRef /Size (\d+) /W \[1 4 2\].*?/Length (\d+) >>\nstream\n", pdf, re.S)
+    data = zlib.decompress(pdf[m.end():m.end() + int(m.group(2))])
+    entries = [ struct.unpack(">BIH", data[i:i + 7]) for i in range(0, len(data), 7) ]
+    self.assertEqual(len(entries), int(m.group(1)))
+    streams = set([ e[1] for e in entries if e[0] == 2 ])
+    self.assertTrue(streams)
+    for n, (kind, a, b) in enumerate(entries):
+      if kind == 1:
+        self.assertTrue(pdf.startswith("%d 0 obj" % (n), a), "Object %d is not at %d" % (n, a))
+      if n in streams:
+        self.assertTrue(re.match(r"%d 0 obj\s*<< /Type /ObjStm" % (n), pdf[entries[n][1]:]), n)
+
+  def testUnknown(self):
+    self.assertRaises(RascalPDFException, RasWriter.Compression, "tiny")
+
+if __name__ == "__main__":
+  unittest.main()
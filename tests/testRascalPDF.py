@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for drawing print jobs in RascalPDF."""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, re, types, unittest
+from rastest import TestCase, undated
+import RascalPDF, RasCache
+
+SPOOL = "".join([ "{$SF(%d)}Line %d of the report{$BOLDON} bold{$BOLDOFF}\n" % (8 + i % 4, i) for i in range(200) ])
+
+class TokenizerTest(TestCase):
+
+  def parse(self, line):
+    parser = RascalPDF._Parser()
+    parser.parseLine(line)
+    return list(parser.cmdlist)
+
+  def testLine(self):
+    self.assertEqual(self.parse("Total{$B1} 12.50 {$B0}\n"), [("printstring", ("Total",), {}), ("B1", (), {}),
+                     ("printstring", (" 12.50 ",), {}), ("B0", (), {}), ("newline", (), {})])
+
+  def testEmptyLine(self):
+    self.assertEqual(self.parse("\n"), [("printstring", ("",), {}), ("newline", (), {})])
+
+  def testTagAtEnd(self):
+    self.assertEqual(self.parse("{$NEWPAGE}"), [("printstring", ("",), {}), ("NEWPAGE", (), {})])
+
+  def testManyTags(self):
+    cmds = self.parse("{$B1}x{$B0}" * 5000 + "\n") #Far more tags than the recursion limit.
+    self.assertEqual(len(cmds), 20001)
+    self.assertEqual(cmds[-3:], [("printstring", ("x",), {}), ("B0", (), {}), ("newline", (), {})])
+
+class ReadLinesTest(TestCase):
+  """Input is cleaned and decoded a block at a time."""
+
+  INPUT = "Invoice\x1b 1234\x0f\n\xc3\xa9t\xc3\xa9\n\xe9t\xe9 latin-1\nForm\x0cfeed\nLast line"
+  LINES = [u"Invoice 1234\n", u"\xe9t\xe9\n", u"t latin-1\n", u"Form\x0cfeed\n", u"Last line"]
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.readsize = RascalPDF._READSIZE
+
+  def tearDown(self):
+    RascalPDF._READSIZE = self.readsize
+    TestCase.tearDown(self)
+
+  def lines(self, f):
+    line = f.readline()
+    return list(RascalPDF.PrintJob()._readLines(line, f))
+
+  def testStream(self):
+    from cStringIO import StringIO
+    for size in (self.readsize, 5):
+      RascalPDF._READSIZE = size
+      self.assertEqual(self.lines(StringIO(self.INPUT)), self.LINES)
+
+  def testFile(self):
+    path = os.path.join(self.tmp, "spool")
+    file(path, "wb").write(self.INPUT)
+    for size in (self.readsize, 5): #Mapped rather than read.
+      RascalPDF._READSIZE = size
+      self.assertEqual(self.lines(file(path, "rb")), self.LINES)
+
+class ParamsTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+
+  def testShowLine(self):
+    for compiled in (False, True):
+      pdf = self.draw('{$SHOWLINE(123)}\n{$SHOWLINE(4.5)}\n{$SHOWLINE("Quoted text")}\n', compiled=compiled)
+      for text in ("(123)", "(4.5)", '("Quoted text")'):
+        self.assertTrue(text in pdf, "%s not drawn" % (text))
+
+  def testNumbers(self):
+    parser = RascalPDF._Parser()
+    parser.parseLine('{$MA(2, 1.5)}{$SHOWLINE(7)}{$PIC(logo.png, imgwidth="40")}\n')
+    cmds = list(parser.cmdlist)
+    self.assertEqual(cmds[1], ("MA", (2, 1.5), {}))
+    self.assertEqual(cmds[3], ("SHOWLINE", ("7",), {}))
+    self.assertEqual(cmds[5], ("PIC", ("logo.png",), {'imgwidth': 40}))
+
+class StreamingTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure(backend="reportlab") #As used when streaming.
+
+  def testSameAsParsedFirst(self):
+    self.assertEqual(undated(self.draw(SPOOL, streaming=True)), undated(self.draw(SPOOL)))
+
+  def testOneLineAtATime(self):
+    from cStringIO import StringIO
+    job = RascalPDF.PrintJob(output=StringIO(), streaming=True)
+    sizes = []
+    fnexec = RascalPDF.RascalPDF.fnexec
+    def counted(pdf, fnname, *params, **kwargs):
+      sizes.append(len(job.parser.cmdlist))
+      return fnexec(pdf, fnname, *params, **kwargs)
+    RascalPDF.RascalPDF.fnexec = counted
+    try:
+      job.feed(StringIO(SPOOL))
+    finally:
+      RascalPDF.RascalPDF.fnexec = fnexec
+    self.assertTrue(len(sizes) > 1000 and max(sizes) <= 7, max(sizes))
+
+class CompiledTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+
+  def testSameAsInterpreted(self):
+    self.assertEqual(undated(self.draw(SPOOL, compiled=True)), undated(self.draw(SPOOL)))
+
+  def testUnknownCommandsReportedFirst(self):
+    try:
+      self.draw("one\n{$NOSUCH(1)}two\nthree {$NOTHERE}\n", compiled=True)
+    except RascalPDF.RascalPDFException, e:
+      self.assertTrue("NOSUCH (line 2)" in str(e) and "NOTHERE (line 3)" in str(e), e)
+    else:
+      self.fail("Unknown commands were not reported")
+
+  def testBoundLazily(self):
+    parser = RascalPDF._Parser()
+    for line in SPOOL.splitlines(True): parser.parseLine(line)
+    pdf = RascalPDF.RascalPDF(os.devnull)
+    self.assertTrue(isinstance(pdf.compile(parser.cmdlist), types.GeneratorType))
+
+  def testProgramFails(self):
+    def program():
+      raise ValueError("bad program")
+      yield
+    pdf = RascalPDF.RascalPDF(os.devnull)
+    self.assertRaises(ValueError, pdf.run, program())
+
+class FormTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.mkdir(".", {"header.inc": "{$B1}Company header{$B0}\n"})
+
+  def forms(self, pdf):
+    """(<forms in pdf>, <times a form is placed>)"""
+    return pdf.count("/Subtype /Form"), len(re.findall(r"/FormXob\.RasForm\d+ Do", pdf))
+
+  def testReused(self):
+    pdf = self.draw("".join([ "{$FORM(header.inc)}Page %d\n{$NEWPAGE}" % (i) for i in range(5) ]))
+    self.assertEqual(self.forms(pdf), (1, 5))
+
+  def testOtherState(self):
+    pdf = self.draw("{$FORM(header.inc)}Page 1\n{$NEWPAGE}{$SF(12)}{$FORM(header.inc)}Page 2\n")
+    self.assertEqual(self.forms(pdf)[0], 2)
+
+  def testLoop(self):
+    self.mkdir(".", {"loop.inc": "Loop{$FORM(loop.inc)}\n"})
+    self.assertRaises(RascalPDF.RascalPDFException, self.draw, "{$FORM(loop.inc)}\n")
+
+class CachedInputTest(TestCase):
+  """The job cache hashes the input a block at a time."""
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.cache = RasCache.JobCache(self.mkdir("jobs"), 1024 * 1024)
+    self.readsize = RascalPDF._READSIZE
+    RascalPDF._READSIZE = 100 #Many blocks even for a small report.
+
+  def tearDown(self):
+    RascalPDF._READSIZE = self.readsize
+    TestCase.tearDown(self)
+
+  def pipe(self, data):
+    """A file that can only be read once holding data."""
+    r, w = os.pipe()
+    os.write(w, data)
+    os.close(w)
+    return os.fdopen(r, "rb")
+
+  def testPipe(self):
+    first = self.draw(self.pipe(SPOOL), cache=self.cache)
+    self.assertEqual(undated(first), undated(self.draw(SPOOL)))
+    self.assertEqual(first, self.draw(self.pipe(SPOOL), cache=self.cache)) #Copied from the cache.
+
+  def testSameKeyForAnyInput(self):
+    self.draw(self.pipe(SPOOL), cache=self.cache)
+    path = os.path.join(self.tmp, "spool")
+    file(path, "wb").write(SPOOL)
+    self.draw(file(path, "rb"), cache=self.cache)
+    self.assertEqual(len([ f for f in os.listdir(self.cache.directory) if f.endswith(".pdf") ]), 1)
+
+  def testChangedInput(self):
+    self.draw(SPOOL, cache=self.cache)
+    self.assertTrue("changed at the end" in self.draw(SPOOL + "changed at the end\n", cache=self.cache))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# © Ed Pascoe 2011. All rights reserved.
+"""Tests for the render server. The parent's side of a connection is driven by hand so no
+worker processes are started.
+"""
+__author__ = "Ed Pascoe <ed@pascoe.co.za>"
+__format__ = "plaintext"
+__version__ = "$Id$"
+__copyright__ = "Ed Pascoe 2011. All rights reserved."
+__license__ = "GNU LGPL version 2"
+__status__ = "Production"
+
+import os, socket, marshal, time, unittest
+from rastest import TestCase
+import server, RasPDF, RasConfig
+
+class ParentTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.server = server.Server(os.path.join(self.tmp, "raspdf.sock"), "xmmail.conf", count=1)
+    self.server._listen()
+    self.peerUid = server.peerUid
+
+  def tearDown(self):
+    server.peerUid = self.peerUid
+    self.server.stop()
+    self.server.socket.close()
+    TestCase.tearDown(self)
+
+  def send(self, kind, data=""):
+    """Connect, send a message and let the server read it. Returns the client's socket."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(self.server.path)
+    sock.settimeout(5)
+    server.sendMessage(sock, kind, data)
+    self.server._accept()
+    for s in self.server.clients.keys(): self.server._read(s)
+    return sock
+
+  def testPeerUid(self):
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.assertEqual(server.peerUid(a), os.getuid())
+
+  def testOwnJobQueued(self):
+    self.send("JOB", marshal.dumps({'cwd': self.tmp}))
+    self.assertEqual(len(self.server.queue), 1)
+
+  def testOtherUserRefused(self):
+    server.peerUid = lambda conn: os.getuid() + 1
+    sock = self.send("JOB", marshal.dumps({'cwd': "/"}))
+    kind, reply = server.recvMessage(sock.makefile('rb'))
+    self.assertEqual(kind, "REFUSED")
+    self.assertEqual(self.server.queue, [])
+
+  def testQueueFull(self):
+    self.server.queuesize = 2
+    for i in range(2): self.send("JOB", marshal.dumps({'cwd': self.tmp}))
+    sock = self.send("JOB", marshal.dumps({'cwd': self.tmp}))
+    kind, reply = server.recvMessage(sock.makefile('rb'))
+    self.assertEqual(kind, "BUSY")
+    self.assertTrue(1 <= int(reply) <= 30)
+    self.assertEqual(len(self.server.queue), 2)
+
+  def testPartJob(self):
+    """A JOB that arrives a piece at a time waits without blocking the server."""
+    job = marshal.dumps({'cwd': self.tmp})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(self.server.path)
+    sock.sendall("JOB %d\n%s" % (len(job), job[:3]))
+    self.server._accept()
+    for s in self.server.clients.keys(): self.server._read(s)
+    self.assertEqual((len(self.server.clients), self.server.queue), (1, []))
+    sock.sendall(job[3:])
+    for s in self.server.clients.keys(): self.server._read(s)
+    self.assertEqual((len(self.server.clients), len(self.server.queue)), (0, 1))
+
+  def worker(self):
+    """A ready worker. Returns the worker's end of its control socket.
+       The process exits at once and is only there so stop() has something to collect.
+    """
+    pid = os.fork()
+    if pid == 0: os._exit(0)
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.server.children[parent] = server._Child(pid, parent)
+    self.server.ready.append(self.server.children[parent])
+    return child
+
+  def testSendFd(self):
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    client, conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.sendfd(a.fileno(), conn.fileno())
+    conn.close()
+    fd = server.recvfd(b.fileno())
+    os.write(fd, "passed")
+    os.close(fd)
+    self.assertEqual(client.recv(10), "passed")
+
+  def testConnectionPassed(self):
+    control = self.worker()
+    sock = self.send("JOB", marshal.dumps({'cwd': self.tmp}))
+    self.server._dispatch()
+    self.assertEqual((self.server.queue, self.server.ready), ([], []))
+    fd = server.recvfd(control.fileno())
+    kind, options = server.recvMessage(control.makefile('rb', 0))
+    self.assertEqual((kind, marshal.loads(options)), ("JOB", {'cwd': self.tmp}))
+    conn = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    server.sendMessage(conn, "SEND") #The worker talks to the client directly.
+    self.assertEqual(server.recvMessage(sock.makefile('rb')), ("SEND", ""))
+
+  def testWorkerGone(self):
+    self.worker().close()
+    self.send("JOB", marshal.dumps({'cwd': self.tmp}))
+    self.server._dispatch()
+    self.assertEqual((len(self.server.queue), self.server.children), (1, {}))
+    for pid in self.server.leaving: os.waitpid(pid, 0)
+
+class SchedulingTest(TestCase):
+  """Small and interactive jobs are drawn first without starving big ones."""
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.server = server.Server(os.path.join(self.tmp, "raspdf.sock"), "xmmail.conf", count=2, reserve=1)
+    self.sockets = []
+
+  def tearDown(self):
+    for s in self.sockets: s.close()
+    TestCase.tearDown(self)
+
+  def queue(self, lines, interactive=False, waited=0):
+    """Queue a job of lines lines. Returns its _Client."""
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sockets += [a, b]
+    client = server._Client(b, True)
+    client.accepted -= waited
+    client.options = server.describe("Invoice line\n" * lines, interactive)
+    self.server._queue(client)
+    return client
+
+  def order(self):
+    return [ entry[-1] for entry in sorted(self.server.queue) ]
+
+  def busy(self, big):
+    """A worker drawing a job."""
+    child = server._Child(None, None)
+    child.started, child.big = time.time(), big
+    self.server.children[len(self.server.children)] = child
+
+  def testDescribe(self):
+    self.assertEqual(server.describe("YMLTEMPLATE invoice.yml\nline\n", True),
+                     {'size': 29, 'lines': 2, 'interactive': True, 'template': True})
+    self.assertFalse(server.describe("line\nYMLTEMPLATE\n", False)['template'])
+
+  def testCost(self):
+    small = server.cost(server.describe("line\n" * 10, False))
+    self.assertTrue(small < server.cost(server.describe("line\n" * 1000, False)))
+    self.assertTrue(small < server.cost(server.describe("YMLTEMPLATE\n" + "line\n" * 9, False)))
+    self.assertEqual(server.cost({'lines': "many"}), server.JOBSECONDS)
+
+  def testSmallFirst(self):
+    big = self.queue(200000)
+    small = self.queue(10)
+    self.assertTrue(big.big and not small.big)
+    self.assertEqual(self.order(), [small, big])
+
+  def testInteractiveFirst(self):
+    batch = self.queue(10)
+    interactive = self.queue(1000, interactive=True)
+    self.assertEqual(self.order(), [interactive, batch])
+    self.assertFalse(self.queue(200000, interactive=True).big)
+
+  def testAgeing(self):
+    big = self.queue(200000, waited=60)
+    small = self.queue(10)
+    self.assertEqual(self.order(), [big, small])
+
+  def testReserve(self):
+    self.queue(200000)
+    self.assertEqual(self.server._next(), 0)
+    self.busy(True) #Only the reserved worker is left.
+    self.assertEqual(self.server._next(), None)
+    small = self.queue(10, waited=-60) #Would otherwise wait behind the big job.
+    self.assertTrue(self.server.queue[self.server._next()][-1] is small)
+
+class ReplaceTest(TestCase):
+  """Workers that exit are collected and the cause kept for STATUS."""
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.server = server.Server(os.path.join(self.tmp, "raspdf.sock"), "xmmail.conf", count=1)
+
+  def exit(self, status):
+    """A worker that exits with status straight away."""
+    pid = os.fork()
+    if pid == 0: os._exit(status)
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    child.close()
+    self.server.children[parent] = server._Child(pid, parent)
+    self.server.children[parent].jobs = 7
+    return pid
+
+  def testCause(self):
+    self.assertEqual(server._cause(server.EXITJOBS << 8), "jobs")
+    self.assertEqual(server._cause(server.EXITMEMORY << 8), "memory")
+    self.assertEqual(server._cause(9), "signal 9")
+
+  def testReaped(self):
+    pid = self.exit(server.EXITMEMORY)
+    deadline = time.time() + 5
+    while not self.server.exited and time.time() < deadline:
+      time.sleep(0.01)
+      self.server._reap()
+    self.assertEqual(self.server.children, {})
+    self.assertEqual(list(self.server.exited)[0][:3], (pid, "memory", 7))
+    self.assertTrue("exited %s after 7 jobs (memory)" % (pid) in self.server.status())
+
+class RequestTest(TestCase):
+  """A busy server is retried."""
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self._request = server._request
+    self.sleep = server.time.sleep
+    self.slept = []
+    server.time.sleep = self.slept.append
+
+  def tearDown(self):
+    server._request = self._request
+    server.time.sleep = self.sleep
+    TestCase.tearDown(self)
+
+  def replies(self, *replies):
+    replies = list(replies)
+    server._request = lambda path, options, data: replies.pop(0)
+
+  def testRetried(self):
+    self.replies(("BUSY", "2"), ("BUSY", "3"), ("PDF", "%PDF-1.4"))
+    self.assertEqual(server.request("raspdf.sock", {}, "Invoice 1234\n", wait=60), "%PDF-1.4")
+    self.assertEqual(self.slept, [2.0, 3.0])
+
+  def testGivesUp(self):
+    self.replies(("BUSY", "2"), ("BUSY", "30"))
+    self.assertEqual(server.request("raspdf.sock", {}, "Invoice 1234\n", wait=10), None)
+    self.assertEqual(self.slept, [2.0])
+
+  def testNoServer(self):
+    self.assertEqual(server.request(os.path.join(self.tmp, "none.sock"), {}, "Invoice 1234\n"), None)
+
+class WorkerTest(TestCase):
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.configure()
+    self.worker = server.Worker(os.path.join(self.tmp, "etc", "xmmail.conf"))
+
+  def options(self, cwd=None):
+    options = dict([ (k, None) for k in RasPDF.RENDEROPTIONS ])
+    options.update({'config': self.worker.config, 'cwd': cwd or self.tmp, 'jobs': 1})
+    return options
+
+  def handle(self, data, cwd=None):
+    """Send data to the worker as a job run in cwd. Returns the worker's reply."""
+    client, conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.sendMessage(client, "DATA", data)
+    self.worker.handle(conn, self.options(cwd))
+    f = client.makefile('rb')
+    self.assertEqual(server.recvMessage(f)[0], "SEND")
+    return server.recvMessage(f)
+
+  def testPdf(self):
+    kind, reply = self.handle("Invoice 1234\n")
+    self.assertEqual(kind, "PDF")
+    self.assertTrue("Invoice 1234" in reply)
+
+  def testUnreadableDirectory(self):
+    self.assertEqual(self.handle("Invoice 1234\n", os.path.join(self.tmp, "gone"))[0], "REFUSED")
+
+  def testUnreadableInclude(self):
+    self.assertEqual(self.handle("{$INCLUDE(header.inc)}Invoice 1234\n")[0], "REFUSED")
+
+  def testBadJob(self):
+    self.assertEqual(self.handle("{$NOSUCHCOMMAND}Invoice 1234\n")[0], "ERROR")
+
+  def testJobExits(self):
+    self.assertEqual(self.handle("{$POPPOS}Invoice 1234\n")[0], "ERROR")
+    self.assertEqual(self.handle("Invoice 1234\n")[0], "PDF")
+
+  def testClientGone(self):
+    client, conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.sendMessage(client, "DATA", "Invoice 1234\n")
+    render = self.worker.render
+    def hangUp(options, data):
+      client.close()
+      return render(options, data)
+    self.worker.render = hangUp
+    self.worker.handle(conn, self.options()) #Does not raise.
+
+  def testRetire(self):
+    rss = server.rss
+    server.rss = lambda: 600.0
+    try:
+      self.assertEqual(self.worker.retire(3, 500), None) #Not before its first job.
+      self.handle("Invoice 1234\n")
+      self.assertEqual(self.worker.retire(3, 500), server.EXITMEMORY)
+      self.assertEqual(self.worker.retire(3, 0), None)
+      self.handle("Invoice 1234\n")
+      self.handle("Invoice 1234\n")
+      self.assertEqual(self.worker.retire(3, 0), server.EXITJOBS)
+    finally:
+      server.rss = rss
+
+  def testRss(self):
+    self.assertTrue(0 < server.rss() < 10000)
+
+  def testFilesOfOneJob(self):
+    self.mkdir("a", {"header.inc": "Header\n"})
+    self.assertEqual(self.handle("{$INCLUDE(header.inc)}Invoice 1234\n", os.path.join(self.tmp, "a"))[0], "PDF")
+    self.assertEqual(self.handle("Invoice 1234\n")[0], "PDF")
+    self.assertEqual((RasConfig.locatedFiles, RasConfig.locatedNames), (set(), {}))
+
+if __name__ == "__main__":
+  unittest.main()